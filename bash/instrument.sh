@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+
+# Runs a workflow stage and appends its wall time, CPU time, peak RSS and bytes moved to
+# $FORECASTS_DIR/$YMD/logs/metrics.jsonl. The exit code of the command is passed through.
+#
+# Usage: instrument.sh STAGE [--vpu VPU] [--outputs GLOB ...] -- COMMAND [ARGS ...]
+
+SCRIPT_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+
+if [[ -z "$YMD" ]]; then
+    echo "Error: YMD must be exported to instrument a stage"
+    exit 1
+fi
+
+STAGE=$1
+shift
+python "$SCRIPT_DIR/../python/instrumentation.py" run --stage "$STAGE" --ymd "$YMD" "$@"
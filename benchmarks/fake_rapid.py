@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the RAPID executable for testing and benchmarking the workflow without the RAPID container
+
+Accepts the same command line as RAPID (--namelist plus ignored PETSc options), reads the inflow file, river
+network and optional Qinit file named in the namelist, and writes a Qout file (and Qfinal file if requested) with
+the same layout as RAPID. Discharge is the inflow volume per second accumulated down the river network and
+attenuated over time, which gives realistic magnitudes without solving the Muskingum equations.
+
+Example:
+    python python/runrapid.py --namelist namelist_101_1 --rapidexec benchmarks/fake_rapid.py
+"""
+import argparse
+import datetime
+import os
+import re
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+
+
+def read_namelist(namelist_file: str) -> dict:
+    options = {}
+    with open(namelist_file) as f:
+        for line in f:
+            match = re.match(r"^\s*(\w+)\s*=\s*(.*?)\s*$", line)
+            if match:
+                options[match.group(1)] = match.group(2).strip("'")
+    return options
+
+
+def downstream_accumulation_order(rivids: np.ndarray, next_down: np.ndarray) -> tuple:
+    """
+    Returns the position of each reach's downstream reach (-1 at outlets) and the reach positions grouped in levels
+    so that every reach comes after all reaches upstream of it
+    """
+    down_idx = pd.Index(rivids).get_indexer(next_down)
+    n_upstream = np.bincount(down_idx[down_idx >= 0], minlength=rivids.shape[0])
+    levels = []
+    ready = np.flatnonzero(n_upstream == 0)
+    while ready.size:
+        levels.append(ready)
+        downstream = down_idx[ready]
+        downstream = downstream[downstream >= 0]
+        np.subtract.at(n_upstream, downstream, 1)
+        ready = np.unique(downstream[n_upstream[downstream] == 0])
+    return down_idx, levels
+
+
+def route(namelist: dict) -> None:
+    rapid_connect = pd.read_csv(namelist['rapid_connect_file'], header=None)
+    riv_bas_id = pd.read_csv(namelist['riv_bas_id_file'], header=None).iloc[:, 0].to_numpy()
+    down_idx, levels = downstream_accumulation_order(rapid_connect[0].to_numpy(), rapid_connect[1].to_numpy())
+
+    with nc.Dataset(namelist['Vlat_file']) as ds:
+        vlat_rivids = ds['rivid'][:]
+        volumes = ds['m3_riv'][:].astype(np.float64)
+        times = ds['time'][:]
+        time_units = ds['time'].units
+        time_bnds = ds['time_bnds'][:] if 'time_bnds' in ds.variables else None
+        lat = ds['lat'][:] if 'lat' in ds.variables else np.zeros(vlat_rivids.shape)
+        lon = ds['lon'][:] if 'lon' in ds.variables else np.zeros(vlat_rivids.shape)
+
+    dt = float(namelist['ZS_TauR'])
+    lateral = np.zeros((volumes.shape[0], rapid_connect.shape[0]))
+    positions = pd.Index(rapid_connect[0].to_numpy()).get_indexer(vlat_rivids)
+    lateral[:, positions[positions >= 0]] = volumes[:, positions >= 0] / dt
+
+    # accumulate the lateral inflows down the network, upstream reaches first
+    accumulated = lateral.copy()
+    for level in levels:
+        level = level[down_idx[level] >= 0]
+        np.add.at(accumulated, (slice(None), down_idx[level]), accumulated[:, level])
+
+    # attenuate with a linear reservoir so that the hydrograph has memory of the initial flows
+    qout = np.empty_like(accumulated)
+    previous = np.zeros(accumulated.shape[1])
+    if namelist.get('BS_opt_Qinit') == '.true.' and os.path.exists(namelist.get('Qinit_file', '')):
+        with nc.Dataset(namelist['Qinit_file']) as ds:
+            qinit = pd.Series(ds['Qout'][0, :], index=ds['rivid'][:])
+        previous = qinit.reindex(rapid_connect[0].to_numpy()).fillna(0).to_numpy()
+    for t in range(accumulated.shape[0]):
+        previous = 0.5 * previous + 0.5 * accumulated[t]
+        qout[t] = previous
+
+    output_positions = pd.Index(rapid_connect[0].to_numpy()).get_indexer(riv_bas_id)
+    qout = qout[:, output_positions]
+    lat = pd.Series(lat, index=vlat_rivids).reindex(riv_bas_id).fillna(0).to_numpy()
+    lon = pd.Series(lon, index=vlat_rivids).reindex(riv_bas_id).fillna(0).to_numpy()
+
+    write_qout(namelist['Qout_file'], riv_bas_id, qout, times + int(dt), time_units, time_bnds, lat, lon)
+    if namelist.get('BS_opt_Qfinal') == '.true.' and namelist.get('Qfinal_file'):
+        write_qout(namelist['Qfinal_file'], riv_bas_id, qout[-1:], times[-1:] + int(dt), time_units, None, lat, lon)
+
+
+def write_qout(path: str, rivids: np.ndarray, qout: np.ndarray, times: np.ndarray, time_units: str,
+               time_bnds: np.ndarray or None, lat: np.ndarray, lon: np.ndarray) -> None:
+    with nc.Dataset(path, 'w', format='NETCDF3_64BIT_OFFSET') as ds:
+        ds.createDimension('time', qout.shape[0])
+        ds.createDimension('rivid', rivids.shape[0])
+        ds.createDimension('nv', 2)
+
+        qout_var = ds.createVariable('Qout', 'f4', ('time', 'rivid'))
+        qout_var[:] = qout
+        qout_var.long_name = 'instantaneous river water discharge downstream of each river reach'
+        qout_var.units = 'm3 s-1'
+        qout_var.coordinates = 'lon lat'
+        qout_var.grid_mapping = 'crs'
+        qout_var.cell_methods = 'time: mean'
+
+        ds.createVariable('rivid', 'i4', ('rivid',))[:] = rivids
+        ds['rivid'].long_name = 'unique identifier for each river reach'
+        ds['rivid'].cf_role = 'timeseries_id'
+
+        time_var = ds.createVariable('time', 'i4', ('time',))
+        time_var[:] = times
+        time_var.units = time_units
+        time_var.standard_name = 'time'
+        time_var.axis = 'T'
+        time_var.calendar = 'gregorian'
+        time_var.bounds = 'time_bnds'
+        bnds = ds.createVariable('time_bnds', 'i4', ('time', 'nv'))
+        bnds[:] = time_bnds if time_bnds is not None else np.stack([times, times], axis=1)
+
+        ds.createVariable('lon', 'f8', ('rivid',))[:] = lon
+        ds.createVariable('lat', 'f8', ('rivid',))[:] = lat
+        crs_var = ds.createVariable('crs', 'i4')
+        crs_var.grid_mapping_name = 'latitude_longitude'
+        crs_var.epsg_code = 'EPSG:4326'
+        ds.createVariable('Qout_err', 'f4', ('rivid',))[:] = 0
+
+        ds.Conventions = 'CF-1.6'
+        ds.featureType = 'timeSeries'
+        ds.history = f'date_created: {datetime.datetime.now(datetime.UTC)} by fake_rapid.py'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--namelist', type=str, required=True, help='Path to namelist file')
+    args, _ = parser.parse_known_args()
+    route(read_namelist(args.namelist))
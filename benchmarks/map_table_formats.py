@@ -0,0 +1,153 @@
+"""
+Benchmark the columnar outputs of generate_global_map_tables.py against the global map table CSVs
+
+Creates synthetic global map tables for two consecutive forecast days in a temporary workspace, where the previous
+day is shifted by one day and --changed of its reaches are in a different class, then writes the second day as CSVs,
+as parquet files per timestamp and as one arrow IPC file, and the delta against the previous day. Reports the size,
+write time and read time of each output, and checks that every columnar table holds the same rows as the CSVs.
+
+Example:
+    python benchmarks/map_table_formats.py --reaches 200000 --timesteps 81 --changed 0.05
+"""
+import argparse
+import datetime
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+
+YMD = '20240102'
+PREVIOUS_YMD = '20240101'
+THICKNESS_BINS = np.array([20, 250, 1500, 10000, 30000])
+RETURN_PERIOD_CLASSES = np.array([0, 2, 5, 10, 25, 50, 100])
+
+
+def synthetic_partitions(comids: np.ndarray, dates: list, rng: np.random.Generator,
+                         probabilities: bool = False) -> dict:
+    """
+    Global map tables keyed by (timestamp, ) with the columns and types of the VPU map tables
+    """
+    partitions = {}
+    for date in dates:
+        flows = rng.lognormal(mean=3, sigma=2.5, size=comids.shape[0]).round(2)
+        columns = {
+            'timestamp': np.full(comids.shape[0], np.datetime64(date, 'ns')),
+            'comid': comids,
+            'mean': flows,
+            'thickness': np.digitize(flows, THICKNESS_BINS).astype(np.int64) + 1,
+            # most reaches are below the 2 year return period on any day
+            'ret_per': RETURN_PERIOD_CLASSES[np.minimum(rng.geometric(0.8, comids.shape[0]) - 1, 6)],
+        }
+        if probabilities:
+            for rp in RETURN_PERIOD_CLASSES[1:]:
+                columns[f'prob_rp{rp}'] = (rng.integers(0, 52, comids.shape[0]) / 51).round(2)
+        partitions[(date, )] = pl.DataFrame(columns)
+    return partitions
+
+
+def previous_day(partitions: dict, changed: float, rng: np.random.Generator) -> dict:
+    """
+    The tables of the forecast made the day before, which start and end one day earlier, with a fraction of the
+    reaches of each timestamp in a different thickness class
+    """
+    previous = {}
+    for (date, ), df in sorted(partitions.items()):
+        previous_date = date - datetime.timedelta(days=1)
+        df = partitions.get((previous_date, ), df)
+        mask = pl.Series(rng.random(df.height) < changed)
+        previous[(previous_date, )] = df.with_columns(
+            pl.lit(previous_date).cast(pl.Datetime('ns')).alias('timestamp'),
+            pl.when(mask).then(pl.col('thickness') % 6 + 1).otherwise(pl.col('thickness')).alias('thickness'),
+        )
+    return previous
+
+
+def directory_size(paths: list) -> int:
+    return sum(os.path.getsize(x) for x in paths)
+
+
+def _timed(function, *args) -> float:
+    t0 = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - t0
+
+
+def _read_csvs(paths: list) -> None:
+    for path in paths:
+        pl.read_csv(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reaches', type=int, default=200_000, help='Number of reaches in the global table')
+    parser.add_argument('--timesteps', type=int, default=81, help='Number of forecast timestamps')
+    parser.add_argument('--changed', type=float, default=0.05,
+                        help='Fraction of the reaches of each timestamp in a different class the day before')
+    parser.add_argument('--probabilities', action='store_true', default=False,
+                        help='Add the prob_rp columns of the ensemble exceedance tables')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of threads writing files')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workspace:
+        os.environ['FORECASTS_DIR'] = os.path.join(workspace, 'forecasts')
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
+        from generate_global_map_tables import (_write_partitions, columnar_dir, read_columnar_tables,  # noqa: E402
+                                                write_columnar_outputs)
+
+        rng = np.random.default_rng(args.seed)
+        comids = rng.choice(np.arange(100_000_000, 800_000_000), size=args.reaches, replace=False).astype(np.int32)
+        start = datetime.datetime.strptime(YMD, '%Y%m%d')
+        dates = [start + datetime.timedelta(hours=3 * i) for i in range(args.timesteps)]
+        partitions = synthetic_partitions(comids, dates, rng, args.probabilities)
+        previous = previous_day(partitions, args.changed, rng)
+        write_columnar_outputs(PREVIOUS_YMD, previous, 'arrow', args.workers)
+
+        csv_dir = os.path.join(workspace, 'forecasts', YMD, 'maptables')
+        os.makedirs(csv_dir)
+        results = {'csv': {
+            'write': _timed(_write_partitions, partitions, csv_dir, args.workers),
+        }}
+        csv_files = glob.glob(os.path.join(csv_dir, '*.csv'))
+        results['csv'].update(bytes=directory_size(csv_files), read=_timed(_read_csvs, csv_files))
+
+        csv_tables = {date: df for (date, ), df in partitions.items()}
+        for columnar_format in ('parquet', 'arrow'):
+            shutil.rmtree(columnar_dir(YMD), ignore_errors=True)
+            t0 = time.perf_counter()
+            outputs = write_columnar_outputs(YMD, partitions, columnar_format, args.workers)
+            write_seconds = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            tables = read_columnar_tables(columnar_dir(YMD))
+            read_seconds = time.perf_counter() - t0
+            assert tables.keys() == csv_tables.keys()
+            for date, df in tables.items():
+                expected = csv_tables[date]
+                assert df['comid'].to_list() == expected['comid'].to_list()
+                assert (df['thickness'].cast(pl.Int64) == expected['thickness']).all()
+                assert (df['ret_per'].cast(pl.Int64) == expected['ret_per']).all()
+                assert np.allclose(df['mean'].to_numpy(), expected['mean'].to_numpy(), rtol=1e-6)
+            results[columnar_format] = {'bytes': directory_size(outputs), 'write': write_seconds, 'read': read_seconds}
+
+            # the delta is timed as the extra seconds of writing the same outputs with it
+            t0 = time.perf_counter()
+            delta_path = write_columnar_outputs(YMD, partitions, columnar_format, args.workers, delta=True)[-1]
+            results[f'{columnar_format} delta'] = {
+                'bytes': os.path.getsize(delta_path),
+                'write': time.perf_counter() - t0 - write_seconds,
+                'read': float('nan'),
+            }
+
+    n_rows = args.reaches * args.timesteps
+    csv_bytes = results['csv']['bytes']
+    print(f'{args.reaches:,} reaches x {args.timesteps} timestamps = {n_rows:,} rows, '
+          f'{args.changed:.0%} reclassified since the day before')
+    print(f'{"output":<16}{"MB":>10}{"vs csv":>10}{"write s":>10}{"Mrows/s":>10}{"read s":>10}')
+    for name, result in results.items():
+        print(f'{name:<16}{result["bytes"] / 1e6:>10.2f}{result["bytes"] / csv_bytes:>10.1%}{result["write"]:>10.2f}'
+              f'{n_rows / result["write"] / 1e6:>10.1f}{result["read"]:>10.2f}')
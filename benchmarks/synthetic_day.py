@@ -0,0 +1,207 @@
+"""
+Generate a synthetic forecast day to run the workflow without ECMWF runoffs, the real VPU configs or RAPID
+
+Creates a CONFIGS_DIR tree of VPUs (rapid_connect.csv, riv_bas_id.csv, k.csv, x.csv, comid_lat_lon_z.csv and a
+weight table), the return period files, and the runoff ensemble of one day with the ECMWF timesteps: members 1-51
+every 3 hours to 144 hours then every 6 hours to 360 hours, and member 52 hourly to 90 hours, every 3 hours to 144
+hours and every 6 hours to 240 hours. Use benchmarks/fake_rapid.py as the RAPID executable.
+
+Example:
+    python benchmarks/synthetic_day.py --root /tmp/synthetic --reaches 100000 --vpus 8
+"""
+import argparse
+import os
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+
+from fake_rapid import downstream_accumulation_order
+
+YMD = '20240101'
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+MEMBER_HOURS = np.concatenate([np.arange(3, 145, 3), np.arange(150, 361, 6)])
+HRES_HOURS = np.concatenate([np.arange(1, 91), np.arange(93, 145, 3), np.arange(150, 241, 6)])
+# mean annual runoff depth used to scale the return period flows
+ANNUAL_RUNOFF_METERS = 0.3
+
+
+def workspace_paths(root: str) -> dict:
+    return {
+        'CONFIGS_DIR': os.path.join(root, 'configs'),
+        'RUNOFFS_DIR': os.path.join(root, 'runoffs'),
+        'FORECASTS_DIR': os.path.join(root, 'forecasts'),
+        'INITS_DIR': os.path.join(root, 'inits'),
+        'RETURN_PERIODS_DIR': os.path.join(root, 'returnperiods'),
+    }
+
+
+def vpu_sizes(n_reaches: int, n_vpus: int, rng: np.random.Generator) -> list:
+    # real VPUs differ in size by more than an order of magnitude
+    weights = rng.lognormal(sigma=0.7, size=n_vpus)
+    sizes = np.maximum(np.floor(weights / weights.sum() * n_reaches).astype(int), 1)
+    sizes[np.argmax(sizes)] += n_reaches - sizes.sum()
+    return sizes.tolist()
+
+
+def river_network(n_reaches: int, rng: np.random.Generator, max_basin_size: int = 5000) -> np.ndarray:
+    """
+    Returns the local index of the downstream reach of each reach (-1 at outlets)
+
+    Reaches are split into basins and each reach drains to one of the next few reaches of its basin, so that every
+    reach comes after all reaches upstream of it and the network branches like a real one.
+    """
+    down = np.full(n_reaches, -1)
+    start = 0
+    while start < n_reaches:
+        size = int(min(max(rng.lognormal(mean=np.log(max_basin_size) - 2, sigma=1.5), 1), max_basin_size))
+        end = min(start + size, n_reaches)
+        local = np.arange(start, end - 1)
+        spread = rng.integers(1, 4, size=local.shape[0])
+        down[local] = np.minimum(local + spread, end - 1)
+        start = end
+    return down
+
+
+def write_vpu_config(configs_dir: str, return_periods_dir: str, vpu: str, n_reaches: int, grid_shape: tuple,
+                     box: tuple, rng: np.random.Generator) -> None:
+    vpu_dir = os.path.join(configs_dir, vpu)
+    os.makedirs(vpu_dir, exist_ok=True)
+    rivids = int(vpu) * 1_000_000 + np.arange(1, n_reaches + 1)
+    down = river_network(n_reaches, rng)
+    next_down = np.where(down >= 0, rivids[np.maximum(down, 0)], 0)
+
+    # rapid_connect: rivid, next down, number of upstream reaches, then the upstream rivids padded with 0
+    upstream = pd.Series(rivids[down >= 0]).groupby(down[down >= 0]).agg(list)
+    n_upstream = np.zeros(n_reaches, dtype=int)
+    n_upstream[upstream.index] = upstream.str.len()
+    max_upstream = max(int(n_upstream.max()), 1)
+    upstream_ids = np.zeros((n_reaches, max_upstream), dtype=np.int64)
+    for position, ids in upstream.items():
+        upstream_ids[position, :len(ids)] = ids
+    rapid_connect = np.column_stack([rivids, next_down, n_upstream, upstream_ids])
+    pd.DataFrame(rapid_connect).to_csv(os.path.join(vpu_dir, 'rapid_connect.csv'), header=False, index=False)
+    pd.DataFrame(rivids).to_csv(os.path.join(vpu_dir, 'riv_bas_id.csv'), header=False, index=False)
+    pd.DataFrame(rng.uniform(1800, 10800, n_reaches).round(2)).to_csv(
+        os.path.join(vpu_dir, 'k.csv'), header=False, index=False)
+    pd.DataFrame(np.full(n_reaches, 0.25)).to_csv(os.path.join(vpu_dir, 'x.csv'), header=False, index=False)
+
+    min_lat, max_lat, min_lon, max_lon = box
+    lat = rng.uniform(min_lat, max_lat, n_reaches)
+    lon = rng.uniform(min_lon, max_lon, n_reaches)
+    pd.DataFrame({'comid': rivids, 'lat': lat, 'lon': lon, 'z': 0}).to_csv(
+        os.path.join(vpu_dir, 'comid_lat_lon_z.csv'), index=False)
+
+    # each reach catchment overlaps 1 to 3 runoff cells near the reach
+    ny, nx = grid_shape
+    n_cells = rng.integers(1, 4, size=n_reaches)
+    reach = np.repeat(np.arange(n_reaches), n_cells)
+    lat_index = np.clip(((90 - lat[reach]) / 180 * (ny - 1)).round().astype(int) + rng.integers(-1, 2, reach.size),
+                        0, ny - 1)
+    lon_index = ((lon[reach] + 180) / 360 * nx).astype(int) % nx
+    area = rng.lognormal(mean=np.log(2e7), sigma=1, size=n_reaches)
+    pd.DataFrame({
+        'streamID': rivids[reach],
+        'area_sqm': (area[reach] / n_cells[reach]).round(1),
+        'lon_index': lon_index,
+        'lat_index': lat_index,
+        'npoints': n_cells[reach],
+        'lon': -180 + lon_index * 360 / nx,
+        'lat': 90 - lat_index * 180 / (ny - 1),
+    }).to_csv(os.path.join(vpu_dir, f'weight_synthetic_{ny}x{nx}.csv'), index=False)
+
+    # return periods scale with the mean flow from the upstream area
+    down_idx, levels = downstream_accumulation_order(rivids, next_down)
+    upstream_area = area.copy()
+    for level in levels:
+        level = level[down_idx[level] >= 0]
+        np.add.at(upstream_area, down_idx[level], upstream_area[level])
+    mean_flow = upstream_area * ANNUAL_RUNOFF_METERS / (365 * 86400)
+    order = rng.permutation(n_reaches)
+    with nc.Dataset(os.path.join(return_periods_dir, f'returnperiods_{vpu}.nc'), 'w') as ds:
+        ds.createDimension('rivid', n_reaches)
+        ds.createVariable('rivid', 'i4', ('rivid',))[:] = rivids[order]
+        for factor, rp in zip((3, 5, 6.5, 8.5, 10, 11.5), RETURN_PERIODS):
+            ds.createVariable(f'rp{rp}', 'f8', ('rivid',))[:] = (mean_flow * factor)[order]
+
+
+def write_runoff(path: str, hours: np.ndarray, grid_shape: tuple, storms: np.ndarray, member_seed: int) -> None:
+    """
+    Writes an ensemble member of incremental runoff depths in meters: a smooth field moving eastward plus storms
+    which every member shares, perturbed differently per member
+    """
+    rng = np.random.default_rng(member_seed)
+    ny, nx = grid_shape
+    lat = np.linspace(90, -90, ny)
+    lon = np.linspace(-180, 180, nx, endpoint=False)
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('time', hours.shape[0])
+        ds.createDimension('lat', ny)
+        ds.createDimension('lon', nx)
+        time_var = ds.createVariable('time', 'i4', ('time',))
+        time_var[:] = hours
+        time_var.units = f'hours since {pd.to_datetime(YMD).strftime("%Y-%m-%d")} 00:00:00'
+        time_var.calendar = 'gregorian'
+        ds.createVariable('lat', 'f4', ('lat',))[:] = lat
+        ds.createVariable('lon', 'f4', ('lon',))[:] = lon
+        runoff = ds.createVariable('RO', 'f4', ('time', 'lat', 'lon'), zlib=True, complevel=1)
+        runoff.units = 'm'
+
+        step_hours = np.diff(np.concatenate([[0], hours]))
+        wet = np.cos(np.deg2rad(lat))[:, None] ** 2
+        storm_shapes = np.exp(-((lat[None, :, None] - storms[:, 0, None, None]) ** 2 +
+                                (lon[None, None, :] - storms[:, 1, None, None]) ** 2) / 25)
+        for t, (hour, step) in enumerate(zip(hours, step_hours)):
+            phase = np.sin(np.deg2rad(lon)[None, :] * 3 - hour / 24 + rng.normal(scale=0.1))
+            storm_timing = np.exp(-((hour - storms[:, 2]) / 24) ** 2)
+            storm_strength = storms[:, 3] * rng.uniform(0.6, 1.4, len(storms)) * storm_timing
+            field = wet * (1 + phase) * 3e-5 + np.tensordot(storm_strength, storm_shapes, axes=1)
+            runoff[t] = (field * step).astype(np.float32)
+
+
+def generate_day(root: str, n_reaches: int, n_vpus: int, n_members: int = 51, grid_shape: tuple = (181, 360),
+                 seed: int = 0) -> dict:
+    """
+    Writes the configs, return periods and runoffs of a synthetic forecast day under root
+
+    Returns:
+        dict: The environment variables which point the workflow scripts at the synthetic day
+    """
+    rng = np.random.default_rng(seed)
+    paths = workspace_paths(root)
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+
+    # VPUs sit side by side in longitude bands between 60S and 60N
+    vpus = [str(101 + i) for i in range(n_vpus)]
+    band = 360 / n_vpus
+    for i, (vpu, size) in enumerate(zip(vpus, vpu_sizes(n_reaches, n_vpus, rng))):
+        box = (-60, 60, -180 + i * band, -180 + (i + 1) * band)
+        write_vpu_config(paths['CONFIGS_DIR'], paths['RETURN_PERIODS_DIR'], vpu, size, grid_shape, box, rng)
+
+    runoffs_dir = os.path.join(paths['RUNOFFS_DIR'], YMD)
+    os.makedirs(runoffs_dir, exist_ok=True)
+    n_storms = 20
+    storms = np.column_stack([rng.uniform(-50, 50, n_storms), rng.uniform(-180, 180, n_storms),
+                              rng.uniform(0, 240, n_storms), rng.uniform(5e-4, 3e-3, n_storms)])
+    for member in [*range(1, n_members + 1), 52]:
+        hours = HRES_HOURS if member == 52 else MEMBER_HOURS
+        write_runoff(os.path.join(runoffs_dir, f'{member}.runoff.nc'), hours, grid_shape, storms, seed * 1000 + member)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='Directory to write the synthetic day to')
+    parser.add_argument('--reaches', type=int, default=100_000, help='Total number of river reaches')
+    parser.add_argument('--vpus', type=int, default=8, help='Number of VPUs the reaches are split into')
+    parser.add_argument('--members', type=int, default=51, help='Number of ensemble members besides 52')
+    parser.add_argument('--grid', type=str, default='181x360', help='Runoff grid shape as LATxLON')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    environment = generate_day(args.root, args.reaches, args.vpus, args.members,
+                               tuple(int(x) for x in args.grid.split('x')), args.seed)
+    print(f'Synthetic forecast day {YMD} written to {args.root}. Set these variables to run the workflow on it:')
+    for key, value in environment.items():
+        print(f'export {key}={value}')
@@ -0,0 +1,171 @@
+"""
+Benchmark the map table engine in generate_vpu_map_tables.py against the original pandas implementation
+
+Creates a synthetic VPU (nces_avg_{vpu}.nc and returnperiods_{vpu}.nc) in a temporary workspace, runs both
+implementations, checks that the parquet files are byte identical, and reports run time and peak traced memory.
+With --blocksize the streaming mode is also run in blocks of that many reaches and checked to hold the same rows.
+
+Example:
+    python benchmarks/vpu_map_tables.py --reaches 20000 --timesteps 85 --blocksize 2000
+"""
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+
+VPU = '999'
+YMD = '20240101'
+
+
+def make_synthetic_vpu(workspace: str, n_reaches: int, n_timesteps: int, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    outputs_dir = os.path.join(workspace, 'forecasts', YMD, 'outputs')
+    os.makedirs(outputs_dir, exist_ok=True)
+    os.makedirs(os.path.join(workspace, 'forecasts', YMD, 'maptables'), exist_ok=True)
+    os.makedirs(os.path.join(workspace, 'returnperiods'), exist_ok=True)
+
+    rivids = rng.choice(np.arange(100_000_000, 200_000_000), size=n_reaches, replace=False).astype(np.int32)
+    # log-normal flows span every thickness class, a few negative values exercise the clipping
+    flows = rng.lognormal(mean=3, sigma=2.5, size=(n_timesteps, n_reaches)).astype(np.float32)
+    flows[rng.random(flows.shape) < 0.001] *= -1
+
+    with nc.Dataset(os.path.join(outputs_dir, f'nces_avg_{VPU}.nc'), 'w') as ds:
+        ds.createDimension('time', n_timesteps)
+        ds.createDimension('rivid', n_reaches)
+        ds.createVariable('Qout', 'f4', ('time', 'rivid'))[:] = flows
+        ds.createVariable('rivid', 'i4', ('rivid',))[:] = rivids
+        time_var = ds.createVariable('time', 'i4', ('time',))
+        time_var[:] = np.arange(n_timesteps) * 3 * 3600
+        time_var.units = f'seconds since {pd.to_datetime(YMD).strftime("%Y-%m-%d")}'
+
+    # return periods are stored in a different order than the Qout rivids
+    rp_order = rng.permutation(n_reaches)
+    base = rng.lognormal(mean=4, sigma=2, size=n_reaches)
+    with nc.Dataset(os.path.join(workspace, 'returnperiods', f'returnperiods_{VPU}.nc'), 'w') as ds:
+        ds.createDimension('rivid', n_reaches)
+        ds.createVariable('rivid', 'i4', ('rivid',))[:] = rivids[rp_order]
+        for factor, rp in zip((1, 1.4, 1.7, 2.1, 2.4, 2.7), (2, 5, 10, 25, 50, 100)):
+            ds.createVariable(f'rp{rp}', 'f8', ('rivid',))[:] = (base * factor)[rp_order]
+
+
+def legacy_postprocess_vpu_forecast_directory(ymd: str, vpu: str, forecasts_dir: str, return_periods_dir: str,
+                                              output_path: str) -> None:
+    import xarray as xr
+
+    nces_output_filename = os.path.join(forecasts_dir, ymd, 'outputs', f'nces_avg_{vpu}.nc')
+    with xr.open_dataset(nces_output_filename) as ds:
+        comids = ds["rivid"][:].values
+        dates = pd.to_datetime(ds["time"][:].values)
+        mean_flows = ds["Qout"][:].values.round(1)
+
+    mean_flow_df = pd.DataFrame(mean_flows, columns=comids, index=dates)
+    mean_flow_df = mean_flow_df[mean_flow_df.index <= mean_flow_df.index[0] + pd.Timedelta(days=10)]
+
+    rp_path = os.path.join(return_periods_dir, f"returnperiods_{vpu}.nc")
+    with nc.Dataset(rp_path, "r") as rp_ncfile:
+        rp_df = pd.DataFrame(
+            {
+                "return_2": rp_ncfile.variables["rp2"][:],
+                "return_5": rp_ncfile.variables["rp5"][:],
+                "return_10": rp_ncfile.variables["rp10"][:],
+                "return_25": rp_ncfile.variables["rp25"][:],
+                "return_50": rp_ncfile.variables["rp50"][:],
+                "return_100": rp_ncfile.variables["rp100"][:],
+            },
+            index=rp_ncfile.variables["rivid"][:],
+        )
+
+    mean_thickness_df = pd.DataFrame(columns=comids, index=dates, dtype=int)
+    mean_thickness_df[:] = 1
+    mean_thickness_df[mean_flow_df >= 20] = 2
+    mean_thickness_df[mean_flow_df >= 250] = 3
+    mean_thickness_df[mean_flow_df >= 1500] = 4
+    mean_thickness_df[mean_flow_df >= 10000] = 5
+    mean_thickness_df[mean_flow_df >= 30000] = 6
+
+    mean_ret_per_df = pd.DataFrame(columns=comids, index=dates, dtype=int)
+    mean_ret_per_df[:] = 0
+    mean_ret_per_df[mean_flow_df.gt(rp_df["return_2"], axis=1)] = 2
+    mean_ret_per_df[mean_flow_df.gt(rp_df["return_5"], axis=1)] = 5
+    mean_ret_per_df[mean_flow_df.gt(rp_df["return_10"], axis=1)] = 10
+    mean_ret_per_df[mean_flow_df.gt(rp_df["return_25"], axis=1)] = 25
+    mean_ret_per_df[mean_flow_df.gt(rp_df["return_50"], axis=1)] = 50
+    mean_ret_per_df[mean_flow_df.gt(rp_df["return_100"], axis=1)] = 100
+
+    mean_flow_df = mean_flow_df.stack().to_frame().rename(columns={0: "mean"})
+    mean_thickness_df = mean_thickness_df.stack().to_frame().rename(columns={0: "thickness"})
+    mean_ret_per_df = mean_ret_per_df.stack().to_frame().rename(columns={0: "ret_per"})
+
+    for df in [mean_thickness_df, mean_ret_per_df]:
+        mean_flow_df = mean_flow_df.merge(df, left_index=True, right_index=True)
+
+    mean_flow_df.index.names = ["timestamp", "comid"]
+    mean_flow_df = mean_flow_df.reset_index()
+    mean_flow_df["mean"] = mean_flow_df["mean"].round(1)
+    mean_flow_df.loc[mean_flow_df["mean"] < 0, "mean"] = 0
+    mean_flow_df["thickness"] = mean_flow_df["thickness"].astype(int)
+    mean_flow_df["ret_per"] = mean_flow_df["ret_per"].astype(int)
+    mean_flow_df.to_parquet(output_path)
+
+
+def _measure(func, *args, **kwargs) -> tuple:
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reaches', type=int, default=20_000, help='Number of river reaches in the synthetic VPU')
+    parser.add_argument('--timesteps', type=int, default=85, help='Number of forecast timesteps')
+    parser.add_argument('--blocksize', type=int, default=None,
+                        help='Also run the streaming mode in blocks of this many reaches')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workspace:
+        os.environ.setdefault('CONFIGS_DIR', os.path.join(workspace, 'configs'))
+        os.environ.setdefault('RUNOFFS_DIR', os.path.join(workspace, 'runoffs'))
+        os.environ.setdefault('INITS_DIR', os.path.join(workspace, 'inits'))
+        os.environ['FORECASTS_DIR'] = os.path.join(workspace, 'forecasts')
+        os.environ['RETURN_PERIODS_DIR'] = os.path.join(workspace, 'returnperiods')
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
+        import generate_vpu_map_tables
+
+        print(f'Creating synthetic VPU with {args.reaches} reaches and {args.timesteps} timesteps')
+        make_synthetic_vpu(workspace, args.reaches, args.timesteps)
+
+        new_table = os.path.join(workspace, 'forecasts', YMD, 'maptables', f'mapstyletable_{VPU}_{YMD}.parquet')
+        old_table = os.path.join(workspace, 'legacy.parquet')
+
+        old_time, old_peak = _measure(
+            legacy_postprocess_vpu_forecast_directory, YMD, VPU, os.environ['FORECASTS_DIR'],
+            os.environ['RETURN_PERIODS_DIR'], old_table
+        )
+        new_time, new_peak = _measure(generate_vpu_map_tables.postprocess_vpu_forecast_directory, YMD, VPU)
+
+        print(f'{"implementation":<15}{"seconds":>10}{"peak MB":>12}')
+        print(f'{"pandas":<15}{old_time:>10.2f}{old_peak / 1e6:>12.1f}')
+        print(f'{"numpy":<15}{new_time:>10.2f}{new_peak / 1e6:>12.1f}')
+        print(f'speedup: {old_time / new_time:.1f}x, peak memory ratio: {old_peak / new_peak:.1f}x')
+        print(f'byte identical parquet: {filecmp.cmp(old_table, new_table, shallow=False)}')
+
+        if args.blocksize:
+            whole_vpu_table = pd.read_parquet(new_table)
+            os.remove(new_table)
+            block_time, block_peak = _measure(generate_vpu_map_tables.postprocess_vpu_forecast_directory, YMD, VPU,
+                                              block_size=args.blocksize)
+            print(f'{f"blocks of {args.blocksize}":<15}{block_time:>10.2f}{block_peak / 1e6:>12.1f}')
+            # blocks are written one after the other, sorting by timestamp restores the time major order
+            block_table = pd.read_parquet(new_table).sort_values('timestamp', kind='stable', ignore_index=True)
+            print(f'streamed rows identical: {block_table.equals(whole_vpu_table)}')
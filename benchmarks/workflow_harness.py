@@ -0,0 +1,183 @@
+"""
+Run the forecast workflow end to end on synthetic days of several sizes and report the time of every stage
+
+For each scale a synthetic day is generated with synthetic_day.py, then suites/workflow.sh is run on it with
+fake_rapid.py in place of the RAPID container. Archiving to S3 is skipped unless an S3 endpoint, e.g. of a moto or
+MinIO server with the S3_BUCKET_* buckets, is given. The time of a stage is from the first start to the last end of
+the stage metrics its scripts record. With --scheduler the day is run with python/scheduler.py instead.
+
+Example:
+    python benchmarks/workflow_harness.py --scales 10000 100000 1000000 --workspace /tmp/harness --report harness.json
+"""
+import argparse
+import datetime
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from synthetic_day import YMD, generate_day, workspace_paths
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARKS_DIR)
+SCRIPTS_DIR = os.path.join(REPOSITORY_DIR, 'python')
+WORKFLOW_SCRIPT = os.path.join(REPOSITORY_DIR, 'suites', 'workflow.sh')
+FAKE_RAPID = os.path.join(BENCHMARKS_DIR, 'fake_rapid.py')
+
+sys.path.insert(0, SCRIPTS_DIR)
+
+
+def _script(name: str, *args) -> list:
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name), *args]
+
+
+def workflow_env(env: dict, workers: int, memory_budget: float = None, subbasins: int = None,
+                 s3_endpoint: str = None) -> dict:
+    """
+    The environment suites/workflow.sh is run with: the synthetic day, this python first on the PATH, and fake_rapid.py
+    as the RAPID executable
+    """
+    run_env = {
+        **os.environ,
+        **env,
+        'PATH': os.path.dirname(sys.executable) + os.pathsep + os.environ.get('PATH', ''),
+        'RAPID_COMMAND': shlex.join(_script('runrapid.py', '--rapidexec', FAKE_RAPID)),
+        'ARCHIVE_COMMAND': shlex.join(_script('archive_to_s3.py')) if s3_endpoint else '',
+        'WORKFLOW_WORKERS': str(workers),
+        # clean_forecast_directory.sh deletes the old directories of FORECAST_DIR, or of its working directory
+        'FORECAST_DIR': env['FORECASTS_DIR'],
+    }
+    if s3_endpoint:
+        run_env['S3_ENDPOINT_URL'] = s3_endpoint
+    if memory_budget is not None:
+        run_env['MEMORY_BUDGET_MB'] = str(memory_budget)
+    if subbasins:
+        run_env['RAPID_SUBBASINS'] = str(subbasins)
+    return run_env
+
+
+def stage_spans(records: list) -> dict:
+    """
+    Seconds from the first start to the last end of the metrics records of each stage, in the order the stages started
+    """
+    spans = {}
+    for record in records:
+        start = datetime.datetime.fromisoformat(record['start']).timestamp()
+        first, last = spans.get(record['stage'], (start, start))
+        spans[record['stage']] = (min(first, start), max(last, start + record['wall_seconds']))
+    return {stage: round(last - first, 3) for stage, (first, last) in sorted(spans.items(), key=lambda x: x[1][0])}
+
+
+def _run(command: list, env: dict, log_path: str, cwd: str = None) -> int:
+    with open(log_path, 'a') as log:
+        return subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+
+
+def run_workflow(env: dict, workers: int, use_scheduler: bool = False, memory_budget: float = None,
+                 subbasins: int = None, s3_endpoint: str = None) -> dict:
+    """
+    Runs one forecast day and returns the wall seconds of each stage, the stage it failed at if it failed, and the
+    totals of the stage metrics
+    """
+    # instrumentation requires FORECASTS_DIR when it is imported, the metrics are read from the log_dir of the day
+    os.environ.setdefault('FORECASTS_DIR', env['FORECASTS_DIR'])
+    from instrumentation import aggregate, read_metrics
+
+    forecast_dir = os.path.join(env['FORECASTS_DIR'], YMD)
+    shutil.rmtree(forecast_dir, ignore_errors=True)
+    os.makedirs(os.path.join(forecast_dir, 'logs'), exist_ok=True)
+    log_path = os.path.join(forecast_dir, 'logs', 'harness.log')
+    run_env = workflow_env(env, workers, memory_budget, subbasins, s3_endpoint)
+
+    if use_scheduler:
+        memory_args = [] if memory_budget is None else ['--memory', str(memory_budget)]
+        command = _script('scheduler.py', '--ymd', YMD, '--workers', str(workers), '--rapidcommand',
+                          run_env['RAPID_COMMAND'], *memory_args)
+    else:
+        command = ['bash', WORKFLOW_SCRIPT, '--ymd', YMD]
+    returncode = _run(command, run_env, log_path, cwd=os.path.dirname(env['FORECASTS_DIR']))
+
+    records = read_metrics(log_dir=os.path.join(forecast_dir, 'logs'))
+    failed = None
+    if returncode:
+        failed_stages = [x['stage'] for x in records if x['status'] != 'succeeded']
+        failed = failed_stages[-1] if failed_stages else 'scheduler' if use_scheduler else 'workflow'
+    return {
+        'stages': stage_spans(records),
+        'failed': failed,
+        # the measurements each script records with instrumentation.stage
+        'metrics': {stage: totals for (stage, ), totals in aggregate(records, by=('stage', )).items()},
+    }
+
+
+def run_scale(workspace: str, n_reaches: int, n_vpus: int, n_members: int, grid_shape: tuple, workers: int,
+              use_scheduler: bool = False, reuse: bool = False, memory_budget: float = None, subbasins: int = None,
+              s3_endpoint: str = None) -> dict:
+    root = os.path.join(workspace, f'reaches_{n_reaches}')
+    t0 = time.perf_counter()
+    if reuse and os.path.exists(os.path.join(root, 'configs')):
+        env = workspace_paths(root)
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+        env = generate_day(root, n_reaches, n_vpus, n_members, grid_shape)
+    generate_seconds = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    result = run_workflow(env, workers, use_scheduler, memory_budget, subbasins, s3_endpoint)
+    result.update({
+        'reaches': n_reaches,
+        'vpus': n_vpus,
+        'members': n_members,
+        'generate_seconds': round(generate_seconds, 3),
+        'total_seconds': round(time.perf_counter() - t0, 3),
+    })
+    return result
+
+
+def print_report(results: list) -> None:
+    stages = list(dict.fromkeys(stage for result in results for stage in result['stages']))
+    print(f'{"stage":<18}' + ''.join(f'{result["reaches"]:>14,}' for result in results))
+    for stage in stages:
+        print(f'{stage:<18}' + ''.join(f'{result["stages"].get(stage, float("nan")):>14.1f}' for result in results))
+    print(f'{"total":<18}' + ''.join(f'{result["total_seconds"]:>14.1f}' for result in results))
+    for result in results:
+        if result['failed']:
+            print(f'{result["reaches"]} reaches failed at stage {result["failed"]}, see the logs of the day')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[10_000, 100_000],
+                        help='Total numbers of reaches to run the workflow at')
+    parser.add_argument('--vpus', type=int, default=8, help='Number of VPUs the reaches are split into')
+    parser.add_argument('--members', type=int, default=51, help='Number of ensemble members besides 52')
+    parser.add_argument('--grid', type=str, default='181x360', help='Runoff grid shape as LATxLON')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of commands run at once')
+    parser.add_argument('--workspace', type=str, required=True, help='Directory for the synthetic days')
+    parser.add_argument('--reuse', action='store_true', default=False,
+                        help='Reuse synthetic days already in the workspace instead of generating them again')
+    parser.add_argument('--scheduler', action='store_true', default=False,
+                        help='Run each day with python/scheduler.py instead of the workflow.sh stage order')
+    parser.add_argument('--memory', type=float, default=None,
+                        help='Memory budget in MB of the tasks run at once, as MEMORY_BUDGET_MB, 0 for no limit')
+    parser.add_argument('--subbasins', type=int, default=None,
+                        help='Route each VPU as up to this many RAPID runs of groups of independent subnetworks, as '
+                             'RAPID_SUBBASINS')
+    parser.add_argument('--s3endpoint', type=str, default=None,
+                        help='Archive the days to the S3_BUCKET_* buckets of this S3 endpoint, e.g. a moto server')
+    parser.add_argument('--report', type=str, default=None, help='Path to save the results as JSON')
+    args = parser.parse_args()
+
+    harness_results = []
+    for scale in args.scales:
+        print(f'Running {scale:,} reaches', flush=True)
+        harness_results.append(run_scale(args.workspace, scale, args.vpus, args.members,
+                                         tuple(int(x) for x in args.grid.split('x')), args.workers, args.scheduler,
+                                         args.reuse, args.memory, args.subbasins, args.s3endpoint))
+    print_report(harness_results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(harness_results, f, indent=2)
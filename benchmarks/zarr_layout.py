@@ -0,0 +1,259 @@
+"""
+Benchmark chunk shapes and codecs of the forecast zarr written by vpu_netcdfs_to_zarr.py for the ways it is read
+
+Writes a synthetic Qout (ensemble, time, rivid) store for every combination of chunk shape, codec and shard size,
+then measures the write time, store size, number of objects, and the latency of reading one reach, a random batch of
+reaches, and every reach of one timestep. Chunk shapes are ensemble,time,rivid sizes where 'all' is the whole
+dimension, or 'auto' for the chunks vpu_netcdfs_to_zarr.py writes. Shard sizes are numbers of rivid chunks packed into
+each object of a zarr v3 store, as in the sharded layout of vpu_netcdfs_to_zarr.py, or 'none' for a zarr v2 store with
+one object per chunk. With --endpoint and --bucket each store is also uploaded with archive_to_s3.py and timed.
+
+Example:
+    python benchmarks/zarr_layout.py --reaches 50000 --chunks auto all,all,5000 all,1,50000 --codecs zstd-bitshuffle lz4
+    python benchmarks/zarr_layout.py --chunks auto --codecs zstd-bitshuffle --shards none 16 64 \\
+        --endpoint http://localhost:9000 --bucket benchmark
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import zarr
+from numcodecs import Blosc, Zstd
+from zarr.codecs import BloscCodec, ZstdCodec
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python')
+
+CODECS = {
+    'zstd-bitshuffle': Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE),
+    'zstd5-bitshuffle': Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE),
+    'lz4': Blosc(cname='lz4', clevel=5, shuffle=Blosc.SHUFFLE),
+    'zstd': Zstd(level=3),
+    'none': None,
+}
+# the same codecs for zarr v3 stores
+V3_CODECS = {
+    'zstd-bitshuffle': BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle'),
+    'zstd5-bitshuffle': BloscCodec(cname='zstd', clevel=5, shuffle='bitshuffle'),
+    'lz4': BloscCodec(cname='lz4', clevel=5, shuffle='shuffle'),
+    'zstd': ZstdCodec(level=3),
+    'none': None,
+}
+DEFAULT_CHUNKS = ('auto', 'all,all,2000', 'all,all,20000', '1,all,20000', 'all,8,20000')
+DEFAULT_CODECS = ('zstd-bitshuffle', 'lz4', 'zstd', 'none')
+DEFAULT_SHARDS = ('none', )
+# target size of an uncompressed chunk in vpu_netcdfs_to_zarr.py
+AUTO_CHUNK_BYTES = 5e6
+# fraction of reaches without flow, e.g. in deserts
+DRY_FRACTION = 0.2
+
+
+def parse_chunks(spec: str, shape: tuple) -> tuple:
+    if spec == 'auto':
+        return shape[0], shape[1], int(min(max(AUTO_CHUNK_BYTES // (4 * shape[0] * shape[1]), 1), shape[2]))
+    return tuple(dim if size == 'all' else min(int(size), dim) for size, dim in zip(spec.split(','), shape))
+
+
+def synthetic_block(rivid_start: int, rivid_end: int, n_ensembles: int, n_timesteps: int, seed: int) -> np.ndarray:
+    """
+    Discharge which is smooth in time, similar between ensemble members, spans orders of magnitude between reaches
+    and is zero in dry reaches, so that it compresses like real forecasts
+    """
+    rng = np.random.default_rng([seed, rivid_start])
+    n_reaches = rivid_end - rivid_start
+    base = rng.lognormal(mean=2, sigma=2.5, size=n_reaches)
+    base[rng.random(n_reaches) < DRY_FRACTION] = 0
+    phase = rng.random(n_reaches) * 2 * np.pi
+    hours = np.arange(n_timesteps)[:, None] * 3
+    hydrograph = 1 + 0.5 * np.sin(hours / 48 + phase)
+    spread = 1 + 0.1 * rng.standard_normal(size=(n_ensembles, 1, n_reaches)).cumsum(axis=0) / n_ensembles
+    return (base * hydrograph * spread).astype(np.float32)
+
+
+def _store_stats(path: str) -> tuple:
+    size = objects = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            if not file.startswith('.z') and file != 'zarr.json':
+                objects += 1
+                size += os.path.getsize(os.path.join(root, file))
+    return size, objects
+
+
+def write_store(path: str, shape: tuple, chunks: tuple, codec_name: str, seed: int, shard_chunks: int = None) -> float:
+    if shard_chunks:
+        codec = V3_CODECS[codec_name]
+        shards = (chunks[0], chunks[1], chunks[2] * shard_chunks)
+        qout = zarr.create_array(store=path, name='Qout', shape=shape, chunks=chunks, shards=shards, dtype='float32',
+                                 compressors=(codec,) if codec is not None else None, fill_value=np.nan,
+                                 zarr_format=3, overwrite=True)
+    else:
+        codec = CODECS[codec_name]
+        qout = zarr.create_array(store=path, name='Qout', shape=shape, chunks=chunks, dtype='float32',
+                                 compressors=(codec,) if codec is not None else None, fill_value=np.nan,
+                                 zarr_format=2, overwrite=True)
+    # blocks of whole rivid chunks or shards of about 256 MB so memory does not grow with the number of reaches
+    write_size = chunks[2] * (shard_chunks or 1)
+    block = max(write_size, (int(256e6 // (4 * shape[0] * shape[1])) // write_size) * write_size)
+    elapsed = 0
+    for start in range(0, shape[2], block):
+        end = min(start + block, shape[2])
+        values = synthetic_block(start, end, shape[0], shape[1], seed)
+        t0 = time.perf_counter()
+        qout[:, :, start:end] = values
+        elapsed += time.perf_counter() - t0
+    return elapsed
+
+
+def _latencies(func, trials: int) -> dict:
+    latencies = []
+    for _ in range(trials):
+        t0 = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    latencies.sort()
+    return {
+        'median_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)], 2),
+    }
+
+
+def measure_reads(path: str, trials: int, batch_size: int, seed: int) -> dict:
+    """
+    Times the three access patterns, opening the array again for every read as a new request would
+    """
+    rng = np.random.default_rng(seed)
+    shape = zarr.open_array(store=path, path='Qout', mode='r').shape
+
+    def _single_reach():
+        zarr.open_array(store=path, path='Qout', mode='r')[:, :, int(rng.integers(shape[2]))]
+
+    def _reach_batch():
+        rivids = np.sort(rng.choice(shape[2], size=min(batch_size, shape[2]), replace=False))
+        zarr.open_array(store=path, path='Qout', mode='r').get_orthogonal_selection((slice(None), slice(None), rivids))
+
+    def _timestep():
+        zarr.open_array(store=path, path='Qout', mode='r')[:, int(rng.integers(shape[1])), :]
+
+    reads = {
+        'single_reach': _latencies(_single_reach, trials),
+        'reach_batch': _latencies(_reach_batch, trials),
+        'timestep': _latencies(_timestep, max(trials // 10, 3)),
+    }
+    reads['reach_batch']['reaches_per_second'] = round(batch_size / reads['reach_batch']['median_ms'] * 1000)
+    timestep_mb = shape[0] * shape[2] * 4 / 1e6
+    reads['timestep']['mb_per_second'] = round(timestep_mb / reads['timestep']['median_ms'] * 1000, 1)
+    return reads
+
+
+def upload_store(path: str, endpoint: str, bucket: str, concurrency: int) -> float:
+    """
+    Uploads a store with the archiver of the workflow and returns the seconds it took
+    """
+    # the archiver requires the directories of a forecast environment, which the upload of one store does not use
+    os.environ.setdefault('FORECASTS_DIR', os.path.dirname(os.path.abspath(path)))
+    os.environ.setdefault('INITS_DIR', os.path.dirname(os.path.abspath(path)))
+    sys.path.insert(0, SCRIPTS_DIR)
+    from archive_to_s3 import S3Archiver, s3_client
+
+    archiver = S3Archiver(s3_client(concurrency, endpoint), concurrency)
+    t0 = time.perf_counter()
+    archiver.sync([('zarr', path, '**/*', bucket, f'{os.path.basename(path)}/')])
+    if archiver.totals['failed']:
+        raise RuntimeError(f'Failed to upload {archiver.totals["failed"]} objects of {path}')
+    return time.perf_counter() - t0
+
+
+def run_matrix(workspace: str, shape: tuple, chunk_specs: list, codec_names: list, trials: int, batch_size: int,
+               seed: int = 0, keep: bool = False, shard_specs: list = DEFAULT_SHARDS, endpoint: str = None,
+               bucket: str = None, concurrency: int = 32) -> list:
+    results = []
+    for chunk_spec in chunk_specs:
+        chunks = parse_chunks(chunk_spec, shape)
+        for codec_name in codec_names:
+            for shard_spec in shard_specs:
+                shard_chunks = None if shard_spec == 'none' else int(shard_spec)
+                path = os.path.join(workspace, f'{chunk_spec.replace(",", "_")}_{codec_name}_{shard_spec}.zarr')
+                write_seconds = write_store(path, shape, chunks, codec_name, seed, shard_chunks)
+                size, objects = _store_stats(path)
+                result = {
+                    'chunks': chunk_spec,
+                    'chunk_shape': list(chunks),
+                    'codec': codec_name,
+                    'shards': shard_spec,
+                    'write_seconds': round(write_seconds, 3),
+                    'size_mb': round(size / 1e6, 2),
+                    'compression_ratio': round(np.prod(shape) * 4 / size, 2),
+                    'objects': objects,
+                    'upload_seconds': round(upload_store(path, endpoint, bucket, concurrency), 3) if bucket else None,
+                    'reads': measure_reads(path, trials, batch_size, seed),
+                }
+                results.append(result)
+                print_row(result)
+                if not keep:
+                    shutil.rmtree(path)
+    return results
+
+
+def print_header() -> None:
+    print(f'{"chunks":<14}{"chunk shape":<18}{"codec":<17}{"shards":>7}{"write s":>8}{"MB":>9}{"ratio":>7}'
+          f'{"objects":>9}{"upload s":>9}{"reach ms":>10}{"batch ms":>10}{"step ms":>10}')
+
+
+def print_row(result: dict) -> None:
+    reads = result['reads']
+    upload = '-' if result['upload_seconds'] is None else f'{result["upload_seconds"]:.2f}'
+    print(f'{result["chunks"]:<14}{"x".join(str(x) for x in result["chunk_shape"]):<18}{result["codec"]:<17}'
+          f'{result["shards"]:>7}{result["write_seconds"]:>8.2f}{result["size_mb"]:>9.1f}'
+          f'{result["compression_ratio"]:>7.1f}{result["objects"]:>9}{upload:>9}'
+          f'{reads["single_reach"]["median_ms"]:>10.2f}{reads["reach_batch"]["median_ms"]:>10.2f}'
+          f'{reads["timestep"]["median_ms"]:>10.2f}', flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reaches', type=int, default=50_000, help='Number of river reaches in the synthetic store')
+    parser.add_argument('--timesteps', type=int, default=145, help='Number of forecast timesteps')
+    parser.add_argument('--ensembles', type=int, default=52, help='Number of ensemble members')
+    parser.add_argument('--chunks', nargs='+', default=DEFAULT_CHUNKS,
+                        help='Chunk shapes as ensemble,time,rivid sizes (all for the whole dimension) or auto')
+    parser.add_argument('--codecs', nargs='+', default=DEFAULT_CODECS, choices=sorted(CODECS),
+                        help='Codecs to compare')
+    parser.add_argument('--shards', nargs='+', default=DEFAULT_SHARDS,
+                        help='Numbers of rivid chunks in each shard of a zarr v3 store, or none for zarr v2')
+    parser.add_argument('--endpoint', type=str, default=None,
+                        help='S3 endpoint URL to upload the stores to, e.g. of a MinIO or moto server')
+    parser.add_argument('--bucket', type=str, default=None, help='Bucket to upload the stores to and time')
+    parser.add_argument('--concurrency', type=int, default=32, help='Number of objects uploaded at once')
+    parser.add_argument('--trials', type=int, default=50, help='Number of reads of each access pattern')
+    parser.add_argument('--batch', type=int, default=100, help='Number of random reaches read in a batch')
+    parser.add_argument('--workspace', type=str, default=None,
+                        help='Directory for the stores, e.g. on the disk used in production. Defaults to a temp dir')
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help='Keep the stores in the workspace after measuring them')
+    parser.add_argument('--report', type=str, default=None, help='Path to save the results as JSON')
+    args = parser.parse_args()
+
+    store_shape = (args.ensembles, args.timesteps, args.reaches)
+    print(f'Qout shape (ensemble, time, rivid): {store_shape}, {np.prod(store_shape) * 4 / 1e6:.0f} MB uncompressed')
+    print_header()
+    if args.workspace:
+        os.makedirs(args.workspace, exist_ok=True)
+    if args.keep and args.workspace:
+        matrix = run_matrix(args.workspace, store_shape, args.chunks, args.codecs, args.trials, args.batch, keep=True,
+                            shard_specs=args.shards, endpoint=args.endpoint, bucket=args.bucket,
+                            concurrency=args.concurrency)
+    else:
+        with tempfile.TemporaryDirectory(dir=args.workspace) as tmp_dir:
+            matrix = run_matrix(tmp_dir, store_shape, args.chunks, args.codecs, args.trials, args.batch,
+                                shard_specs=args.shards, endpoint=args.endpoint, bucket=args.bucket,
+                                concurrency=args.concurrency)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'shape': store_shape, 'batch': args.batch, 'trials': args.trials, 'results': matrix}, f,
+                      indent=2)
@@ -0,0 +1,282 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from s3transfer.utils import ChunksizeAdjuster
+
+from instrumentation import stage
+
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
+INITS_DIR = os.environ['INITS_DIR']
+# a MinIO or moto server to archive to instead of AWS, e.g. http://localhost:9000
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+
+DEFAULT_CONCURRENCY = 32
+# files larger than this are uploaded in parts of MULTIPART_CHUNKSIZE, which is also used to compute their ETags
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+# zarr metadata is uploaded after every chunk so readers never see a store whose chunks are still missing
+ZARR_METADATA_FILES = ('.zmetadata', '.zgroup', '.zarray', '.zattrs', 'zarr.json')
+
+
+def archive_targets(ymd: str, names: list = None) -> list:
+    """
+    The directories archived after a forecast day as (name, local directory, glob pattern, bucket, key prefix)
+
+    The forecast zarr goes to S3_BUCKET_FORECAST_ARCHIVE/{ymd}.zarr, the global map table CSVs to the root of
+    S3_BUCKET_ESRI_MAP_TABLES, their columnar copies and deltas, if written, to S3_BUCKET_ESRI_MAP_TABLES/columnar, and
+    the inits for the next day to S3_BUCKET_INIT_ARCHIVE/{init date}.
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        names (list): Names of the targets to archive. Defaults to all of them
+
+    Returns:
+        list: The targets
+    """
+    init_date = (datetime.datetime.strptime(ymd, '%Y%m%d') + datetime.timedelta(days=1)).strftime('%Y%m%d')
+    targets = [
+        ('zarr', os.path.join(FORECASTS_DIR, ymd, 'outputs', f'{ymd}.zarr'), '**/*',
+         'S3_BUCKET_FORECAST_ARCHIVE', f'{ymd}.zarr/'),
+        ('maptables', os.path.join(FORECASTS_DIR, ymd, 'maptables'), 'map*.csv', 'S3_BUCKET_ESRI_MAP_TABLES', ''),
+        ('columnar', os.path.join(FORECASTS_DIR, ymd, 'maptables', 'columnar'), 'mapstyle*',
+         'S3_BUCKET_ESRI_MAP_TABLES', 'columnar/'),
+        ('inits', os.path.join(INITS_DIR, init_date), '*', 'S3_BUCKET_INIT_ARCHIVE', f'{init_date}/'),
+    ]
+    return [
+        (name, local_dir, pattern, os.environ[bucket_variable], prefix)
+        for name, local_dir, pattern, bucket_variable, prefix in targets if names is None or name in names
+    ]
+
+
+def s3_client(concurrency: int = DEFAULT_CONCURRENCY, endpoint_url: str = S3_ENDPOINT_URL):
+    """
+    Creates one client shared by every upload thread with a connection pool large enough for all of them
+    """
+    config = Config(max_pool_connections=concurrency * 2, retries={'max_attempts': 10, 'mode': 'adaptive'})
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def local_etag(path: str, threshold: int = MULTIPART_THRESHOLD, chunksize: int = MULTIPART_CHUNKSIZE) -> str:
+    """
+    Computes the ETag S3 gives a file uploaded with the same multipart threshold and part size
+
+    The ETag is the MD5 of the file, or for a multipart upload the MD5 of the part MD5s followed by the number of parts
+    """
+    size = os.path.getsize(path)
+    if size < threshold:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        return f'"{md5.hexdigest()}"'
+    # the part size is adjusted the same way the uploader adjusts it to the S3 part size and count limits
+    chunksize = ChunksizeAdjuster().adjust_chunksize(chunksize, size)
+    with open(path, 'rb') as f:
+        part_digests = [hashlib.md5(block).digest() for block in iter(lambda: f.read(chunksize), b'')]
+    return f'"{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}"'
+
+
+class S3Archiver:
+    """
+    Uploads directories to S3 from a pool of threads sharing one client, skipping files already uploaded
+
+    The objects under each target prefix are listed once and a file is skipped when an object with the same key has
+    the same size and ETag, so rerunning the archiver after a failure only uploads what is missing or changed.
+    Files this archiver uploaded are remembered by size and mtime so repeated passes do not hash them again.
+
+    Args:
+        client: boto3 S3 client, e.g. from s3_client
+        concurrency (int): Number of files uploaded at once
+        multipart_threshold (int): Files at least this large are uploaded in parts
+        multipart_chunksize (int): Size of each part of a multipart upload
+    """
+
+    def __init__(self, client, concurrency: int = DEFAULT_CONCURRENCY, multipart_threshold: int = MULTIPART_THRESHOLD,
+                 multipart_chunksize: int = MULTIPART_CHUNKSIZE):
+        self.client = client
+        self.concurrency = concurrency
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        # each file already runs in its own pool thread, so parts of one file only use a few more threads
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize, max_concurrency=4)
+        self._remote = {}
+        self._uploaded = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self.totals = {'uploaded': 0, 'skipped': 0, 'failed': 0, 'uploaded_bytes': 0}
+
+    def _remote_objects(self, bucket: str, prefix: str) -> dict:
+        if (bucket, prefix) not in self._remote:
+            objects = {}
+            for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    objects[obj['Key']] = (obj['Size'], obj['ETag'])
+            self._remote[(bucket, prefix)] = objects
+        return self._remote[(bucket, prefix)]
+
+    def _is_archived(self, path: str, bucket: str, key: str, prefix: str) -> bool:
+        stat = os.stat(path)
+        if self._uploaded.get((bucket, key)) == (stat.st_size, stat.st_mtime_ns):
+            return True
+        remote = self._remote_objects(bucket, prefix).get(key)
+        if remote is None or remote[0] != stat.st_size:
+            return False
+        if remote[1] == local_etag(path, self.multipart_threshold, self.multipart_chunksize):
+            self._uploaded[(bucket, key)] = (stat.st_size, stat.st_mtime_ns)
+            self.totals['skipped'] += 1
+            return True
+        return False
+
+    def _upload(self, path: str, bucket: str, key: str) -> None:
+        stat = os.stat(path)
+        try:
+            self.client.upload_file(path, bucket, key, Config=self.transfer_config)
+        except Exception as e:
+            logging.error(f'Failed to upload {path} to s3://{bucket}/{key}: {e}')
+            with self._lock:
+                self._failed.add((bucket, key))
+                self.totals['failed'] = len(self._failed)
+            return
+        with self._lock:
+            # a file which failed in an earlier pass and uploads in a later one is no longer a failure
+            self._failed.discard((bucket, key))
+            self.totals['failed'] = len(self._failed)
+            self._uploaded[(bucket, key)] = (stat.st_size, stat.st_mtime_ns)
+            self.totals['uploaded'] += 1
+            self.totals['uploaded_bytes'] += stat.st_size
+
+    def pending_files(self, targets: list, settle_seconds: float = 0, include_metadata: bool = True) -> tuple:
+        """
+        Lists the files of the targets which are not archived yet, split into data files and zarr metadata files
+
+        Args:
+            targets (list): Targets from archive_targets
+            settle_seconds (float): Leave out files modified more recently than this, which may still be written
+            include_metadata (bool): Include zarr metadata files
+
+        Returns:
+            tuple: Lists of (path, bucket, key) for the data files and the metadata files
+        """
+        data, metadata = [], []
+        now = time.time()
+        for _, local_dir, pattern, bucket, prefix in targets:
+            for path in sorted(glob.glob(os.path.join(local_dir, pattern), recursive=True, include_hidden=True)):
+                if not os.path.isfile(path) or now - os.path.getmtime(path) < settle_seconds:
+                    continue
+                is_metadata = os.path.basename(path) in ZARR_METADATA_FILES
+                if is_metadata and not include_metadata:
+                    continue
+                key = prefix + os.path.relpath(path, local_dir).replace(os.sep, '/')
+                if self._is_archived(path, bucket, key, prefix):
+                    continue
+                (metadata if is_metadata else data).append((path, bucket, key))
+        return data, metadata
+
+    def sync(self, targets: list, settle_seconds: float = 0, include_metadata: bool = True) -> int:
+        """
+        Uploads every file of the targets which is not archived yet, then the zarr metadata
+
+        Returns:
+            int: The number of files uploaded or attempted
+        """
+        data, metadata = self.pending_files(targets, settle_seconds, include_metadata)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for files in (data, metadata):
+                list(executor.map(lambda x: self._upload(*x), files))
+        return len(data) + len(metadata)
+
+    def watch(self, targets: list, until: str = None, interval: float = 30, settle_seconds: float = 10,
+              timeout: float = None) -> None:
+        """
+        Uploads files as the workflow produces them, then makes a final pass including the zarr metadata
+
+        Files are uploaded once they have not been modified for settle_seconds. Zarr chunks rewritten later, e.g. the
+        chunks shared by neighboring VPUs, no longer match their ETag and are uploaded again by a later pass. SIGTERM
+        stops watching without the final pass, e.g. when the workflow fails before the forecast is complete.
+
+        Args:
+            targets (list): Targets from archive_targets
+            until (str): Path of a file whose creation ends watching, e.g. the rivid index written last when the
+                forecast zarr is finalized
+            interval (float): Seconds between passes
+            settle_seconds (float): Seconds a file must be unmodified before it is uploaded while watching
+            timeout (float): Seconds after which watching ends even if the until file does not exist
+        """
+        start = time.time()
+        stop = threading.Event()
+        previous_handler = signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        try:
+            # an until file left by an earlier run of the day does not count, it has to be written again
+            while not (stop.is_set() or (until and os.path.exists(until) and os.path.getmtime(until) >= start) or
+                       (timeout is not None and time.time() - start > timeout)):
+                n_files = self.sync(targets, settle_seconds, include_metadata=False)
+                logging.info(f'Uploaded {n_files} files while watching')
+                stop.wait(interval)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+        if stop.is_set():
+            logging.warning('Stopped watching before the forecast was complete')
+            return
+        # the remote listings are refreshed so that the final pass compares against what is actually archived
+        self._remote.clear()
+        self.sync(targets)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ymd', type=str, required=True,
+                        help='Year, month, and day in YYYYMMDD format', )
+    parser.add_argument('--targets', type=str, nargs='+', required=False, default=None,
+                        choices=('zarr', 'maptables', 'columnar', 'inits'),
+                        help='What to archive. Defaults to the zarr, the map tables, the columnar map tables if '
+                             'written, and the inits', )
+    parser.add_argument('--concurrency', type=int, required=False, default=DEFAULT_CONCURRENCY,
+                        help='Number of files uploaded at once', )
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Upload files as they are produced until --until exists or --timeout passes', )
+    parser.add_argument('--until', type=str, required=False, default=None,
+                        help='File whose creation ends --watch. Defaults to the rivid index of the forecast zarr', )
+    parser.add_argument('--interval', type=float, required=False, default=30,
+                        help='Seconds between passes in --watch mode', )
+    parser.add_argument('--settle', type=float, required=False, default=10,
+                        help='Seconds a file must be unmodified before it is uploaded in --watch mode', )
+    parser.add_argument('--timeout', type=float, required=False, default=None,
+                        help='Seconds after which --watch makes its final pass and exits', )
+    parser.add_argument('--endpoint', type=str, required=False, default=S3_ENDPOINT_URL,
+                        help='S3 endpoint URL, e.g. of a MinIO or moto server. Defaults to S3_ENDPOINT_URL or AWS', )
+    args = parser.parse_args()
+
+    archive = archive_targets(args.ymd, args.targets)
+    archiver = S3Archiver(s3_client(args.concurrency, args.endpoint), args.concurrency)
+    with stage('archive', ymd=args.ymd) as archive_stage:
+        if args.watch:
+            # imported here, reach_query imports xarray and zarr which the archiver does not need otherwise
+            from reach_query import INDEX_SUFFIX
+
+            zarr_path = os.path.join(FORECASTS_DIR, args.ymd, 'outputs', f'{args.ymd}.zarr')
+            # written after the metadata of either zarr layout is consolidated
+            until_path = args.until or f'{zarr_path}{INDEX_SUFFIX}'
+            archiver.watch(archive, until_path, args.interval, args.settle, args.timeout)
+        else:
+            archiver.sync(archive)
+        archive_stage.add(**archiver.totals)
+        if archiver.totals['failed']:
+            archive_stage.status = 'failed'
+    logging.info(json.dumps(archiver.totals))
+    sys.exit(1 if archiver.totals['failed'] else 0)
@@ -1,30 +1,69 @@
 import argparse
 import datetime
+import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import netCDF4 as nc
-import pandas as pd
-import xarray as xr
+import numpy as np
+from natsort import natsorted
+
+from instrumentation import stage
+from stage_manifest import StageManifest
 
 FORECASTS_DIR = os.environ['FORECASTS_DIR']
 CONFIGS_DIR = os.environ['CONFIGS_DIR']
 RUNOFFS_DIR = os.environ['RUNOFFS_DIR']
 INITS_DIR = os.environ['INITS_DIR']
 
+# the inits of every VPU in one file next to the Qinit files, see write_init_archive
+INIT_ARCHIVE_NAME = 'Qinit_{init_date}.npz'
+
+
+def _init_date(ymd: str) -> datetime.datetime:
+    return datetime.datetime.strptime(ymd, '%Y%m%d') + datetime.timedelta(days=1)
+
+
+def _init_output_file(vpu: str or int, init_date_string: str) -> str:
+    return os.path.join(INITS_DIR, init_date_string, f'Qinit_{vpu}_{init_date_string}.nc')
 
-def init_file_from_forecast_averages(ymd: str, vpu: str or int) -> None:
-    init_date = pd.to_datetime(ymd) + pd.Timedelta(days=1)
+
+def read_init_flows(average_flow_file: str, init_date: datetime.datetime) -> tuple:
+    """
+    Reads the flows of one timestep of an ensemble average by its index, without reading the other timesteps
+
+    Returns:
+        tuple: The rivids and the flows at init_date
+    """
+    with nc.Dataset(average_flow_file) as ds:
+        # the exact timestep 24 hours after the ymd, a missing timestep raises a ValueError
+        time_index = nc.date2index(init_date, ds['time'], select='exact')
+        init_flows = np.ma.filled(ds['Qout'][time_index, :].astype(np.float64), np.nan)
+        rivids = np.asarray(ds['rivid'][:])
+    return rivids, init_flows
+
+
+def init_file_from_forecast_averages(ymd: str, vpu: str or int, manifest: StageManifest = None) -> None:
+    init_date = _init_date(ymd)
     init_date_string = init_date.strftime('%Y%m%d')
     average_flow_file = os.path.join(FORECASTS_DIR, ymd, 'outputs', f'nces_avg_{vpu}.nc')
-    init_output_file = os.path.join(INITS_DIR, init_date_string, f'Qinit_{vpu}_{init_date_string}.nc')
+    init_output_file = _init_output_file(vpu, init_date_string)
+    if manifest is not None and manifest.is_complete('inits', vpu, [average_flow_file]):
+        return
 
     os.makedirs(os.path.join(INITS_DIR, init_date_string), exist_ok=True)
+    rivids, init_flows = read_init_flows(average_flow_file, init_date)
+    write_init_file(init_output_file, init_date, rivids, init_flows)
+
+    if manifest is not None:
+        manifest.record('inits', vpu, [average_flow_file], [init_output_file])
 
-    with xr.open_dataset(average_flow_file) as ds:
-        # select the timestep 24 hours after the ymd variable
-        init_flows = ds.Qout.sel(time=init_date).values
-        rivids = ds.rivid.values
 
+def write_init_file(init_output_file: str, init_date: datetime.datetime, rivids: np.ndarray,
+                    init_flows: np.ndarray) -> None:
+    """
+    Writes the flows of a VPU as the NETCDF3 Qinit file RAPID reads
+    """
     with nc.Dataset(init_output_file, "w", format="NETCDF3_CLASSIC") as inflow_nc:
         # create dimensions
         inflow_nc.createDimension('time', 1)
@@ -83,6 +122,90 @@ def init_file_from_forecast_averages(ymd: str, vpu: str or int) -> None:
         inflow_nc.featureType = 'timeSeries'
 
 
+def write_init_archive(init_date_string: str, vpus: list) -> str:
+    """
+    Saves the inits of many VPUs in one compressed npz file next to their Qinit files
+
+    The rivids and flows of every VPU are concatenated in the order of vpus. The flows of vpus[i] are
+    qout[offsets[i]:offsets[i + 1]], read them with read_init_archive. The flows are saved as float32, the precision
+    of the ensemble averages they are taken from.
+
+    Args:
+        init_date_string (str): Init date in YYYYMMDD format
+        vpus (list): VPUs whose Qinit files are archived
+
+    Returns:
+        str: Path to the archive
+    """
+    rivids, flows = [], []
+    for vpu in vpus:
+        with nc.Dataset(_init_output_file(vpu, init_date_string)) as ds:
+            rivids.append(np.asarray(ds['rivid'][:]))
+            flows.append(np.asarray(ds['Qout'][0, :], dtype=np.float32))
+    archive_path = os.path.join(INITS_DIR, init_date_string, INIT_ARCHIVE_NAME.format(init_date=init_date_string))
+    tmp_path = f'{archive_path}.tmp.npz'
+    np.savez_compressed(
+        tmp_path,
+        vpus=np.array([str(x) for x in vpus]),
+        offsets=np.concatenate([[0], np.cumsum([x.shape[0] for x in rivids])]).astype(np.int64),
+        rivid=np.concatenate(rivids).astype(np.int32),
+        qout=np.concatenate(flows),
+    )
+    os.replace(tmp_path, archive_path)
+    return archive_path
+
+
+def read_init_archive(archive_path: str, vpu: str or int) -> tuple:
+    """
+    Reads the inits of one VPU from an archive written by write_init_archive
+
+    Returns:
+        tuple: The rivids and flows of the VPU
+    """
+    with np.load(archive_path) as archive:
+        position = list(archive['vpus']).index(str(vpu))
+        start, end = archive['offsets'][position:position + 2]
+        return archive['rivid'][start:end], archive['qout'][start:end]
+
+
+def calculate_vpu_inits(ymd: str, vpus: list = None, max_workers: int = None, manifest: StageManifest = None,
+                        archive: bool = False) -> list:
+    """
+    Writes the Qinit files of many VPUs from one process with a pool of workers
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        vpus (list): VPUs to write. Defaults to every VPU in CONFIGS_DIR with an ensemble average
+        max_workers (int): Number of VPUs written at once. Defaults to the number of CPUs
+        manifest (StageManifest): Stage manifest of the day. Skips VPUs which are complete and records the rest
+        archive (bool): Also save the inits of all the VPUs in one file with write_init_archive
+
+    Returns:
+        list: The VPUs which were written
+    """
+    outputs_dir = os.path.join(FORECASTS_DIR, ymd, 'outputs')
+    if vpus is None:
+        vpus = natsorted(os.path.basename(x) for x in glob.glob(os.path.join(CONFIGS_DIR, '*')) if os.path.isdir(x))
+        vpus = [x for x in vpus if os.path.exists(os.path.join(outputs_dir, f'nces_avg_{x}.nc'))]
+    average_flow_files = {vpu: [os.path.join(outputs_dir, f'nces_avg_{vpu}.nc')] for vpu in vpus}
+    remaining = manifest.remaining('inits', average_flow_files) if manifest is not None else list(vpus)
+
+    init_date_string = _init_date(ymd).strftime('%Y%m%d')
+    os.makedirs(os.path.join(INITS_DIR, init_date_string), exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for vpu, _ in zip(remaining, executor.map(init_file_from_forecast_averages, [ymd] * len(remaining), remaining)):
+            if manifest is not None:
+                manifest.record('inits', vpu, average_flow_files[vpu], [_init_output_file(vpu, init_date_string)])
+
+    if archive:
+        init_files = [_init_output_file(vpu, init_date_string) for vpu in vpus]
+        if manifest is None or remaining or not manifest.is_complete('initsarchive', init_date_string, init_files):
+            archive_path = write_init_archive(init_date_string, vpus)
+            if manifest is not None:
+                manifest.record('initsarchive', init_date_string, init_files, [archive_path])
+    return remaining
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -94,12 +217,34 @@ if __name__ == "__main__":
     parser.add_argument(
         '--vpu',
         type=str,
-        required=True,
-        help='VPU number',
+        required=False,
+        default=None,
+        help='VPU number. Defaults to every VPU with an ensemble average, written by a pool of workers',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        required=False,
+        default=None,
+        help='Number of VPUs written at once when writing every VPU. Defaults to the number of CPUs',
+    )
+    parser.add_argument(
+        '--archive',
+        action='store_true',
+        default=False,
+        help='Also save the inits of every VPU in one Qinit_{init date}.npz file when writing every VPU',
     )
     args = parser.parse_args()
 
     ymd = args.ymd
     vpu = args.vpu
 
-    init_file_from_forecast_averages(ymd=ymd, vpu=vpu)
+    init_date_string = _init_date(ymd).strftime('%Y%m%d')
+    if vpu:
+        with stage('inits', ymd=ymd, vpu=vpu,
+                   outputs=[os.path.join(INITS_DIR, init_date_string, f'Qinit_{vpu}_*.nc')]):
+            init_file_from_forecast_averages(ymd=ymd, vpu=vpu, manifest=StageManifest.for_day(ymd))
+    else:
+        with stage('inits', ymd=ymd, outputs=[os.path.join(INITS_DIR, init_date_string, 'Qinit_*')]):
+            calculate_vpu_inits(ymd=ymd, max_workers=args.workers, manifest=StageManifest.for_day(ymd),
+                                archive=args.archive)
@@ -1,44 +1,217 @@
+import argparse
+import datetime
 import glob
+import json
 import os
-import argparse
+import re
+import time
 
+import netCDF4 as nc
+import numpy as np
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--inflowsdir', type=str, required=False,
-                        default='/mnt/inflows',
-                        help='Path to directory containing subdirectories of inflow files', )
-    parser.add_argument('--outflowsdir', type=str, required=False,
-                        default='/mnt/outputs',
-                        help='Path to directory containing subdirectories of outflow files', )
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
 
-    args = parser.parse_args()
-    inflows_dir = args.inflowsdir
-    outflows_dir = args.outflowsdir
+# seconds of history used to calculate the current throughput
+THROUGHPUT_WINDOW = 600
 
-    outputdirs = sorted([d for d in glob.glob(os.path.join(outflows_dir, '*')) if os.path.isdir(d)])
 
-    num_output_dirs = len(outputdirs)
-    outputs_complete = 0
+def read_namelist(namelist_file: str) -> dict:
+    options = {}
+    with open(namelist_file) as f:
+        for line in f:
+            match = re.match(r"^\s*(\w+)\s*=\s*'?(.*?)'?\s*$", line)
+            if match:
+                options[match.group(1)] = match.group(2)
+    return options
 
-    for outputdir in outputdirs:
-        # identify the watershed being checked
-        watershed_id = os.path.basename(outputdir)
 
-        # look for files in the output directory
-        qout_file = glob.glob(os.path.join(outputdir, 'Qout*.nc'))
-        qout_size = sum([os.path.getsize(x) for x in qout_file])
+def new_state() -> dict:
+    return {'runs': {}, 'run_log_offset': 0, 'samples': []}
 
-        inflow_files = glob.glob(os.path.join(inflows_dir, watershed_id, '*.nc'))
-        inflow_size = sum([os.path.getsize(x) for x in inflow_files])
-        # calculate percent completed
-        pct_complete = (qout_size / inflow_size) * 100
 
-        if pct_complete >= 100:
-            outputs_complete += 1
-            print(f'{watershed_id}: COMPLETE {round(pct_complete, 1)}%')
-        else:
-            print(f'{watershed_id}: {round(pct_complete, 1)}%')
+def load_state(state_file: str) -> dict:
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+    return new_state()
+
+
+def save_state(state: dict, state_file: str) -> None:
+    if not state_file:
+        return
+    tmp_file = f'{state_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+
+def discover_runs(state: dict, namelists_dir: str) -> None:
+    """
+    Adds runs for namelists which are not tracked yet. Namelists are only parsed the first time they are seen.
+    """
+    for namelist_file in glob.glob(os.path.join(namelists_dir, 'namelist_*')):
+        if namelist_file in state['runs']:
+            continue
+        options = read_namelist(namelist_file)
+        time_step = float(options.get('ZS_TauR') or 0)
+        state['runs'][namelist_file] = {
+            'qout_file': options.get('Qout_file'),
+            'reaches': int(options.get('IS_riv_tot') or 0),
+            'timesteps': int(round(float(options.get('ZS_TauM') or 0) / time_step)) if time_step else 0,
+            'written': 0,
+            'complete': False,
+            'signature': None,
+        }
+
+
+def update_from_run_log(state: dict, run_log: str) -> None:
+    """
+    Marks runs finished by the runrapid.py worker, reading only the records appended since the last update
+    """
+    if not run_log or not os.path.exists(run_log):
+        return
+    with open(run_log) as f:
+        f.seek(state['run_log_offset'])
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            state['run_log_offset'] += len(line.encode())
+            record = json.loads(line)
+            run = state['runs'].get(record['namelist'])
+            if run is None:
+                continue
+            run['status'] = record['status']
+            if record['status'] == 'succeeded':
+                run['written'] = run['timesteps']
+                run['complete'] = True
+
+
+def _written_timesteps(qout_file: str) -> int:
+    with nc.Dataset(qout_file) as ds:
+        time_dim = ds.dimensions['time']
+        if time_dim.isunlimited():
+            return len(time_dim)
+        # fixed size files are filled in time order, so count the written values of one reach
+        values = ds['Qout'][:, -1]
+        return int(np.ma.count(values)) if np.ma.is_masked(values) else values.shape[0]
+
 
-    print(f'{outputs_complete} / {num_output_dirs} complete: {round((outputs_complete / num_output_dirs) * 100, 1)}%')
+def update_from_outputs(state: dict) -> None:
+    """
+    Counts the timesteps written to the Qout files of incomplete runs, reopening only files which changed
+    """
+    for run in state['runs'].values():
+        if run['complete'] or not run['qout_file'] or not os.path.exists(run['qout_file']):
+            continue
+        stat = os.stat(run['qout_file'])
+        signature = [stat.st_size, stat.st_mtime_ns]
+        if signature == run['signature']:
+            continue
+        try:
+            run['written'] = min(_written_timesteps(run['qout_file']), run['timesteps'])
+        except (OSError, KeyError, IndexError):
+            # the file is still being created
+            continue
+        run['signature'] = signature
+        run['complete'] = run['timesteps'] > 0 and run['written'] >= run['timesteps']
 
+
+def progress_report(state: dict, now: float = None, deadline: datetime.datetime = None) -> dict:
+    """
+    Summarizes completion, throughput in reach timesteps and reaches per second, and the estimated finish time
+    """
+    now = now or time.time()
+    runs = state['runs'].values()
+    total_work = sum(x['reaches'] * x['timesteps'] for x in runs)
+    done_work = sum(x['reaches'] * x['written'] for x in runs)
+
+    state['samples'].append([now, done_work])
+    state['samples'] = [x for x in state['samples'] if now - x[0] <= THROUGHPUT_WINDOW] or [[now, done_work]]
+    first_time, first_work = state['samples'][0]
+    throughput = (done_work - first_work) / (now - first_time) if now > first_time else 0
+
+    mean_timesteps = total_work / max(sum(x['reaches'] for x in runs), 1)
+    remaining = total_work - done_work
+    eta_seconds = remaining / throughput if throughput > 0 else None
+    report = {
+        'time': datetime.datetime.fromtimestamp(now, datetime.UTC).strftime('%Y-%m-%d %X'),
+        'runs': len(state['runs']),
+        'complete': sum(1 for x in runs if x['complete']),
+        'failed': sum(1 for x in runs if x.get('status') == 'failed' and not x['complete']),
+        'percent_complete': round(100 * done_work / total_work, 1) if total_work else 0,
+        'reach_timesteps_per_second': round(throughput, 1),
+        'reaches_per_second': round(throughput / mean_timesteps, 1) if mean_timesteps else 0,
+        'eta_seconds': round(eta_seconds) if eta_seconds is not None else None,
+        'estimated_finish': None,
+        'meets_deadline': None,
+    }
+    if eta_seconds is not None:
+        finish = datetime.datetime.fromtimestamp(now + eta_seconds, datetime.UTC)
+        report['estimated_finish'] = finish.strftime('%Y-%m-%d %X')
+        if deadline is not None:
+            report['meets_deadline'] = finish <= deadline
+    if remaining == 0 and total_work:
+        report['meets_deadline'] = deadline is None or now <= deadline.timestamp()
+    return report
+
+
+def _print_report(report: dict) -> None:
+    eta = f'{report["eta_seconds"] // 60}m {report["eta_seconds"] % 60}s' if report['eta_seconds'] is not None else '?'
+    message = (
+        f'{report["time"]}: {report["complete"]} / {report["runs"]} runs complete '
+        f'({report["percent_complete"]}% of reach timesteps), {report["failed"]} failed, '
+        f'{report["reaches_per_second"]} reaches/s, ETA {eta}'
+    )
+    if report['estimated_finish']:
+        message += f' (finish {report["estimated_finish"]} UTC)'
+    if report['meets_deadline'] is not None:
+        message += ', on time for deadline' if report['meets_deadline'] else ', WILL MISS DEADLINE'
+    print(message, flush=True)
+
+
+def _parse_deadline(deadline: str, ymd: str) -> datetime.datetime or None:
+    if not deadline:
+        return None
+    if re.match(r'^\d{1,2}:\d{2}$', deadline):
+        deadline = f'{ymd[:4]}-{ymd[4:6]}-{ymd[6:]}T{deadline}'
+    return datetime.datetime.fromisoformat(deadline).replace(tzinfo=datetime.UTC)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ymd', type=str, required=True,
+                        help='Year, month, and day in YYYYMMDD format', )
+    parser.add_argument('--namelistsdir', type=str, required=False, default=None,
+                        help='Path to the directory of namelists. Defaults to FORECASTS_DIR/ymd/namelists', )
+    parser.add_argument('--runlog', type=str, required=False, default=None,
+                        help='Path to the runrapid.py worker run log. Defaults to logs/rapid_runs.jsonl', )
+    parser.add_argument('--state', type=str, required=False, default=None,
+                        help='Path to save the incremental state. Defaults to logs/rapid_progress.json', )
+    parser.add_argument('--watch', type=float, required=False, default=None,
+                        help='Keep reporting every this many seconds until all runs are complete', )
+    parser.add_argument('--deadline', type=str, required=False, default=None,
+                        help='UTC time routing must finish by, as HH:MM on the forecast date or YYYY-MM-DDTHH:MM', )
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='Print reports as JSON lines', )
+
+    args = parser.parse_args()
+    logs_dir = os.path.join(FORECASTS_DIR, args.ymd, 'logs')
+    namelists_dir = args.namelistsdir or os.path.join(FORECASTS_DIR, args.ymd, 'namelists')
+    run_log = args.runlog or os.path.join(logs_dir, 'rapid_runs.jsonl')
+    state_file = args.state or os.path.join(logs_dir, 'rapid_progress.json')
+    deadline = _parse_deadline(args.deadline, args.ymd)
+
+    progress_state = load_state(state_file if os.path.isdir(os.path.dirname(state_file)) else None)
+    while True:
+        discover_runs(progress_state, namelists_dir)
+        update_from_run_log(progress_state, run_log)
+        update_from_outputs(progress_state)
+        progress = progress_report(progress_state, deadline=deadline)
+        save_state(progress_state, state_file if os.path.isdir(os.path.dirname(state_file)) else None)
+        if args.json:
+            print(json.dumps(progress), flush=True)
+        else:
+            _print_report(progress)
+        if args.watch is None or (progress['runs'] and progress['complete'] + progress['failed'] >= progress['runs']):
+            break
+        time.sleep(args.watch)
@@ -1,32 +1,307 @@
 import argparse
+import datetime
 import glob
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import polars as pl
 from natsort import natsorted
 
+from instrumentation import stage
+from stage_manifest import StageManifest
+
 FORECASTS_DIR = os.environ['FORECASTS_DIR']
 
+# compact copies of the global tables are written to maptables/columnar, one parquet file per timestamp or one arrow
+# IPC file per day with one record batch per timestamp
+COLUMNAR_DIR = 'columnar'
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+# a reach is in the delta of a day if any of these differ from the same timestamp of the previous day
+DELTA_CLASS_COLUMNS = ('thickness', 'ret_per')
+
+
+def _csv_table_path(global_csv_tables_dir: str, date: datetime.datetime) -> str:
+    return os.path.join(global_csv_tables_dir, f'mapstyletable_{date.strftime("%Y-%m-%d-%H")}.csv')
+
+
+def _write_partitions(partitions: dict, global_csv_tables_dir: str, max_workers: int) -> None:
+    def _write(item):
+        (date, ), df = item
+        df.write_csv(_csv_table_path(global_csv_tables_dir, date))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_write, partitions.items()))
+
+
+def _stream_partitions(vpu_parquet_tables: list, global_csv_tables_dir: str, max_workers: int) -> None:
+    # the CSVs are appended to one VPU at a time so only one VPU table is held in memory
+    csv_files = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for vpu_parquet_table in vpu_parquet_tables:
+                vpu_df = pl.read_parquet(vpu_parquet_table).fill_nan(0)
+                partitions = vpu_df.partition_by('timestamp', as_dict=True, maintain_order=True)
+                new_dates = {date for (date, ) in partitions if date not in csv_files}
+                for date in new_dates:
+                    csv_files[date] = open(_csv_table_path(global_csv_tables_dir, date), 'wb')
+
+                # each thread appends to a different timestamp's file
+                def _append(item):
+                    (date, ), df = item
+                    df.write_csv(csv_files[date], include_header=date in new_dates)
+
+                list(executor.map(_append, partitions.items()))
+    finally:
+        for csv_file in csv_files.values():
+            csv_file.close()
+
+
+def _columnar_table_path(columnar_dir: str, date: datetime.datetime) -> str:
+    return os.path.join(columnar_dir, f'mapstyletable_{date.strftime("%Y-%m-%d-%H")}.parquet')
+
+
+def _columnar_day_path(columnar_dir: str, ymd: str) -> str:
+    return os.path.join(columnar_dir, f'mapstyletables_{ymd}.arrow')
+
+
+def _delta_path(columnar_dir: str, ymd: str, columnar_format: str) -> str:
+    return os.path.join(columnar_dir, f'mapstyledelta_{ymd}.{columnar_format}')
+
+
+def columnar_dir(ymd: str) -> str:
+    return os.path.join(FORECASTS_DIR, ymd, 'maptables', COLUMNAR_DIR)
+
+
+def columnar_outputs(ymd: str, columnar_format: str) -> list:
+    directory = columnar_dir(ymd)
+    if columnar_format == 'arrow':
+        return [x for x in [_columnar_day_path(directory, ymd)] if os.path.exists(x)]
+    return natsorted(glob.glob(os.path.join(directory, 'mapstyletable_*.parquet')))
+
+
+def compact_table(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Casts a map style table to the smallest types which hold its values: int32 comid, float32 mean and
+    probabilities, and uint8 thickness and return period classes
+    """
+    return df.with_columns(
+        pl.col('comid').cast(pl.Int32),
+        pl.col(DELTA_CLASS_COLUMNS).cast(pl.UInt8),
+        pl.col(pl.Float64).cast(pl.Float32),
+    )
+
+
+def _tmp_path(path: str) -> str:
+    # hidden so that an archiver watching the directory does not upload a file which is still being written
+    return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+
+
+def _write_ipc(batches: list, schema, path: str) -> None:
+    import pyarrow as pa
+
+    with pa.ipc.new_file(_tmp_path(path), schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+        for batch in batches:
+            writer.write(batch)
+    os.replace(_tmp_path(path), path)
 
-def combine_esri_tables(ymd: str) -> None:
+
+def _write_parquet(df: pl.DataFrame, path: str) -> None:
+    import pyarrow.parquet as pq
+
+    # comids are unique within a table, so a comid dictionary only adds a dictionary page as large as the column
+    pq.write_table(df.to_arrow(), _tmp_path(path), compression='zstd', use_dictionary=['timestamp'])
+    os.replace(_tmp_path(path), path)
+
+
+def _write_columnar_partitions(partitions: dict, directory: str, max_workers: int) -> None:
+    def _write(item):
+        (date, ), df = item
+        _write_parquet(compact_table(df), _columnar_table_path(directory, date))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_write, partitions.items()))
+
+
+def _write_columnar_day(partitions: dict, path: str) -> None:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # every timestamp lists the same reaches in the same order, so the comids of one day share a single dictionary
+    # and the indices of each record batch are sequential integers which compress to almost nothing
+    tables = [compact_table(df).to_arrow() for df in partitions.values()]
+    comids = tables[0]['comid'].combine_chunks()
+    if any(not table['comid'].equals(tables[0]['comid']) for table in tables[1:]):
+        comids = pc.unique(pa.chunked_array([table['comid'] for table in tables])).combine_chunks()
+    batches = []
+    for table in tables:
+        indices = pc.index_in(table['comid'], value_set=comids).cast(pa.int32()).combine_chunks()
+        table = table.set_column(table.schema.get_field_index('comid'), 'comid',
+                                 pa.DictionaryArray.from_arrays(indices, comids))
+        batches.extend(table.to_batches())
+    _write_ipc(batches, batches[0].schema, path)
+
+
+def read_columnar_tables(directory: str) -> dict:
+    """
+    Reads the columnar map style tables of a day written by combine_esri_tables in either format
+
+    Args:
+        directory (str): The maptables/columnar directory of the day
+
+    Returns:
+        dict: The table of each forecast timestamp with plain int32 comids, keyed by timestamp
+    """
+    import pyarrow as pa
+
+    tables = {}
+    day_files = glob.glob(os.path.join(directory, 'mapstyletables_*.arrow'))
+    if day_files:
+        with pa.memory_map(day_files[0]) as source:
+            table = pa.ipc.open_file(source).read_all()
+        table = table.set_column(table.schema.get_field_index('comid'), 'comid',
+                                 table['comid'].cast(pa.int32()))
+        df = pl.from_arrow(table)
+        tables.update({date: part for (date, ), part in df.partition_by('timestamp', as_dict=True).items()})
+    for path in glob.glob(os.path.join(directory, 'mapstyletable_*.parquet')):
+        df = pl.read_parquet(path)
+        tables[df['timestamp'][0]] = df
+    return tables
+
+
+def map_table_delta(partitions: dict, previous_tables: dict) -> pl.DataFrame:
+    """
+    Selects the rows of the global tables whose thickness or return period class differs from the same timestamp and
+    reach of the previous forecast day. Reaches and timestamps which were not in the previous day are kept
+
+    Args:
+        partitions (dict): The global table of each timestamp, keyed by (timestamp, )
+        previous_tables (dict): The compact tables of the previous day keyed by timestamp, see read_columnar_tables
+
+    Returns:
+        pl.DataFrame: The changed rows as a compact table
+    """
+    deltas = []
+    for (date, ), df in partitions.items():
+        df = compact_table(df)
+        previous = previous_tables.get(date)
+        if previous is None:
+            deltas.append(df)
+            continue
+        changed = pl.any_horizontal(pl.col(c).ne_missing(pl.col(f'{c}_previous')) for c in DELTA_CLASS_COLUMNS)
+        deltas.append(
+            df
+            .join(previous.select('comid', *DELTA_CLASS_COLUMNS), on='comid', how='left', suffix='_previous')
+            .filter(changed)
+            .select(df.columns)
+        )
+    return pl.concat(deltas)
+
+
+def write_columnar_outputs(ymd: str, partitions: dict, columnar_format: str, max_workers: int,
+                           delta: bool = False, previous_dir: str = None) -> list:
+    """
+    Writes compact copies of the global map style tables, and optionally the rows which changed since the previous
+    forecast day, to the maptables/columnar directory of the day
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        partitions (dict): The global table of each timestamp, keyed by (timestamp, )
+        columnar_format (str): 'parquet' for one file per timestamp or 'arrow' for one IPC file per day
+        max_workers (int): Number of threads writing parquet files concurrently
+        delta (bool): Also write mapstyledelta_{ymd} with the reaches whose class changed since the previous day
+        previous_dir (str): Columnar directory of the day to compare with. Defaults to the one of the day before ymd
+
+    Returns:
+        list: Paths to the files written
+    """
+    directory = columnar_dir(ymd)
+    os.makedirs(directory, exist_ok=True)
+    if columnar_format == 'arrow':
+        _write_columnar_day(partitions, _columnar_day_path(directory, ymd))
+    else:
+        _write_columnar_partitions(partitions, directory, max_workers)
+    outputs = columnar_outputs(ymd, columnar_format)
+
+    if delta:
+        if previous_dir is None:
+            previous_ymd = (datetime.datetime.strptime(ymd, '%Y%m%d') - datetime.timedelta(days=1)).strftime('%Y%m%d')
+            previous_dir = columnar_dir(previous_ymd)
+        previous_tables = read_columnar_tables(previous_dir)
+        if not previous_tables:
+            logging.warning(f'No columnar map tables in {previous_dir}, the delta contains every reach')
+        delta_df = map_table_delta(partitions, previous_tables)
+        logging.info(f'{delta_df.height} rows changed since {previous_dir}')
+        delta_path = _delta_path(directory, ymd, columnar_format)
+        if columnar_format == 'arrow':
+            table = delta_df.to_arrow()
+            _write_ipc(table.to_batches(), table.schema, delta_path)
+        else:
+            _write_parquet(delta_df, delta_path)
+        outputs.append(delta_path)
+    return outputs
+
+
+def combine_esri_tables(ymd: str, streaming: bool = False, max_workers: int = None,
+                        manifest: StageManifest = None, columnar: str = None, delta: bool = False,
+                        previous_dir: str = None) -> None:
+    """
+    Combines the VPU map style tables into one CSV per forecast timestamp
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        streaming (bool): Read and partition one VPU table at a time instead of materializing the global table
+        max_workers (int): Number of threads writing CSVs concurrently. Defaults to the number of CPUs
+        manifest (StageManifest): Stage manifest of the day. Skips the tables if they are complete and records them
+        columnar (str): Also write compact 'parquet' or 'arrow' tables, see write_columnar_outputs. Not streamed
+        delta (bool): Also write the reaches whose class changed since the previous day. Requires columnar
+        previous_dir (str): Columnar directory to compare with for the delta. Defaults to the previous day's
+
+    Returns:
+        None
+    """
     # get path to tables from workspace
     vpu_parquet_tables = natsorted(glob.glob(os.path.join(FORECASTS_DIR, ymd, "maptables", 'map*parquet')))
     global_csv_tables_dir = os.path.join(FORECASTS_DIR, ymd, "maptables")
+    max_workers = max_workers or os.cpu_count()
+    if columnar is not None and columnar not in COLUMNAR_FORMATS:
+        raise ValueError(f'columnar must be one of {COLUMNAR_FORMATS}, not {columnar}')
+    if streaming and columnar:
+        raise ValueError('The columnar tables are written from the global table and cannot be streamed')
+    if delta and not columnar:
+        raise ValueError('The delta is written as a columnar table, give the columnar format')
+    if manifest is not None:
+        if manifest.is_complete('globalmaptables', ymd, vpu_parquet_tables):
+            logging.info("The global map tables are complete")
+            return
+        # VPU tables deleted by the last run have to be generated again before the global tables can be redone
+        lost_tables = manifest.invalidate_lost('globalmaptables', ymd, vpu_parquet_tables)
+        if lost_tables:
+            raise FileNotFoundError(f'Rerun generate_vpu_map_tables.py for the tables deleted by the last run: '
+                                    f'{lost_tables}')
 
-    # select all outputs/VPUNUMBER/DATE/map_style_table*.parquet files
-    logging.info("Concatenating parquet map_style_tables from each VPU")
-    global_map_style_df = pl.concat([pl.read_parquet(x) for x in vpu_parquet_tables])
-
-    # replace nans with 0
-    logging.info("Preparing concatenated DF")
-    global_map_style_df = global_map_style_df.fill_nan(0)
+    columnar_files = []
+    if streaming:
+        logging.info("Streaming parquet map_style_tables from each VPU into timestamp CSVs")
+        _stream_partitions(vpu_parquet_tables, global_csv_tables_dir, max_workers)
+    else:
+        # select all outputs/VPUNUMBER/DATE/map_style_table*.parquet files and replace nans with 0
+        logging.info("Concatenating parquet map_style_tables from each VPU")
+        global_map_style_df = pl.scan_parquet(vpu_parquet_tables).fill_nan(0).collect()
 
-    # for each unique date in the timestamp column, create a new dataframe
-    for date in global_map_style_df['timestamp'].unique():
-        file_save_path = os.path.join(global_csv_tables_dir, f'mapstyletable_{date.strftime("%Y-%m-%d-%H")}.csv')
-        global_map_style_df.filter(pl.col('timestamp') == date).write_csv(file_save_path)
+        # split the global table by timestamp in a single pass then write the CSVs concurrently
+        logging.info("Partitioning concatenated DF by timestamp")
+        partitions = global_map_style_df.partition_by('timestamp', as_dict=True, maintain_order=True)
+        del global_map_style_df
+        _write_partitions(partitions, global_csv_tables_dir, max_workers)
+        if columnar:
+            logging.info(f"Writing {columnar} map_style_tables")
+            columnar_files = write_columnar_outputs(ymd, partitions, columnar, max_workers, delta, previous_dir)
 
+    if manifest is not None:
+        manifest.record('globalmaptables', ymd, vpu_parquet_tables,
+                        glob.glob(os.path.join(global_csv_tables_dir, 'mapstyletable_*.csv')) + columnar_files,
+                        consumed=vpu_parquet_tables)
     for parquet_table in vpu_parquet_tables:
         os.remove(parquet_table)
     return
@@ -35,7 +310,29 @@ def combine_esri_tables(ymd: str) -> None:
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--ymd', type=str, required=True,)
+    argparser.add_argument('--streaming', action='store_true', default=False,
+                           help='Process one VPU table at a time to bound memory use')
+    argparser.add_argument('--workers', type=int, required=False, default=None,
+                           help='Number of threads writing CSVs concurrently')
+    argparser.add_argument('--columnar', type=str, required=False, default=os.environ.get('MAP_TABLE_COLUMNAR'),
+                           choices=COLUMNAR_FORMATS,
+                           help='Also write compact tables to maptables/columnar, one parquet file per timestamp '
+                                'or one arrow IPC file per day. Defaults to $MAP_TABLE_COLUMNAR')
+    argparser.add_argument('--delta', action='store_true',
+                           default=os.environ.get('MAP_TABLE_DELTA', '').lower() in ('1', 'true', 'yes'),
+                           help='Also write the reaches whose class changed since the previous forecast day. '
+                                'Defaults to true if $MAP_TABLE_DELTA is 1, true or yes')
+    argparser.add_argument('--previous', type=str, required=False, default=None,
+                           help='Columnar directory to compare with for --delta. Defaults to the previous day\'s')
     args = argparser.parse_args()
     ymd = args.ymd
+    if args.streaming and args.columnar:
+        argparser.error('--columnar cannot be combined with --streaming')
+    if args.delta and not args.columnar:
+        argparser.error('--delta requires --columnar')
 
-    combine_esri_tables(ymd)
+    with stage('globalmaptables', ymd=ymd, outputs=[os.path.join(FORECASTS_DIR, ymd, 'maptables', '*.csv'),
+                                                    os.path.join(columnar_dir(ymd), '*')]):
+        combine_esri_tables(ymd, streaming=args.streaming, max_workers=args.workers,
+                            manifest=StageManifest.for_day(ymd), columnar=args.columnar, delta=args.delta,
+                            previous_dir=args.previous)
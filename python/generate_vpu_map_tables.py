@@ -1,10 +1,15 @@
 import argparse
+import contextlib
 import os
 
-import netCDF4 as nc
+import numpy as np
 import pandas as pd
 import xarray as xr
 
+from instrumentation import stage
+from return_periods import RETURN_PERIODS, load_thresholds
+from stage_manifest import StageManifest
+
 FORECASTS_DIR = os.environ['FORECASTS_DIR']
 CONFIGS_DIR = os.environ['CONFIGS_DIR']
 RUNOFFS_DIR = os.environ['RUNOFFS_DIR']
@@ -12,73 +17,176 @@ INITS_DIR = os.environ['INITS_DIR']
 RETURN_PERIODS_DIR = os.environ['RETURN_PERIODS_DIR']
 
 
-def postprocess_vpu_forecast_directory(ymd: str, vpu: int or str, ):
-    style_table_file_name = f'mapstyletable_{vpu}_{ymd}.parquet'
-    if os.path.exists(os.path.join(FORECASTS_DIR, ymd, 'mapstyletables', style_table_file_name)):
+THICKNESS_BINS = np.array([20, 250, 1500, 10000, 30000])
+
+
+def read_return_period_thresholds(vpu: int or str, comids: np.ndarray) -> np.ndarray:
+    """
+    Reads the return period flows for a VPU aligned to the order of the given comids, memory mapped from the thresholds
+    compiled by return_periods.py if they match the comids
+
+    Args:
+        vpu (int or str): VPU number
+        comids (np.ndarray): River IDs in the order of the Qout columns
+
+    Returns:
+        np.ndarray: Array of shape (len(RETURN_PERIODS), len(comids)). Missing thresholds are +inf.
+    """
+    return load_thresholds(os.path.join(RETURN_PERIODS_DIR, f"returnperiods_{vpu}.nc"), comids)
+
+
+def classify_thickness(flows: np.ndarray) -> np.ndarray:
+    """
+    Classifies flows into the map line thickness classes 1 through 6
+    """
+    thickness = np.digitize(flows, THICKNESS_BINS).astype(np.int64) + 1
+    thickness[np.isnan(flows)] = 1
+    return thickness
+
+
+def classify_return_period(flows: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """
+    Classifies flows (time x comid) by the largest return period whose threshold is exceeded, or 0
+
+    A flow is labeled with the last return period in RETURN_PERIODS that it exceeds. Taking the running minimum of
+    the thresholds from the largest return period down makes them monotonic per reach without changing that label,
+    so the class is found by counting how many thresholds are exceeded.
+    """
+    monotonic_thresholds = np.minimum.accumulate(thresholds[::-1], axis=0)[::-1]
+    n_exceeded = np.zeros(flows.shape, dtype=np.uint8)
+    for threshold in monotonic_thresholds:
+        n_exceeded += flows > threshold
+    return np.array((0, *RETURN_PERIODS), dtype=np.int64)[n_exceeded]
+
+
+def map_table_columns(dates: np.ndarray, comids: np.ndarray, flows: np.ndarray, thresholds: np.ndarray,
+                      exceedance: np.ndarray = None) -> dict:
+    """
+    Builds the columns of the long format map table from a 2D (time x comid) array of rounded mean flows
+
+    Args:
+        exceedance (np.ndarray): Fractions of the ensemble members exceeding each return period flow with shape
+            (len(RETURN_PERIODS), time, comid), added as the prob_rp{return period} columns if given
+
+    Returns:
+        dict: Flat arrays for the timestamp, comid, mean, thickness, and ret_per columns in time major order
+    """
+    thickness = classify_thickness(flows)
+    ret_per = classify_return_period(flows, thresholds)
+    mean = np.where(flows < 0, np.zeros(1, dtype=flows.dtype), flows)
+    columns = {
+        "timestamp": np.repeat(dates, comids.shape[0]),
+        "comid": np.tile(comids, dates.shape[0]),
+        "mean": mean.ravel(),
+        "thickness": thickness.ravel(),
+        "ret_per": ret_per.ravel(),
+    }
+    if exceedance is not None:
+        for rp, fractions in zip(RETURN_PERIODS, exceedance):
+            columns[f"prob_rp{rp}"] = fractions.round(2).ravel()
+    return columns
+
+
+def write_map_table_blocks(vpu: int or str, nces_output_filename: str, style_table_path: str, block_size: int,
+                           stats_filename: str = None) -> int:
+    """
+    Writes the map table of a VPU one block of reaches at a time, each block a row group of the same parquet file
+
+    Only the flows, thresholds and exceedance fractions of one block are in memory at once, so peak memory is bounded
+    by the block size instead of the size of the VPU. Rows are ordered by block, then time, then comid, so the rows of
+    each timestamp are still in comid order.
+
+    Args:
+        vpu (int or str): VPU number
+        nces_output_filename (str): Path to the nces_avg_{vpu}.nc ensemble mean
+        style_table_path (str): Path to write the parquet map table to
+        block_size (int): Number of reaches per block
+        stats_filename (str): Path to the nces_stats_{vpu}.nc ensemble statistics to add the prob_rp columns from
+
+    Returns:
+        int: Number of row groups written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tmp_path = f'{style_table_path}.tmp'
+    stats = xr.open_dataset(stats_filename) if stats_filename else contextlib.nullcontext()
+    with xr.open_dataset(nces_output_filename) as ds, stats as stats_ds:
+        comids = ds["rivid"][:].values
+        dates = pd.to_datetime(ds["time"][:].values)
+        first_10_days = dates <= dates[0] + pd.Timedelta(days=10)
+        dates = dates[first_10_days].values
+        thresholds = read_return_period_thresholds(vpu, comids)
+
+        n_blocks = 0
+        writer = None
+        try:
+            # a VPU without reaches is written as one empty block so the table still has its columns
+            for start in range(0, max(comids.shape[0], 1), block_size):
+                end = min(start + block_size, comids.shape[0])
+                mean_flows = ds["Qout"][first_10_days, start:end].values.round(1)
+                exceedance = None
+                if stats_ds is not None:
+                    exceedance = stats_ds["Qout_exceedance"].sel(
+                        return_period=list(RETURN_PERIODS))[:, first_10_days, start:end].values
+                block = pa.table(map_table_columns(
+                    dates, comids[start:end], mean_flows, thresholds[:, start:end], exceedance))
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, block.schema)
+                writer.write_table(block)
+                n_blocks += 1
+        except BaseException:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    writer.close()
+    os.replace(tmp_path, style_table_path)
+    return n_blocks
+
+
+def postprocess_vpu_forecast_directory(ymd: str, vpu: int or str, manifest: StageManifest = None,
+                                       probabilities: bool = False, block_size: int = None):
+    maptable_outdir = os.path.join(FORECASTS_DIR, ymd, "maptables")
+    style_table_path = os.path.join(maptable_outdir, f'mapstyletable_{vpu}_{ymd}.parquet')
+    nces_output_filename = os.path.join(FORECASTS_DIR, ymd, 'outputs', f'nces_avg_{vpu}.nc')
+    stats_filename = os.path.join(FORECASTS_DIR, ymd, 'outputs', f'nces_stats_{vpu}.nc')
+    rp_path = os.path.join(RETURN_PERIODS_DIR, f"returnperiods_{vpu}.nc")
+    inputs = [nces_output_filename, rp_path, stats_filename] if probabilities else [nces_output_filename, rp_path]
+    if manifest is not None:
+        if manifest.is_complete('maptables', vpu, inputs):
+            return
+    elif os.path.exists(style_table_path):
         return
 
-    nces_output_filename = os.path.join(FORECASTS_DIR, ymd, 'outputs', f'nces_avg_{vpu}.nc')
+    if block_size:
+        write_map_table_blocks(vpu, nces_output_filename, style_table_path, block_size,
+                               stats_filename if probabilities else None)
+        if manifest is not None:
+            manifest.record('maptables', vpu, inputs, [style_table_path])
+        return
 
-    # read the date and COMID lists from one of the netcdfs
+    # read the date and COMID lists and the flows for the first 10 days
     with xr.open_dataset(nces_output_filename) as ds:
         comids = ds["rivid"][:].values
         dates = pd.to_datetime(ds["time"][:].values)
-        mean_flows = ds["Qout"][:].values.round(1)
-
-    mean_flow_df = pd.DataFrame(mean_flows, columns=comids, index=dates)
-
-    # limit both dataframes to the first 10 days
-    mean_flow_df = mean_flow_df[mean_flow_df.index <= mean_flow_df.index[0] + pd.Timedelta(days=10)]
-
-    # creating pandas dataframe with return periods
-    rp_path = os.path.join(RETURN_PERIODS_DIR, f"returnperiods_{vpu}.nc")
-    with nc.Dataset(rp_path, "r") as rp_ncfile:
-        rp_df = pd.DataFrame(
-            {
-                "return_2": rp_ncfile.variables["rp2"][:],
-                "return_5": rp_ncfile.variables["rp5"][:],
-                "return_10": rp_ncfile.variables["rp10"][:],
-                "return_25": rp_ncfile.variables["rp25"][:],
-                "return_50": rp_ncfile.variables["rp50"][:],
-                "return_100": rp_ncfile.variables["rp100"][:],
-            },
-            index=rp_ncfile.variables["rivid"][:],
-        )
-
-    mean_thickness_df = pd.DataFrame(columns=comids, index=dates, dtype=int)
-    mean_thickness_df[:] = 1
-    mean_thickness_df[mean_flow_df >= 20] = 2
-    mean_thickness_df[mean_flow_df >= 250] = 3
-    mean_thickness_df[mean_flow_df >= 1500] = 4
-    mean_thickness_df[mean_flow_df >= 10000] = 5
-    mean_thickness_df[mean_flow_df >= 30000] = 6
-
-    mean_ret_per_df = pd.DataFrame(columns=comids, index=dates, dtype=int)
-    mean_ret_per_df[:] = 0
-    mean_ret_per_df[mean_flow_df.gt(rp_df["return_2"], axis=1)] = 2
-    mean_ret_per_df[mean_flow_df.gt(rp_df["return_5"], axis=1)] = 5
-    mean_ret_per_df[mean_flow_df.gt(rp_df["return_10"], axis=1)] = 10
-    mean_ret_per_df[mean_flow_df.gt(rp_df["return_25"], axis=1)] = 25
-    mean_ret_per_df[mean_flow_df.gt(rp_df["return_50"], axis=1)] = 50
-    mean_ret_per_df[mean_flow_df.gt(rp_df["return_100"], axis=1)] = 100
-
-    mean_flow_df = mean_flow_df.stack().to_frame().rename(columns={0: "mean"})
-    mean_thickness_df = mean_thickness_df.stack().to_frame().rename(columns={0: "thickness"})
-    mean_ret_per_df = mean_ret_per_df.stack().to_frame().rename(columns={0: "ret_per"})
-
-    # merge all dataframes
-    for df in [mean_thickness_df, mean_ret_per_df]:
-        mean_flow_df = mean_flow_df.merge(df, left_index=True, right_index=True)
-
-    maptable_outdir = os.path.join(FORECASTS_DIR, ymd, "maptables")
-
-    mean_flow_df.index.names = ["timestamp", "comid"]
-    mean_flow_df = mean_flow_df.reset_index()
-    mean_flow_df["mean"] = mean_flow_df["mean"].round(1)
-    mean_flow_df.loc[mean_flow_df["mean"] < 0, "mean"] = 0
-    mean_flow_df["thickness"] = mean_flow_df["thickness"].astype(int)
-    mean_flow_df["ret_per"] = mean_flow_df["ret_per"].astype(int)
-    mean_flow_df.to_parquet(os.path.join(maptable_outdir, style_table_file_name))
+        first_10_days = dates <= dates[0] + pd.Timedelta(days=10)
+        dates = dates[first_10_days].values
+        mean_flows = ds["Qout"][first_10_days, :].values.round(1)
+
+    # the exceedance fractions written by postprocess_rapid_outputs.py from the same read of the ensemble members
+    exceedance = None
+    if probabilities:
+        with xr.open_dataset(stats_filename) as ds:
+            exceedance = ds["Qout_exceedance"].sel(return_period=list(RETURN_PERIODS))[:, first_10_days, :].values
+
+    thresholds = read_return_period_thresholds(vpu, comids)
+    map_table = pd.DataFrame(map_table_columns(dates, comids, mean_flows, thresholds, exceedance), copy=False)
+
+    map_table.to_parquet(style_table_path)
+    if manifest is not None:
+        manifest.record('maptables', vpu, inputs, [style_table_path])
     return
 
 
@@ -97,9 +205,25 @@ if __name__ == "__main__":
         required=True,
         help="VPU number"
     )
+    parser.add_argument(
+        '--probabilities',
+        action='store_true',
+        default=False,
+        help="Add the fraction of ensemble members exceeding each return period as prob_rp columns"
+    )
+    parser.add_argument(
+        '--blocksize',
+        type=int,
+        required=False,
+        default=os.environ.get('MAP_TABLE_BLOCK_SIZE'),
+        help="Stream the map table in blocks of this many reaches to bound memory. Defaults to $MAP_TABLE_BLOCK_SIZE, "
+             "or the whole VPU at once if it is not set"
+    )
     args = parser.parse_args()
 
     ymd = args.ymd
     vpu = args.vpu
 
-    postprocess_vpu_forecast_directory(ymd=ymd, vpu=vpu)
+    with stage('maptables', ymd=ymd, vpu=vpu, outputs=[os.path.join(FORECASTS_DIR, ymd, 'maptables', f'*_{vpu}_*')]):
+        postprocess_vpu_forecast_directory(ymd=ymd, vpu=vpu, manifest=StageManifest.for_day(ymd),
+                                           probabilities=args.probabilities, block_size=args.blocksize)
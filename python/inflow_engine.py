@@ -0,0 +1,462 @@
+import dataclasses
+import datetime
+import glob
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import xarray as xr
+from natsort import natsorted
+
+# number of runoff timesteps decoded from the full grid at a time
+DEFAULT_TIME_BLOCK_SIZE = 8
+# fraction of the available memory the arrays of the runoff files processed at once may use together
+WORKER_MEMORY_FRACTION = 0.5
+
+
+@dataclasses.dataclass
+class VpuWeights:
+    """
+    A VPU weight table compiled into a sparse (reach x grid cell) matrix of contributing areas
+    """
+    vpu: str
+    weight_table: str
+    rivids: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    bounds: tuple  # min_lat, max_lat, min_lon, max_lon of the weight table
+    matrix: scipy.sparse.csr_matrix
+
+
+@dataclasses.dataclass
+class GridWeights:
+    """
+    All VPU weight matrices for one runoff grid shape, with columns indexing the union of cells they use
+    """
+    shape: tuple
+    cells: np.ndarray  # flat (lat, lon) indices of the cells read from the grid
+    vpus: list
+
+
+def _weight_table_grid_shape(weight_table: str) -> tuple:
+    return tuple(int(x) for x in re.findall(r'(\d+)x(\d+)', os.path.basename(weight_table))[0])
+
+
+def compile_weight_matrices(configs_dir: str, vpus: list = None) -> dict:
+    """
+    Reads every weight_*.csv table under the VPU config directories into sparse matrices grouped by grid shape
+
+    For each VPU and grid shape the same weight table is selected as basininflow.create_inflow_file would select.
+
+    Args:
+        configs_dir (str): Path to the directory of VPU config directories
+        vpus (list): VPU numbers to compile. Defaults to every directory in configs_dir
+
+    Returns:
+        dict: GridWeights keyed by the (lat, lon) shape of the runoff grid
+    """
+    if vpus is None:
+        vpus = natsorted([os.path.basename(x) for x in glob.glob(os.path.join(configs_dir, '*')) if os.path.isdir(x)])
+
+    tables_by_shape = {}
+    for vpu in vpus:
+        vpu_dir = os.path.join(configs_dir, vpu)
+        for weight_table in glob.glob(os.path.join(vpu_dir, 'weight_*.csv')):
+            shape = _weight_table_grid_shape(weight_table)
+            first_match = glob.glob(os.path.join(vpu_dir, f'weight*{shape[0]}x{shape[1]}.csv'))[0]
+            tables_by_shape.setdefault(shape, {})[vpu] = first_match
+
+    grids = {}
+    for shape, tables in tables_by_shape.items():
+        logging.info(f'Compiling {len(tables)} weight tables for grid shape {shape}')
+        weight_dfs = {vpu: pd.read_csv(weight_table) for vpu, weight_table in tables.items()}
+        # negative indices wrap around the grid the same way numpy indexing does
+        flat_cells = {
+            vpu: (df['lat_index'].values % shape[0]) * shape[1] + (df['lon_index'].values % shape[1])
+            for vpu, df in weight_dfs.items()
+        }
+        cells = np.unique(np.concatenate(list(flat_cells.values())))
+
+        vpu_weights = []
+        for vpu, weight_df in weight_dfs.items():
+            comid_df = pd.read_csv(os.path.join(configs_dir, vpu, 'comid_lat_lon_z.csv'))
+            rivids = comid_df.iloc[:, 0].to_numpy()
+            rows = pd.Index(rivids).get_indexer(weight_df.iloc[:, 0].to_numpy())
+            keep = rows >= 0
+            matrix = scipy.sparse.csr_matrix(
+                (weight_df['area_sqm'].values[keep], (rows[keep], np.searchsorted(cells, flat_cells[vpu][keep]))),
+                shape=(rivids.shape[0], cells.shape[0]),
+            )
+            vpu_weights.append(VpuWeights(
+                vpu=vpu,
+                weight_table=tables[vpu],
+                rivids=rivids,
+                lat=comid_df['lat'].values,
+                lon=comid_df['lon'].values,
+                bounds=(weight_df['lat'].min(), weight_df['lat'].max(), weight_df['lon'].min(), weight_df['lon'].max()),
+                matrix=matrix,
+            ))
+        grids[shape] = GridWeights(shape=shape, cells=cells, vpus=vpu_weights)
+    return grids
+
+
+def read_runoff_cells(runoff_file: str,
+                      grids: dict,
+                      runoff_var: str = 'RO',
+                      time_var: str = 'time',
+                      time_block_size: int = DEFAULT_TIME_BLOCK_SIZE, ) -> tuple:
+    """
+    Reads the runoff of every cell used by any VPU from a runoff file, decoding the grid in blocks of timesteps
+
+    Returns:
+        tuple: the GridWeights matching the file, the datetime array, an array of shape (time, cells) with NaN and
+            negative runoff replaced by 0, and the factor which converts the runoff units to meters
+    """
+    with xr.open_dataset(runoff_file) as ds:
+        runoff = ds[runoff_var]
+        grid_shape = tuple(runoff.shape[-2:])
+        if grid_shape not in grids:
+            raise FileNotFoundError(f'No weight tables found for the grid shape {grid_shape} of {runoff_file}')
+        grid = grids[grid_shape]
+
+        units = runoff.attrs.get('units', False)
+        if not units:
+            logging.warning("No units attribute found. Assuming meters")
+            conversion_factor = 1
+        elif units == 'm':
+            conversion_factor = 1
+        elif units == 'mm':
+            conversion_factor = .001
+        else:
+            raise ValueError(f"Unknown units: {units}")
+
+        datetime_array = ds[time_var].to_numpy()
+        values = np.empty((datetime_array.shape[0], grid.cells.shape[0]), dtype=runoff.dtype)
+        for start in range(0, datetime_array.shape[0], time_block_size):
+            end = min(start + time_block_size, datetime_array.shape[0])
+            block = runoff[start:end].values
+            if block.ndim == 3:
+                values[start:end] = block.reshape(end - start, -1)[:, grid.cells]
+            elif block.ndim == 4:
+                block = block.reshape(end - start, block.shape[1], -1)[:, :, grid.cells]
+                values[start:end] = np.where(np.isnan(block[:, 0, :]), block[:, 1, :], block[:, 0, :])
+            else:
+                raise ValueError(f"Unknown number of dimensions: {block.ndim}")
+
+    values[np.isnan(values)] = 0
+    np.clip(values, 0, None, out=values)
+    return grid, datetime_array, values, conversion_factor
+
+
+def _cumulative_to_incremental(values: np.ndarray) -> np.ndarray:
+    return np.vstack([values[0, :], np.diff(values, axis=0)])
+
+
+def route_runoff_to_reaches(vpu_weights: VpuWeights,
+                            datetime_array: np.ndarray,
+                            runoff: np.ndarray,
+                            conversion_factor: float = 1, ) -> tuple:
+    """
+    Converts gridded runoff depths to incremental inflow volumes per reach with one sparse matrix multiply
+
+    Non-uniform timesteps are resampled to the first timestep the same way basininflow does it.
+
+    Returns:
+        tuple: the (possibly resampled) datetime array and an array of inflow volumes of shape (time, rivid)
+    """
+    inflows = (vpu_weights.matrix @ runoff.T).T * conversion_factor
+
+    time_diff = np.diff(datetime_array)
+    if np.all(time_diff == datetime_array[1] - datetime_array[0]):
+        return datetime_array, inflows
+
+    timestep = pd.Timedelta(datetime_array[1] - datetime_array[0])
+    inflows = (
+        pd.DataFrame(inflows, index=datetime_array)
+        .cumsum()
+        .resample(rule=timestep)
+        .interpolate(method='linear')
+    )
+    return inflows.index.to_numpy(), _cumulative_to_incremental(inflows.values)
+
+
+def write_inflow_file(vpu_weights: VpuWeights,
+                      datetime_array: np.ndarray,
+                      inflows: np.ndarray,
+                      inflow_dir: str,
+                      file_label: str = None, ) -> str:
+    """
+    Writes an m3 inflow netCDF with the same layout and naming as basininflow.create_inflow_file
+
+    Returns:
+        str: Path to the inflow file
+    """
+    start_date = pd.to_datetime(datetime_array[0]).strftime('%Y%m%d')
+    end_date = pd.to_datetime(datetime_array[-1]).strftime('%Y%m%d')
+    file_name = f'm3_{vpu_weights.vpu}_{start_date}_{end_date}.nc'
+    if file_label is not None:
+        file_name = f'm3_{vpu_weights.vpu}_{start_date}_{end_date}_{file_label}.nc'
+    inflow_file_path = os.path.join(inflow_dir, file_name)
+    min_lat, max_lat, min_lon, max_lon = vpu_weights.bounds
+
+    with nc.Dataset(inflow_file_path, "w", format="NETCDF3_CLASSIC") as inflow_nc:
+        # create dimensions
+        inflow_nc.createDimension('time', datetime_array.shape[0])
+        inflow_nc.createDimension('rivid', vpu_weights.rivids.shape[0])
+        inflow_nc.createDimension('nv', 2)
+
+        # m3_riv
+        m3_riv_var = inflow_nc.createVariable('m3_riv', 'f4', ('time', 'rivid'))
+        m3_riv_var[:] = inflows
+        m3_riv_var.long_name = 'accumulated inflow inflow volume in river reach boundaries'
+        m3_riv_var.units = 'm3'
+        m3_riv_var.coordinates = 'lon lat'
+        m3_riv_var.grid_mapping = 'crs'
+        m3_riv_var.cell_methods = "time: sum"
+
+        # rivid
+        rivid_var = inflow_nc.createVariable('rivid', 'i4', ('rivid',))
+        rivid_var[:] = vpu_weights.rivids
+        rivid_var.long_name = 'unique identifier for each river reach'
+        rivid_var.units = '1'
+        rivid_var.cf_role = 'timeseries_id'
+
+        # time
+        reference_time = datetime_array[0]
+        time_step = (datetime_array[1] - reference_time).astype('timedelta64[s]')
+        time_var = inflow_nc.createVariable('time', 'i4', ('time',))
+        time_var[:] = (datetime_array - reference_time).astype('timedelta64[s]').astype(int)
+        time_var.long_name = 'time'
+        time_var.standard_name = 'time'
+        time_var.units = f'seconds since {reference_time.astype("datetime64[s]")}'  # Must be seconds
+        time_var.axis = 'T'
+        time_var.calendar = 'gregorian'
+        time_var.bounds = 'time_bnds'
+
+        # time_bnds
+        time_bnds = inflow_nc.createVariable('time_bnds', 'i4', ('time', 'nv',))
+        time_bnds_array = np.stack([datetime_array, datetime_array + time_step], axis=1)
+        time_bnds_array = (time_bnds_array - reference_time).astype('timedelta64[s]').astype(int)
+        time_bnds[:] = time_bnds_array
+
+        # longitude
+        lon_var = inflow_nc.createVariable('lon', 'f8', ('rivid',))
+        lon_var[:] = vpu_weights.lon
+        lon_var.long_name = 'longitude of a point related to each river reach'
+        lon_var.standard_name = 'longitude'
+        lon_var.units = 'degrees_east'
+        lon_var.axis = 'X'
+
+        # latitude
+        lat_var = inflow_nc.createVariable('lat', 'f8', ('rivid',))
+        lat_var[:] = vpu_weights.lat
+        lat_var.long_name = 'latitude of a point related to each river reach'
+        lat_var.standard_name = 'latitude'
+        lat_var.units = 'degrees_north'
+        lat_var.axis = 'Y'
+
+        # crs
+        crs_var = inflow_nc.createVariable('crs', 'i4')
+        crs_var.grid_mapping_name = 'latitude_longitude'
+        crs_var.epsg_code = 'EPSG:4326'  # WGS 84
+        crs_var.semi_major_axis = 6378137.0
+        crs_var.inverse_flattening = 298.257223563
+
+        # add global attributes
+        inflow_nc.Conventions = 'CF-1.6'
+        inflow_nc.history = f'date_created: {datetime.datetime.now(datetime.UTC)}'
+        inflow_nc.featureType = 'timeSeries'
+        inflow_nc.geospatial_lat_min = min_lat
+        inflow_nc.geospatial_lat_max = max_lat
+        inflow_nc.geospatial_lon_min = min_lon
+        inflow_nc.geospatial_lon_max = max_lon
+
+    return inflow_file_path
+
+
+def create_inflow_files_for_runoff(runoff_file: str,
+                                   grids: dict,
+                                   inflow_dir: str,
+                                   skip_vpus: set = None,
+                                   time_block_size: int = DEFAULT_TIME_BLOCK_SIZE,
+                                   manifest=None, ) -> list:
+    """
+    Reads one runoff file once and writes the m3_{vpu}_*_{ensemble}.nc inflow file of every compiled VPU
+
+    Args:
+        runoff_file (str): Path to an ensemble runoff file named {ensemble}.*.nc
+        grids (dict): Compiled weight matrices from compile_weight_matrices
+        inflow_dir (str): Path to the directory to save inflow files
+        skip_vpus (set): VPU numbers which already have an inflow file for this ensemble member
+        time_block_size (int): Number of runoff timesteps decoded from the full grid at a time
+        manifest (StageManifest): Stage manifest of the day where each inflow file is recorded once it is written
+
+    Returns:
+        list: Paths to the inflow files written
+    """
+    skip_vpus = skip_vpus or set()
+    vpu_inputs = vpu_input_files(grids) if manifest is not None else {}
+    file_label = os.path.basename(runoff_file).split('.')[0]
+    logging.info(f'Reading runoff file {runoff_file}')
+    grid, datetime_array, runoff, conversion_factor = read_runoff_cells(
+        runoff_file, grids, time_block_size=time_block_size
+    )
+
+    inflow_files = []
+    for vpu_weights in grid.vpus:
+        if vpu_weights.vpu in skip_vpus:
+            continue
+        vpu_datetimes, inflows = route_runoff_to_reaches(vpu_weights, datetime_array, runoff, conversion_factor)
+        inflow_file = write_inflow_file(vpu_weights, vpu_datetimes, inflows, inflow_dir, file_label)
+        if manifest is not None:
+            manifest.record('inflows', f'{vpu_weights.vpu}_{file_label}', [runoff_file, *vpu_inputs[vpu_weights.vpu]],
+                            [inflow_file])
+        inflow_files.append(inflow_file)
+    logging.info(f'Wrote {len(inflow_files)} inflow files for {runoff_file}')
+    return inflow_files
+
+
+def vpu_input_files(grids: dict) -> dict:
+    """
+    Lists the config files the inflows of each VPU are computed from: its weight tables and comid_lat_lon_z.csv
+    """
+    inputs = {}
+    for grid in grids.values():
+        for vpu_weights in grid.vpus:
+            vpu_dir = os.path.dirname(vpu_weights.weight_table)
+            inputs.setdefault(vpu_weights.vpu, [os.path.join(vpu_dir, 'comid_lat_lon_z.csv')])
+            inputs[vpu_weights.vpu].append(vpu_weights.weight_table)
+    return inputs
+
+
+def _available_memory_bytes() -> int:
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def runoff_file_memory_bytes(runoff_file: str,
+                             grids: dict,
+                             runoff_var: str = 'RO',
+                             time_block_size: int = DEFAULT_TIME_BLOCK_SIZE, ) -> int:
+    """
+    Estimates the bytes a worker holds while it processes a runoff file: the (time, cells) runoff array of the cells
+    used by any VPU, one decoded block of the full grid, and the inflows of the largest VPU and their transpose
+
+    The compiled weight matrices are not counted, forked workers share them with the parent.
+    """
+    with nc.Dataset(runoff_file) as ds:
+        runoff = ds[runoff_var]
+        shape = runoff.shape
+        itemsize = runoff.dtype.itemsize
+    grid = grids.get(tuple(shape[-2:]))
+    if grid is None:
+        return 0
+    n_times = shape[0]
+    grid_cells = int(np.prod(shape[1:]))
+    max_reaches = max(x.rivids.shape[0] for x in grid.vpus)
+    return (n_times * grid.cells.shape[0] * itemsize
+            + min(time_block_size, n_times) * grid_cells * itemsize
+            + 2 * n_times * max_reaches * 8)
+
+
+def default_max_workers(runoff_files: list,
+                        grids: dict,
+                        time_block_size: int = DEFAULT_TIME_BLOCK_SIZE,
+                        memory_fraction: float = WORKER_MEMORY_FRACTION, ) -> int:
+    """
+    The number of runoff files processed at once: the number of CPUs, lowered so that the arrays of the files being
+    processed fit in memory_fraction of the available memory. The files of a day have the same grid and timesteps,
+    so the first one is measured
+    """
+    n_workers = min(os.cpu_count(), len(runoff_files)) or 1
+    if not runoff_files:
+        return n_workers
+    worker_bytes = runoff_file_memory_bytes(runoff_files[0], grids, time_block_size=time_block_size)
+    if not worker_bytes:
+        return n_workers
+    memory_workers = int(memory_fraction * _available_memory_bytes() // worker_bytes)
+    if memory_workers < n_workers:
+        logging.info(f'Processing {max(memory_workers, 1)} runoff files at once instead of {n_workers}, each needs '
+                     f'about {worker_bytes / 1e6:.0f} MB')
+    return max(min(n_workers, memory_workers), 1)
+
+
+# compiled weights and the stage manifest are inherited by forked workers instead of being pickled for each task
+_GRIDS = {}
+_MANIFEST = None
+
+
+def _create_inflow_files_worker(runoff_file: str, inflow_dir: str, skip_vpus: set, time_block_size: int) -> list:
+    return create_inflow_files_for_runoff(runoff_file, _GRIDS, inflow_dir, skip_vpus, time_block_size, _MANIFEST)
+
+
+def create_inflow_files(runoff_files: list,
+                        configs_dir: str,
+                        inflow_dir: str,
+                        vpus: list = None,
+                        max_workers: int = None,
+                        time_block_size: int = DEFAULT_TIME_BLOCK_SIZE,
+                        manifest=None, ) -> list:
+    """
+    Creates inflow files for every VPU from a set of ensemble runoff files, reading each runoff file once
+
+    Inflow files which already exist for a VPU and ensemble member are not recreated. With a stage manifest, only
+    inflow files recorded in the manifest whose runoff file and weight tables are unchanged are kept, so partial
+    files left by a crash are rewritten. Runoff files with nothing left to write are not read.
+
+    Args:
+        runoff_files (list): Paths to ensemble runoff files named {ensemble}.*.nc
+        configs_dir (str): Path to the directory of VPU config directories
+        inflow_dir (str): Path to the directory to save inflow files
+        vpus (list): VPU numbers to create inflows for. Defaults to every directory in configs_dir
+        max_workers (int): Number of runoff files processed in parallel. Defaults to the number of CPUs, lowered so
+            that the runoff arrays of the workers fit in memory, see default_max_workers
+        time_block_size (int): Number of runoff timesteps decoded from the full grid at a time
+        manifest (StageManifest): Stage manifest of the day used to skip and record inflow files
+
+    Returns:
+        list: Paths to the inflow files written
+    """
+    global _MANIFEST
+    os.makedirs(inflow_dir, exist_ok=True)
+    _GRIDS.clear()
+    _GRIDS.update(compile_weight_matrices(configs_dir, vpus))
+    _MANIFEST = manifest
+    vpu_inputs = vpu_input_files(_GRIDS)
+
+    # m3_{vpu}_{start}_{end}_{ensemble}.nc
+    existing = [os.path.basename(x).replace('.nc', '').split('_')
+                for x in glob.glob(os.path.join(inflow_dir, 'm3_*.nc'))]
+    existing = {(x[1], x[-1]) for x in existing if len(x) == 5}
+    tasks = []
+    for runoff_file in runoff_files:
+        ensemble_number = os.path.basename(runoff_file).split('.')[0]
+        if manifest is None:
+            skip_vpus = {vpu for vpu, ens in existing if ens == ensemble_number}
+        else:
+            skip_vpus = {vpu for vpu, inputs in vpu_inputs.items()
+                         if manifest.is_complete('inflows', f'{vpu}_{ensemble_number}', [runoff_file, *inputs])}
+        if set(vpu_inputs) - skip_vpus:
+            tasks.append((runoff_file, skip_vpus))
+    logging.info(f'{len(tasks)} of {len(runoff_files)} runoff files have inflow files left to write')
+
+    if max_workers is None:
+        max_workers = default_max_workers([runoff_file for runoff_file, _ in tasks], _GRIDS, time_block_size)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [
+            executor.submit(_create_inflow_files_worker, runoff_file, inflow_dir, skip_vpus, time_block_size)
+            for runoff_file, skip_vpus in tasks
+        ]
+        return [inflow_file for future in futures for inflow_file in future.result()]
@@ -0,0 +1,334 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
+
+METRICS_FILE_NAME = 'metrics.jsonl'
+PROMETHEUS_PREFIX = 'forecast_stage'
+# metrics summed per stage and VPU in the prometheus export and the summary
+METRICS = ('wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'read_bytes', 'write_bytes', 'files_written',
+           'output_bytes', )
+
+
+def metrics_path(ymd: str = None, log_dir: str = None) -> str or None:
+    if log_dir is None and ymd is not None:
+        log_dir = os.path.join(FORECASTS_DIR, ymd, 'logs')
+    return os.path.join(log_dir, METRICS_FILE_NAME) if log_dir else None
+
+
+def _io_counters() -> dict:
+    # bytes which reached the storage layer including reaped child processes, only available on linux
+    counters = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def _usage() -> dict:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss_scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'cpu_seconds': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        'peak_rss_bytes': own.ru_maxrss * rss_scale,
+        'children_peak_rss_bytes': children.ru_maxrss * rss_scale,
+    }
+
+
+def _high_water_mark() -> int or None:
+    # VmHWM is the peak RSS of this process since it started or since the peak was last reset. Unlike ru_maxrss it is
+    # not carried over from the parent through fork and exec, only available on linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_high_water_mark() -> bool:
+    # writing 5 to clear_refs sets VmHWM to the current RSS, linux 4.0 or later
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# the stages measured in this process which have not finished, the peak each reached before VmHWM was last reset
+_OPEN_STAGES = {}
+_PEAK_LOCK = threading.Lock()
+
+
+def _start_peak(key: int) -> bool:
+    """
+    Resets the peak RSS of the process for a stage starting, keeping the peak the stages already running reached
+
+    Returns:
+        bool: False if the peak cannot be reset, the stage then reports the peak of the process so far
+    """
+    with _PEAK_LOCK:
+        high_water_mark = _high_water_mark()
+        if high_water_mark is None or not _reset_high_water_mark():
+            return False
+        for open_key in _OPEN_STAGES:
+            _OPEN_STAGES[open_key] = max(_OPEN_STAGES[open_key], high_water_mark)
+        _OPEN_STAGES[key] = 0
+        return True
+
+
+def _end_peak(key: int) -> int:
+    with _PEAK_LOCK:
+        return max(_OPEN_STAGES.pop(key), _high_water_mark() or 0)
+
+
+def _output_files(patterns: list, since: float) -> tuple:
+    files = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        files.update(x for x in matches if os.path.isfile(x) and os.path.getmtime(x) >= since)
+    return len(files), sum(os.path.getsize(x) for x in files)
+
+
+def write_record(record: dict, path: str) -> None:
+    """
+    Appends one JSON line with a single write so that concurrent stages do not interleave their records
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+class Stage:
+    """
+    Measurements of one stage, updated by the stage() context manager when the stage finishes
+    """
+
+    def __init__(self, name: str, ymd: str = None, vpu: str = None, ensemble: str = None, outputs: list = None):
+        self.record = {'stage': name, 'ymd': ymd, 'vpu': vpu, 'ensemble': ensemble, 'host': socket.gethostname(),
+                       'pid': os.getpid()}
+        self.outputs = list(outputs or [])
+        self.status = None
+        self.extra = {}
+        # peak RSS of a child process measured on its own, see run_command
+        self.child_peak_rss_bytes = 0
+
+    def add(self, **values) -> None:
+        """
+        Adds stage specific values to the record, e.g. the number of reaches processed
+        """
+        self.extra.update(values)
+
+
+@contextlib.contextmanager
+def stage(name: str, ymd: str = None, vpu: str = None, ensemble: str = None, outputs: list = None,
+          log_dir: str = None):
+    """
+    Measures a stage of the workflow and appends the measurements to FORECASTS_DIR/ymd/logs/metrics.jsonl
+
+    Records wall and CPU time, peak RSS, bytes read from and written to storage, and the number and size of files
+    matching the outputs glob patterns which were written during the stage. CPU time and I/O include child processes
+    which finished during the stage.
+
+    Peak RSS is the peak of the process during the stage, read from VmHWM after resetting it when the stage starts, so
+    it does not include earlier work of a long lived process. If a child process which finished during the stage set a
+    new peak for the children of the process, the larger of the two is recorded. Where VmHWM cannot be reset, the
+    peak of the process so far is recorded.
+
+    Args:
+        name (str): Stage name, e.g. 'maptables'
+        ymd (str): Year, month, and day in YYYYMMDD format
+        vpu (str): VPU number, if the stage handles one VPU
+        ensemble (str): Ensemble member, if the stage handles one member
+        outputs (list): Glob patterns of the files the stage writes
+        log_dir (str): Directory of the metrics file. Defaults to FORECASTS_DIR/ymd/logs
+
+    Yields:
+        Stage: The stage, whose add method records extra values
+    """
+    current = Stage(name, ymd, vpu, ensemble, outputs)
+    start_time = time.time()
+    start_perf = time.perf_counter()
+    start_usage = _usage()
+    start_io = _io_counters()
+    stage_peak = _start_peak(id(current))
+    status = 'succeeded'
+    try:
+        yield current
+    except BaseException as e:
+        status = 'failed' if not isinstance(e, SystemExit) or e.code not in (0, None) else 'succeeded'
+        raise
+    finally:
+        usage = _usage()
+        io = _io_counters()
+        peak_rss_bytes = _end_peak(id(current)) if stage_peak else usage['peak_rss_bytes']
+        if usage['children_peak_rss_bytes'] > start_usage['children_peak_rss_bytes']:
+            peak_rss_bytes = max(peak_rss_bytes, usage['children_peak_rss_bytes'])
+        peak_rss_bytes = max(peak_rss_bytes, current.child_peak_rss_bytes)
+        files_written, output_bytes = _output_files(current.outputs, start_time)
+        record = {
+            **current.record,
+            'status': current.status or status,
+            'start': datetime.datetime.fromtimestamp(start_time, datetime.UTC).isoformat(),
+            'wall_seconds': round(time.perf_counter() - start_perf, 3),
+            'cpu_seconds': round(usage['cpu_seconds'] - start_usage['cpu_seconds'], 3),
+            'peak_rss_mb': round(peak_rss_bytes / 1e6, 1),
+            'read_bytes': io['read_bytes'] - start_io['read_bytes'],
+            'write_bytes': io['write_bytes'] - start_io['write_bytes'],
+            'files_written': files_written,
+            'output_bytes': output_bytes,
+            **current.extra,
+        }
+        path = metrics_path(ymd, log_dir)
+        if path:
+            write_record(record, path)
+        logging.debug(json.dumps(record))
+
+
+def run_command(command: list, name: str, ymd: str = None, vpu: str = None, ensemble: str = None,
+                outputs: list = None, log_dir: str = None) -> int:
+    """
+    Runs a command as a measured stage, e.g. a shell stage of suites/workflow.sh
+
+    The peak RSS of the command is its own, from wait4, rather than the largest of every child this process waited
+    for. It includes the RSS this process had when it forked the command, which is small.
+
+    Returns:
+        int: The exit code of the command
+    """
+    with stage(name, ymd, vpu, ensemble, outputs, log_dir) as current:
+        process = subprocess.Popen(command)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        current.child_peak_rss_bytes = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        current.add(returncode=process.returncode, command=' '.join(command))
+        if process.returncode != 0:
+            current.status = 'failed'
+    return process.returncode
+
+
+def read_metrics(ymd: str = None, log_dir: str = None) -> list:
+    path = metrics_path(ymd, log_dir)
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def aggregate(records: list, by: tuple = ('stage', 'vpu')) -> dict:
+    """
+    Sums the metrics of the records by stage and VPU (peak RSS is the maximum)
+    """
+    totals = {}
+    for record in records:
+        key = tuple(record.get(x) or '' for x in by)
+        total = totals.setdefault(key, {'count': 0, 'failed': 0, **{x: 0 for x in METRICS}})
+        total['count'] += 1
+        total['failed'] += record.get('status') == 'failed'
+        for metric in METRICS:
+            value = record.get(metric) or 0
+            total[metric] = max(total[metric], value) if metric == 'peak_rss_mb' else total[metric] + value
+    for total in totals.values():
+        for metric in ('wall_seconds', 'cpu_seconds'):
+            total[metric] = round(total[metric], 3)
+    return totals
+
+
+def export_prometheus(ymd: str, output_path: str, log_dir: str = None) -> None:
+    """
+    Writes the metrics of a forecast day as a Prometheus textfile for the node exporter textfile collector
+    """
+    totals = aggregate(read_metrics(ymd, log_dir))
+    lines = []
+    for metric in (*METRICS, 'count', 'failed'):
+        metric_name = f'{PROMETHEUS_PREFIX}_{metric}'
+        lines.append(f'# TYPE {metric_name} gauge')
+        for (stage_name, vpu), total in sorted(totals.items()):
+            lines.append(f'{metric_name}{{ymd="{ymd}",stage="{stage_name}",vpu="{vpu}"}} {total[metric]}')
+    # written to a temporary file and renamed so the collector never reads a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix='.prom.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, output_path)
+
+
+def summarize(ymd: str, compare_ymd: str = None, top: int = 10) -> dict:
+    """
+    Lists the stages and stage VPU pairs which took the most time, and the change from another day if given
+    """
+    stages = aggregate(read_metrics(ymd), by=('stage',))
+    vpus = aggregate(read_metrics(ymd), by=('stage', 'vpu'))
+    previous = aggregate(read_metrics(compare_ymd), by=('stage',)) if compare_ymd else {}
+    summary = {'ymd': ymd, 'stages': [], 'slowest': []}
+    for (stage_name, ), total in sorted(stages.items(), key=lambda x: -x[1]['wall_seconds']):
+        entry = {'stage': stage_name, **total}
+        if (stage_name, ) in previous and previous[(stage_name, )]['wall_seconds']:
+            entry['wall_change'] = round(total['wall_seconds'] / previous[(stage_name, )]['wall_seconds'] - 1, 3)
+        summary['stages'].append(entry)
+    for (stage_name, vpu), total in sorted(vpus.items(), key=lambda x: -x[1]['wall_seconds'])[:top]:
+        summary['slowest'].append({'stage': stage_name, 'vpu': vpu, **total})
+    return summary
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run a command as a measured stage')
+    run_parser.add_argument('--stage', type=str, required=True, help='Stage name')
+    run_parser.add_argument('--ymd', type=str, required=True, help='Year, month, and day in YYYYMMDD format')
+    run_parser.add_argument('--vpu', type=str, required=False, default=None, help='VPU number')
+    run_parser.add_argument('--ensemble', type=str, required=False, default=None, help='Ensemble member')
+    run_parser.add_argument('--outputs', type=str, nargs='*', default=None,
+                            help='Glob patterns of the files the command writes')
+    run_parser.add_argument('cmd', nargs=argparse.REMAINDER, help='Command to run after --')
+
+    prometheus_parser = subparsers.add_parser('prometheus', help='Export the metrics of a day as a Prometheus textfile')
+    prometheus_parser.add_argument('--ymd', type=str, required=True, help='Year, month, and day in YYYYMMDD format')
+    prometheus_parser.add_argument('--output', type=str, required=True, help='Path of the .prom file')
+
+    summary_parser = subparsers.add_parser('summary', help='Print the slowest stages and VPUs of a day')
+    summary_parser.add_argument('--ymd', type=str, required=True, help='Year, month, and day in YYYYMMDD format')
+    summary_parser.add_argument('--compare', type=str, required=False, default=None,
+                                help='Previous day to compare the stage times to')
+    summary_parser.add_argument('--top', type=int, required=False, default=10,
+                                help='Number of slowest stage and VPU pairs listed')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if not cmd:
+            parser.error('give the command to run after --')
+        sys.exit(run_command(cmd, args.stage, args.ymd, args.vpu, args.ensemble, args.outputs))
+    elif args.command == 'prometheus':
+        export_prometheus(args.ymd, args.output)
+    else:
+        print(json.dumps(summarize(args.ymd, args.compare, args.top), indent=2))
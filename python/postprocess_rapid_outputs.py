@@ -0,0 +1,363 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import logging
+import os
+import sys
+
+import netCDF4 as nc
+import numpy as np
+from natsort import natsorted
+
+from instrumentation import stage
+from return_periods import RETURN_PERIODS, load_thresholds
+from stage_manifest import StageManifest
+
+# optional, exceedance fractions of the return periods are added to the ensemble statistics when this is set
+RETURN_PERIODS_DIR = os.environ.get('RETURN_PERIODS_DIR')
+
+# number of river reaches read from each ensemble member at a time
+DEFAULT_BLOCK_SIZE = 50_000
+# the ensemble statistics hold every member of a block in memory, so blocks are made smaller to stay under this size
+STATS_BLOCK_BYTES = 256e6
+
+# variables which are identical for every ensemble member and are copied instead of averaged
+NON_AVERAGED_VARIABLES = ('lat', 'lon', )
+# variable summarized by the ensemble statistics
+STATS_VARIABLE = 'Qout'
+PERCENTILES = (25, 50, 75)
+
+
+def find_ensemble_member_files(outputs_directory: str, vpu: str or int) -> list:
+    """
+    Lists the Qout files for ensemble members 1-51 of a VPU in natural sort order
+
+    Args:
+        outputs_directory (str): Path to the directory of RAPID outputs for a forecast date
+        vpu (str or int): VPU number
+
+    Returns:
+        list: Paths to the Qout_{vpu}_*.nc files, excluding the high resolution member 52
+    """
+    member_files = glob.glob(os.path.join(outputs_directory, f'Qout_{vpu}_*.nc'))
+    member_files = [x for x in member_files if not x.endswith('_52.nc')]
+    return natsorted(member_files)
+
+
+def _is_averaged(variable: nc.Variable) -> bool:
+    return (
+            'rivid' in variable.dimensions
+            and np.issubdtype(variable.dtype, np.floating)
+            and variable.name not in NON_AVERAGED_VARIABLES
+            and variable.name not in variable.dimensions
+    )
+
+
+def _is_coordinate(variable: nc.Variable) -> bool:
+    return variable.dimensions == (variable.name,)
+
+
+def _create_variable(ds: nc.Dataset, source: nc.Variable, dimensions: tuple, name: str = None) -> nc.Variable:
+    kwargs = {}
+    if ds.data_model.startswith('NETCDF4'):
+        filters = source.filters() or {}
+        kwargs = {'zlib': bool(filters.get('zlib')), 'complevel': filters.get('complevel', 4),
+                  'shuffle': bool(filters.get('shuffle'))}
+    fill_value = getattr(source, '_FillValue', None)
+    var = ds.createVariable(name or source.name, source.dtype, dimensions, fill_value=fill_value, **kwargs)
+    var.setncatts({k: source.getncattr(k) for k in source.ncattrs() if k != '_FillValue'})
+    return var
+
+
+def _prepare_outputs(template: nc.Dataset, avg_ds: nc.Dataset, cat_ds: nc.Dataset, n_members: int) -> None:
+    history = f'{datetime.datetime.now(datetime.UTC)}: ensemble reduction by {os.path.basename(__file__)}'
+    for ds in (avg_ds, cat_ds):
+        ds.setncatts({k: template.getncattr(k) for k in template.ncattrs()})
+        ds.history = f'{history}\n{template.history}' if 'history' in template.ncattrs() else history
+        for name, dim in template.dimensions.items():
+            ds.createDimension(name, None if dim.isunlimited() else len(dim))
+    cat_ds.createDimension('ensemble', n_members)
+
+    for name, var in template.variables.items():
+        _create_variable(avg_ds, var, var.dimensions)
+        # ncecat convention: coordinate variables are copied, everything else gains a leading ensemble dimension
+        _create_variable(cat_ds, var, var.dimensions if _is_coordinate(var) else ('ensemble', *var.dimensions))
+
+
+def _prepare_stats_output(template: nc.Dataset, stats_ds: nc.Dataset, n_members: int, exceedance: bool) -> None:
+    history = f'{datetime.datetime.now(datetime.UTC)}: ensemble statistics by {os.path.basename(__file__)}'
+    stats_ds.setncatts({k: template.getncattr(k) for k in template.ncattrs()})
+    stats_ds.history = f'{history}\n{template.history}' if 'history' in template.ncattrs() else history
+    stats_ds.ensemble_members = n_members
+    for name, dim in template.dimensions.items():
+        stats_ds.createDimension(name, None if dim.isunlimited() else len(dim))
+    for name, var in template.variables.items():
+        if not _is_averaged(var):
+            _create_variable(stats_ds, var, var.dimensions)
+
+    source = template[STATS_VARIABLE]
+    stats_ds.createDimension('percentile', len(PERCENTILES))
+    stats_ds.createVariable('percentile', 'i4', ('percentile', ))[:] = PERCENTILES
+    var = _create_variable(stats_ds, source, ('percentile', *source.dimensions), f'{STATS_VARIABLE}_percentile')
+    var.long_name = f'ensemble percentiles of {STATS_VARIABLE}'
+    var = _create_variable(stats_ds, source, source.dimensions, f'{STATS_VARIABLE}_max')
+    var.long_name = f'ensemble maximum of {STATS_VARIABLE}'
+    if not exceedance:
+        return
+    stats_ds.createDimension('return_period', len(RETURN_PERIODS))
+    stats_ds.createVariable('return_period', 'i4', ('return_period', ))[:] = RETURN_PERIODS
+    var = _create_variable(stats_ds, source, ('return_period', *source.dimensions), f'{STATS_VARIABLE}_exceedance')
+    var.setncatts({'long_name': 'fraction of ensemble members exceeding the return period flow', 'units': '1'})
+
+
+def ensemble_statistics(stack: np.ndarray, thresholds: np.ndarray = None, rivid_axis: int = -1) -> dict:
+    """
+    Calculates the percentiles, the maximum and the fraction of members exceeding each return period flow of an
+    ensemble with one sort of the members
+
+    Percentiles are interpolated linearly between the sorted members, the same as np.percentile.
+
+    Args:
+        stack (np.ndarray): Values of each member stacked on the first axis. It is sorted in place
+        thresholds (np.ndarray): Return period flows of shape (len(RETURN_PERIODS), number of rivids), or None
+        rivid_axis (int): Axis of the rivids in the values of one member
+
+    Returns:
+        dict: 'percentile' of shape (len(PERCENTILES), ...), 'max', and 'exceedance' of shape
+            (len(RETURN_PERIODS), ...) if thresholds are given
+    """
+    n_members = stack.shape[0]
+    stack.sort(axis=0)
+    positions = np.asarray(PERCENTILES) / 100 * (n_members - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, n_members - 1)
+    weights = (positions - lower).reshape(-1, *[1] * (stack.ndim - 1)).astype(stack.dtype)
+    stats = {
+        'percentile': stack[lower] + (stack[upper] - stack[lower]) * weights,
+        'max': stack[-1],
+    }
+    if thresholds is not None:
+        shape = [1] * (stack.ndim - 1)
+        shape[rivid_axis] = thresholds.shape[1]
+        stats['exceedance'] = np.stack([
+            np.count_nonzero(stack > threshold.reshape(shape), axis=0) for threshold in thresholds
+        ]).astype(stack.dtype) / n_members
+    return stats
+
+
+def reduce_ensemble_members(member_files: list,
+                            avg_output_file: str,
+                            concat_output_file: str,
+                            block_size: int = DEFAULT_BLOCK_SIZE,
+                            stats_output_file: str = None,
+                            return_periods_file: str = None, ) -> None:
+    """
+    Calculates the ensemble average and the ensemble concatenation of RAPID outputs in a single read of each member
+
+    Equivalent to `nces --op_typ=avg` followed by `ncecat` and `ncrename -d record,ensemble`. Each member file is
+    read once, in blocks of river reaches, so memory use is bounded by the block size rather than the VPU size.
+    Floating point variables on the rivid dimension (e.g. Qout, Qout_err) are averaged, all other variables are
+    copied from the first member. The ensemble statistics of Qout are calculated from the same reads.
+
+    Args:
+        member_files (list): Paths to the Qout files of each ensemble member, in ensemble order
+        avg_output_file (str): Path to save the ensemble average netCDF
+        concat_output_file (str): Path to save the netCDF with all members stacked on the ensemble dimension
+        block_size (int): Number of river reaches read from each member at a time
+        stats_output_file (str): Path to save the ensemble percentiles, maximum and return period exceedance
+            fractions of Qout, see ensemble_statistics. Not written if None
+        return_periods_file (str): Path to the returnperiods_{vpu}.nc file. The exceedance fractions are left out of
+            the statistics if None
+
+    Returns:
+        None
+    """
+    if not len(member_files):
+        raise FileNotFoundError('No ensemble member files given to reduce')
+
+    avg_tmp_file = f'{avg_output_file}.tmp'
+    cat_tmp_file = f'{concat_output_file}.tmp'
+    stats_tmp_file = f'{stats_output_file}.tmp' if stats_output_file else None
+    tmp_files = [x for x in (avg_tmp_file, cat_tmp_file, stats_tmp_file) if x]
+    members = [nc.Dataset(x, 'r') for x in member_files]
+    try:
+        template = members[0]
+        for member in members:
+            member.set_auto_mask(False)
+        n_rivids = len(template.dimensions['rivid'])
+        rivid_variables = [v for v in template.variables.values() if 'rivid' in v.dimensions]
+        other_variables = [v for v in template.variables.values() if 'rivid' not in v.dimensions]
+        thresholds = None
+        if stats_output_file:
+            stats_source = template[STATS_VARIABLE]
+            stats_rivid_axis = stats_source.dimensions.index('rivid')
+            n_values = int(np.prod(stats_source.shape)) // max(n_rivids, 1)
+            block_size = min(block_size, max(int(STATS_BLOCK_BYTES // (stats_source.dtype.itemsize * n_values *
+                                                                        len(members))), 1))
+            if return_periods_file:
+                thresholds = load_thresholds(return_periods_file, np.asarray(template['rivid'][:]))
+
+        with (
+            nc.Dataset(avg_tmp_file, 'w', format=template.data_model) as avg_ds,
+            nc.Dataset(cat_tmp_file, 'w', format=template.data_model) as cat_ds,
+            (nc.Dataset(stats_tmp_file, 'w', format=template.data_model) if stats_output_file
+             else contextlib.nullcontext()) as stats_ds,
+        ):
+            _prepare_outputs(template, avg_ds, cat_ds, len(members))
+            avg_ds.set_auto_mask(False)
+            cat_ds.set_auto_mask(False)
+            if stats_ds is not None:
+                _prepare_stats_output(template, stats_ds, len(members), thresholds is not None)
+                stats_ds.set_auto_mask(False)
+
+            for var in other_variables:
+                avg_ds[var.name][...] = var[...]
+                if stats_ds is not None:
+                    stats_ds[var.name][...] = var[...]
+                if _is_coordinate(var):
+                    cat_ds[var.name][...] = var[...]
+                    continue
+                for ens_idx, member in enumerate(members):
+                    cat_ds[var.name][ens_idx, ...] = member[var.name][...]
+
+            for start in range(0, n_rivids, block_size):
+                end = min(start + block_size, n_rivids)
+                logging.debug(f'Reducing rivids {start}-{end} of {n_rivids}')
+                for var in rivid_variables:
+                    rivid_axis = var.dimensions.index('rivid')
+                    block = tuple(slice(start, end) if i == rivid_axis else slice(None) for i in range(var.ndim))
+                    if _is_coordinate(var) or not _is_averaged(var):
+                        values = var[block]
+                        avg_ds[var.name][block] = values
+                        if stats_ds is not None:
+                            stats_ds[var.name][block] = values
+                        if _is_coordinate(var):
+                            cat_ds[var.name][block] = values
+                            continue
+                    stack = None
+                    if stats_ds is not None and var.name == STATS_VARIABLE:
+                        block_shape = tuple(end - start if i == rivid_axis else n for i, n in enumerate(var.shape))
+                        stack = np.empty((len(members), *block_shape), dtype=var.dtype)
+                    total = None
+                    for ens_idx, member in enumerate(members):
+                        values = member[var.name][block]
+                        cat_ds[var.name][(ens_idx, *block)] = values
+                        if stack is not None:
+                            stack[ens_idx] = values
+                        if not _is_averaged(var):
+                            continue
+                        total = values.astype(np.float64) if total is None else total + values
+                    if total is not None:
+                        avg_ds[var.name][block] = (total / len(members)).astype(var.dtype)
+                    if stack is not None:
+                        block_thresholds = None if thresholds is None else thresholds[:, start:end]
+                        stats = ensemble_statistics(stack, block_thresholds, stats_rivid_axis)
+                        stats_ds[f'{var.name}_percentile'][(slice(None), *block)] = stats['percentile']
+                        stats_ds[f'{var.name}_max'][block] = stats['max']
+                        if 'exceedance' in stats:
+                            stats_ds[f'{var.name}_exceedance'][(slice(None), *block)] = stats['exceedance']
+    except Exception:
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        raise
+    finally:
+        for member in members:
+            member.close()
+
+    os.replace(avg_tmp_file, avg_output_file)
+    os.replace(cat_tmp_file, concat_output_file)
+    if stats_output_file:
+        os.replace(stats_tmp_file, stats_output_file)
+
+
+def postprocess_vpu_outputs(outputs_directory: str,
+                            vpu: str or int,
+                            block_size: int = DEFAULT_BLOCK_SIZE,
+                            remove_members: bool = True,
+                            manifest: StageManifest = None,
+                            stats: bool = True,
+                            return_periods_file: str = None, ) -> None:
+    """
+    Drop-in replacement for bash/postprocess_rapid_outputs.sh
+
+    Writes nces_avg_{vpu}.nc, nces_stats_{vpu}.nc and Qout_{vpu}.nc for ensemble members 1-51 then deletes the
+    individual member files.
+
+    Args:
+        outputs_directory (str): Path to the directory of RAPID outputs for a forecast date
+        vpu (str or int): VPU number
+        block_size (int): Number of river reaches read from each member at a time
+        remove_members (bool): Delete the Qout_{vpu}_*.nc files for members 1-51 after a successful reduction
+        manifest (StageManifest): Stage manifest of the day. The VPU is skipped if it is complete and recorded after
+        stats (bool): Write the ensemble statistics to nces_stats_{vpu}.nc
+        return_periods_file (str): Path to the return periods of the VPU for the exceedance fractions. Defaults to
+            RETURN_PERIODS_DIR/returnperiods_{vpu}.nc if it exists
+
+    Returns:
+        None
+    """
+    logging.info(f'Looking for rapid outputs in directory: {outputs_directory}')
+    member_files = find_ensemble_member_files(outputs_directory, vpu)
+    avg_output_file = os.path.join(outputs_directory, f'nces_avg_{vpu}.nc')
+    concat_output_file = os.path.join(outputs_directory, f'Qout_{vpu}.nc')
+    stats_output_file = os.path.join(outputs_directory, f'nces_stats_{vpu}.nc') if stats else None
+    if not stats:
+        return_periods_file = None
+    elif return_periods_file is None and RETURN_PERIODS_DIR:
+        default_file = os.path.join(RETURN_PERIODS_DIR, f'returnperiods_{vpu}.nc')
+        return_periods_file = default_file if os.path.exists(default_file) else None
+    inputs = [*member_files, return_periods_file] if return_periods_file else member_files
+    if manifest is not None:
+        if manifest.is_complete('postprocess', vpu, inputs):
+            logging.info(f'VPU number {vpu} is already postprocessed')
+            return
+        # members deleted by the last reduction have to be routed again before the VPU can be reduced again
+        lost_files = manifest.invalidate_lost('postprocess', vpu, member_files)
+        if lost_files:
+            raise FileNotFoundError(f'Rerun RAPID for the ensemble members of VPU {vpu} deleted by the last '
+                                    f'postprocessing: {lost_files}')
+
+    logging.info(f'Calculating ensemble mean and concatenating {len(member_files)} ensembles for VPU number {vpu}')
+    reduce_ensemble_members(member_files, avg_output_file, concat_output_file, block_size=block_size,
+                            stats_output_file=stats_output_file, return_periods_file=return_periods_file)
+    if manifest is not None:
+        outputs = [x for x in (avg_output_file, concat_output_file, stats_output_file) if x]
+        manifest.record('postprocess', vpu, inputs, outputs, consumed=member_files if remove_members else None)
+
+    if not remove_members:
+        return
+    logging.info(f'Removing individual ensemble files for VPU number {vpu}')
+    for member_file in member_files:
+        os.remove(member_file)
+    return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputs', type=str, required=True,
+                        help='Path to directory of RAPID outputs for a forecast date', )
+    parser.add_argument('--vpu', type=str, required=True,
+                        help='VPU number', )
+    parser.add_argument('--blocksize', type=int, required=False, default=DEFAULT_BLOCK_SIZE,
+                        help='Number of river reaches read from each ensemble member at a time', )
+    parser.add_argument('--keepmembers', action='store_true', default=False,
+                        help='Do not delete the individual ensemble member files', )
+    parser.add_argument('--nostats', action='store_true', default=False,
+                        help='Do not write the ensemble statistics to nces_stats_{vpu}.nc', )
+    parser.add_argument('--returnperiods', type=str, required=False, default=None,
+                        help='Path to the return periods of the VPU for the exceedance fractions. Defaults to '
+                             'RETURN_PERIODS_DIR/returnperiods_{vpu}.nc', )
+    args = parser.parse_args()
+
+    # the outputs directory is FORECASTS_DIR/ymd/outputs
+    forecast_dir = os.path.dirname(os.path.abspath(args.outputs))
+    outputs = [os.path.join(args.outputs, f'{x}_{args.vpu}.nc') for x in ('Qout', 'nces_avg', 'nces_stats')]
+    with stage('postprocess', ymd=os.path.basename(forecast_dir), vpu=args.vpu,
+               log_dir=os.path.join(forecast_dir, 'logs'), outputs=outputs):
+        postprocess_vpu_outputs(args.outputs, args.vpu, block_size=args.blocksize, remove_members=not args.keepmembers,
+                                manifest=StageManifest.for_day(forecast_dir=forecast_dir), stats=not args.nostats,
+                                return_periods_file=args.returnperiods)
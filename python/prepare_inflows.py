@@ -4,9 +4,12 @@ import logging
 import os
 import sys
 
-from basininflow import create_inflow_file
 from natsort import natsorted
 
+from inflow_engine import create_inflow_files
+from instrumentation import stage
+from stage_manifest import StageManifest
+
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 CONFIGS_DIR = os.environ['CONFIGS_DIR']
@@ -22,8 +25,20 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--vpu',
-        help='VPU number',
-        required=True,
+        help='VPU number. If not given, inflows are created for every VPU in CONFIGS_DIR in one batch',
+        required=False,
+    )
+    parser.add_argument(
+        '--ensemble',
+        help='Only create inflows for this ensemble member',
+        required=False,
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of runoff files processed in parallel in batch mode. Defaults to the number of CPUs, lowered so '
+             'that the runoff arrays of the workers fit in half the available memory',
+        type=int,
+        required=False,
     )
     args = parser.parse_args()
     ymd = args.ymd
@@ -32,25 +47,44 @@ if __name__ == '__main__':
     # search for runoff files in runoff/YMD
     RUNOFFS_DIR = os.path.join(RUNOFFS_DIR, ymd)
     runoff_files = natsorted(glob.glob(os.path.join(RUNOFFS_DIR, '*.nc')))
+    if args.ensemble is not None:
+        runoff_files = [x for x in runoff_files if os.path.basename(x).split('.')[0] == args.ensemble]
 
     inflow_dir = os.path.join(FORECASTS_DIR, ymd, 'inflows')
-    vpu_config_dir = os.path.join(CONFIGS_DIR, vpu)
 
     # make the inflow/YMD directory
     os.makedirs(os.path.join(FORECASTS_DIR, ymd, 'inflows'), exist_ok=True)
 
-    for runoff_file in runoff_files:
-        ensemble_number = os.path.basename(runoff_file).split('.')[0]
-        if len(glob.glob(os.path.join(inflow_dir, f'm3_{vpu}*{ensemble_number}.nc'))):
-            continue
-        create_inflow_file(
-            lsm_data=runoff_file,
-            input_dir=vpu_config_dir,
-            inflow_dir=inflow_dir,
-            y_var='lat',
-            x_var='lon',
-            time_var='time',
-            runoff_var='RO',
-            file_label=ensemble_number,
-            force_positive_runoff=True,
-        )
+    manifest = StageManifest.for_day(ymd)
+
+    with stage('inflows', ymd=ymd, vpu=vpu, ensemble=args.ensemble,
+               outputs=[os.path.join(inflow_dir, f'm3_{vpu or "*"}_*_{args.ensemble or "*"}.nc')]) as inflows_stage:
+        inflows_stage.add(runoff_files=len(runoff_files))
+        if vpu is None:
+            create_inflow_files(runoff_files, CONFIGS_DIR, inflow_dir, max_workers=args.workers, manifest=manifest)
+        else:
+            # only the single VPU mode uses basininflow
+            from basininflow import create_inflow_file
+
+            vpu_config_dir = os.path.join(CONFIGS_DIR, vpu)
+            vpu_inputs = [os.path.join(vpu_config_dir, 'comid_lat_lon_z.csv'),
+                          *natsorted(glob.glob(os.path.join(vpu_config_dir, 'weight_*.csv')))]
+
+            # completed members are found in the manifest instead of globbing the inflow directory for every member
+            for runoff_file in runoff_files:
+                ensemble_number = os.path.basename(runoff_file).split('.')[0]
+                if manifest.is_complete('inflows', f'{vpu}_{ensemble_number}', [runoff_file, *vpu_inputs]):
+                    continue
+                create_inflow_file(
+                    lsm_data=runoff_file,
+                    input_dir=vpu_config_dir,
+                    inflow_dir=inflow_dir,
+                    y_var='lat',
+                    x_var='lon',
+                    time_var='time',
+                    runoff_var='RO',
+                    file_label=ensemble_number,
+                    force_positive_runoff=True,
+                )
+                inflow_files = glob.glob(os.path.join(inflow_dir, f'm3_{vpu}_*_{ensemble_number}.nc'))
+                manifest.record('inflows', f'{vpu}_{ensemble_number}', [runoff_file, *vpu_inputs], inflow_files)
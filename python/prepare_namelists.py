@@ -1,15 +1,27 @@
 import argparse
+import datetime
 import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import netCDF4
-import pandas as pd
 from natsort import natsorted
 
+from instrumentation import stage
+from stage_manifest import StageManifest
+from subbasins import (PARTITION_FILE_NAME, SUBBASINS_DIR, config_rivids, group_directory, is_current_subset,
+                       partition_dir, subset_rivid_file, vpu_partition)
+from vpu_config_index import vpu_config_metadata
+
 FORECASTS_DIR = os.environ['FORECASTS_DIR']
 CONFIGS_DIR = os.environ['CONFIGS_DIR']
 INITS_DIR = os.environ['INITS_DIR']
 
+# config files every namelist points RAPID at
+CONFIG_FILES = ('k.csv', 'x.csv', 'riv_bas_id.csv', 'rapid_connect.csv')
+# days before the forecast date to look for a qinit file
+QINIT_MAX_AGE_DAYS = 10
+
 
 def rapid_namelist(
         namelist_save_path: str,
@@ -78,6 +90,10 @@ def rapid_namelist(
     assert routing_type in [1, 2, 3, ], 'routing_type must be 1, 2, 3, or 4'
     assert opt_phi in [1, 2], 'opt_phi must be 1, or 2'
 
+    if any([x is None for x in (reaches_in_rapid_connect, max_upstream_reaches, reaches_total)]):
+        # only needed without the reach counts of the config index
+        import pandas as pd
+
     if any([x is None for x in (reaches_in_rapid_connect, max_upstream_reaches)]):
         df = pd.read_csv(rapid_connect_file, header=None)
         reaches_in_rapid_connect = df.shape[0]
@@ -141,6 +157,68 @@ def rapid_namelist(
         f.write(namelist_string)
 
 
+def check_config_files(vpu_directory: str) -> None:
+    for x in CONFIG_FILES:
+        x = os.path.join(vpu_directory, x)
+        assert os.path.exists(x), f'{x} does not exist'
+
+
+def inflow_time_steps(inflow_file: str) -> tuple:
+    """
+    Reads the timestep and the total time of an inflow file in seconds from its time_bnds
+
+    Returns:
+        tuple: The timestep and the total time
+    """
+    with netCDF4.Dataset(inflow_file) as ds:
+        time_step_inflows = ds['time_bnds'][0, 1] - ds['time_bnds'][0, 0]
+        time_total_inflow = ds['time_bnds'][-1, 1] - ds['time_bnds'][0, 0]
+    return time_step_inflows, time_total_inflow
+
+
+def find_qinit_files(ymd: str, vpus: list) -> dict:
+    """
+    Finds the most recent qinit file of each VPU from up to QINIT_MAX_AGE_DAYS days before ymd
+
+    INITS_DIR is listed once and each of the init date directories in that window at most once, instead of
+    checking for the file of every VPU and day.
+
+    Returns:
+        dict: The path to the qinit file of each VPU which has one
+    """
+    forecast_date = datetime.datetime.strptime(ymd, '%Y%m%d')
+    available_qinit_dates = {x.name for x in os.scandir(INITS_DIR) if x.is_dir()} if os.path.isdir(INITS_DIR) else set()
+    qinit_files = {}
+    for day in range(QINIT_MAX_AGE_DAYS + 1):
+        possible_init_date = (forecast_date - datetime.timedelta(days=day)).strftime('%Y%m%d')
+        if possible_init_date not in available_qinit_dates:
+            continue
+        file_names = set(os.listdir(os.path.join(INITS_DIR, possible_init_date)))
+        for vpu in vpus:
+            file_name = f'qinit_{vpu}_{possible_init_date}.nc'
+            if vpu not in qinit_files and file_name in file_names:
+                qinit_files[vpu] = os.path.join(INITS_DIR, possible_init_date, file_name)
+        if len(qinit_files) == len(vpus):
+            break
+    return qinit_files
+
+
+def inflow_files_by_member(inflows_dir: str, vpus: list = None) -> dict:
+    """
+    Lists the m3_{vpu}_{start}_{end}_{ensemble}.nc inflow files of a day
+
+    Returns:
+        dict: The inflow file of each VPU keyed by ensemble member
+    """
+    inflow_files = {}
+    for inflow_file in natsorted(glob.glob(os.path.join(inflows_dir, 'm3_*.nc'))):
+        name_parts = os.path.basename(inflow_file).replace('.nc', '').split('_')
+        vpu, ensemble_number = name_parts[1], name_parts[-1]
+        if vpus is None or vpu in vpus:
+            inflow_files.setdefault(ensemble_number, {})[vpu] = inflow_file
+    return inflow_files
+
+
 def create_rapid_namelist(vpu_directory: str,
                           inflow_file: str,
                           namelist_directory: str,
@@ -148,15 +226,27 @@ def create_rapid_namelist(vpu_directory: str,
                           file_label: str = None,
                           end_date: str = None,
                           qinit_file: str = None,
-                          qfinal_file: str = None, ) -> None:
+                          qfinal_file: str = None,
+                          inflow_times: tuple = None,
+                          config_metadata: dict = None, ) -> None:
+    """
+    Writes the namelist of one VPU and inflow file
+
+    Args:
+        inflow_times (tuple): The inflow timestep and total time from inflow_time_steps. Read from the inflow file if
+            not given
+        config_metadata (dict): The reach counts from vpu_config_metadata. If given, the config files are assumed to
+            have been checked already by check_config_files
+    """
     vpu_code = os.path.basename(vpu_directory)
     k_file = os.path.join(vpu_directory, f'k.csv')
     x_file = os.path.join(vpu_directory, f'x.csv')
     riv_bas_id_file = os.path.join(vpu_directory, f'riv_bas_id.csv')
     rapid_connect_file = os.path.join(vpu_directory, f'rapid_connect.csv')
 
-    for x in (k_file, x_file, riv_bas_id_file, rapid_connect_file):
-        assert os.path.exists(x), f'{x} does not exist'
+    if config_metadata is None:
+        check_config_files(vpu_directory)
+        config_metadata = vpu_config_metadata(vpu_directory)
 
     write_qfinal_file = bool(qfinal_file)
     use_qinit_file = bool(qinit_file)
@@ -178,9 +268,7 @@ def create_rapid_namelist(vpu_directory: str,
     namelist_path = os.path.join(namelist_directory, namelist_file_name)
     qout_path = os.path.join(outputs_directory, qout_file_name)
 
-    with netCDF4.Dataset(inflow_file) as ds:
-        time_step_inflows = ds['time_bnds'][0, 1] - ds['time_bnds'][0, 0]
-        time_total_inflow = ds['time_bnds'][-1, 1] - ds['time_bnds'][0, 0]
+    time_step_inflows, time_total_inflow = inflow_times if inflow_times else inflow_time_steps(inflow_file)
     time_total = time_total_inflow
     timestep_inp_runoff = time_step_inflows
     timestep_calc = time_step_inflows
@@ -200,18 +288,162 @@ def create_rapid_namelist(vpu_directory: str,
                    write_qfinal_file=write_qfinal_file,
                    qfinal_file=qfinal_file,
                    use_qinit_file=use_qinit_file,
-                   qinit_file=qinit_file, )
+                   qinit_file=qinit_file,
+                   reaches_in_rapid_connect=config_metadata['reaches_in_rapid_connect'],
+                   max_upstream_reaches=config_metadata['max_upstream_reaches'],
+                   reaches_total=config_metadata['reaches_total'], )
 
     return
 
 
+def _group_files(vpu: str, code: str, path: str, directory: str) -> str:
+    # m3_{vpu}_... and qinit_{vpu}_... of a group are named after the group code instead of the VPU
+    name = os.path.basename(path)
+    prefix = name.split('_')[0]
+    return os.path.join(directory, name.replace(f'{prefix}_{vpu}_', f'{prefix}_{code}_', 1))
+
+
+def _remove_stale_namelists(namelists_dir: str, vpu: str, ensemble_number: str, split: bool) -> None:
+    # the last time the day ran the VPU may have been routed whole, or in a different number of groups
+    patterns = [f'namelist_{vpu}-g*_{ensemble_number}', *([f'namelist_{vpu}_{ensemble_number}'] if split else [])]
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(namelists_dir, pattern)):
+            os.remove(path)
+
+
+def prepare_vpu_namelists(ymd: str, vpus: list = None, max_workers: int = None,
+                          manifest: StageManifest = None, subbasins: int = None,
+                          subbasin_min_reaches: int = 0) -> list:
+    """
+    Writes the namelists of every VPU and ensemble member of a day from one process
+
+    The inflow files of an ensemble member share the same times in every VPU, so the timestep and total time are read
+    from one inflow file per member. The config files of each VPU are checked once and the qinit files are found
+    with one scan of INITS_DIR. The namelists are written by a pool of threads.
+
+    With subbasins, each VPU with at least subbasin_min_reaches reaches and more than one subnetwork is routed as up
+    to that many RAPID runs of groups of independent subnetworks (see subbasins.py). The inflow and qinit files are
+    subset for each group in inflows/subbasins, the group Qout files are written to outputs/subbasins and merged
+    into the VPU Qout file by subbasins.py merge after RAPID.
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        vpus (list): VPUs to prepare. Defaults to every VPU with inflow files
+        max_workers (int): Number of namelists written at once. Defaults to the number of CPUs
+        manifest (StageManifest): Stage manifest of the day. Skips namelists which are complete and records the rest
+        subbasins (int): Number of groups to route large VPUs in. Defaults to routing every VPU in one run
+        subbasin_min_reaches (int): Only VPUs with at least this many reaches are routed in groups
+
+    Returns:
+        list: The (vpu, ensemble) units which were written
+    """
+    inflows_dir = os.path.join(FORECASTS_DIR, ymd, 'inflows')
+    namelists_dir = os.path.join(FORECASTS_DIR, ymd, 'namelists')
+    outputs_dir = os.path.join(FORECASTS_DIR, ymd, 'outputs')
+    os.makedirs(namelists_dir, exist_ok=True)
+    os.makedirs(outputs_dir, exist_ok=True)
+
+    inflow_files = inflow_files_by_member(inflows_dir, vpus)
+    vpus = natsorted({vpu for member_files in inflow_files.values() for vpu in member_files})
+    qinit_files = find_qinit_files(ymd, vpus)
+    config_metadata = {}
+    partitions = {}
+    for vpu in vpus:
+        check_config_files(os.path.join(CONFIGS_DIR, vpu))
+        config_metadata[vpu] = vpu_config_metadata(os.path.join(CONFIGS_DIR, vpu))
+        if subbasins and subbasins > 1 and config_metadata[vpu]['reaches_total'] >= subbasin_min_reaches:
+            partition = vpu_partition(os.path.join(CONFIGS_DIR, vpu), subbasins)
+            if len(partition['groups']) > 1:
+                partitions[vpu] = partition
+    subbasin_inflows_dir = os.path.join(inflows_dir, SUBBASINS_DIR)
+    subbasin_outputs_dir = os.path.join(outputs_dir, SUBBASINS_DIR)
+    if partitions:
+        os.makedirs(subbasin_inflows_dir, exist_ok=True)
+        os.makedirs(subbasin_outputs_dir, exist_ok=True)
+
+    # the group qinit files checked or written by this run, each is shared by every ensemble member
+    current_group_qinits = set()
+    units = []
+    for ensemble_number, member_files in inflow_files.items():
+        inflow_times = None
+        for vpu, inflow_file in member_files.items():
+            qinit_file = qinit_files.get(vpu)
+            inputs = [inflow_file, *[os.path.join(CONFIGS_DIR, vpu, x) for x in CONFIG_FILES],
+                      *([qinit_file] if qinit_file else [])]
+            codes = [vpu]
+            if vpu in partitions:
+                inputs.append(os.path.join(partition_dir(os.path.join(CONFIGS_DIR, vpu), subbasins),
+                                           PARTITION_FILE_NAME))
+                codes = [group['code'] for group in partitions[vpu]['groups']]
+            outputs = [os.path.join(namelists_dir, f'namelist_{code}_{ensemble_number}') for code in codes]
+            if manifest is not None and manifest.is_complete('namelists', f'{vpu}_{ensemble_number}', inputs,
+                                                             outputs):
+                continue
+            inflow_times = inflow_times or inflow_time_steps(inflow_file)
+            _remove_stale_namelists(namelists_dir, vpu, ensemble_number, vpu in partitions)
+            if vpu not in partitions:
+                runs = [(os.path.join(CONFIGS_DIR, vpu), inflow_file, outputs_dir, qinit_file, config_metadata[vpu])]
+            else:
+                # the netCDF subsets are written here rather than by the threads, netCDF4 is not thread safe
+                runs = []
+                for group in partitions[vpu]['groups']:
+                    config_dir = group_directory(os.path.join(CONFIGS_DIR, vpu), subbasins, group['code'])
+                    group_inflow = _group_files(vpu, group['code'], inflow_file, subbasin_inflows_dir)
+                    subset_rivid_file(inflow_file, group_inflow, config_rivids(config_dir, 'rapid_connect.csv'))
+                    group_qinit = None
+                    if qinit_file:
+                        group_qinit = _group_files(vpu, group['code'], qinit_file, subbasin_inflows_dir)
+                        if group_qinit not in current_group_qinits:
+                            # a group of another number of groups has the same code but not the same reaches
+                            group_rivids = config_rivids(config_dir)
+                            if not is_current_subset(group_qinit, qinit_file, group_rivids):
+                                subset_rivid_file(qinit_file, group_qinit, group_rivids)
+                            current_group_qinits.add(group_qinit)
+                    runs.append((config_dir, group_inflow, subbasin_outputs_dir, group_qinit, group))
+            units.append((vpu, ensemble_number, runs, inflow_times, inputs, outputs))
+
+    def _write(unit):
+        vpu, ensemble_number, runs, inflow_times, *_ = unit
+        for vpu_directory, run_inflow_file, run_outputs_dir, run_qinit_file, run_metadata in runs:
+            create_rapid_namelist(
+                vpu_directory=vpu_directory,
+                inflow_file=run_inflow_file,
+                namelist_directory=namelists_dir,
+                outputs_directory=run_outputs_dir,
+                qinit_file=run_qinit_file,
+                qfinal_file=None,
+                file_label=ensemble_number,
+                inflow_times=inflow_times,
+                config_metadata=run_metadata,
+            )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for unit, _ in zip(units, executor.map(_write, units)):
+            vpu, ensemble_number, _, _, inputs, outputs = unit
+            if manifest is not None:
+                manifest.record('namelists', f'{vpu}_{ensemble_number}', inputs, outputs)
+    return [(vpu, ensemble_number) for vpu, ensemble_number, *_ in units]
+
+
 if __name__ == '__main__':
     """
     Prepare rapid namelist files for a directory of VPU inputs
     """
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--ymd', type=str, required=True)
-    argparser.add_argument('--vpu', type=str, required=True)
+    argparser.add_argument('--vpu', type=str, required=False, default=None,
+                           help='Only prepare the namelists of this VPU. Defaults to every VPU with inflow files')
+    argparser.add_argument('--ensemble', type=str, required=False,
+                           help='Only prepare the namelist for this ensemble member')
+    argparser.add_argument('--workers', type=int, required=False, default=None,
+                           help='Number of namelists written at once when preparing every VPU')
+    argparser.add_argument('--subbasins', type=int, required=False, default=os.environ.get('RAPID_SUBBASINS'),
+                           help='Route large VPUs as up to this many groups of independent subnetworks when '
+                                'preparing every VPU. Defaults to $RAPID_SUBBASINS')
+    argparser.add_argument('--subbasinreaches', type=int, required=False,
+                           default=os.environ.get('RAPID_SUBBASIN_MIN_REACHES', 0),
+                           help='Only route VPUs with at least this many reaches in groups. Defaults to '
+                                '$RAPID_SUBBASIN_MIN_REACHES or 0')
     args = argparser.parse_args()
 
     ymd = args.ymd
@@ -224,26 +456,34 @@ if __name__ == '__main__':
     os.makedirs(namelists_dir, exist_ok=True)
     os.makedirs(outputs_dir, exist_ok=True)
 
-    qinit_file = None
-    available_qinit_dates = [os.path.basename(x) for x in glob.glob(os.path.join(INITS_DIR, '*'))]
-    available_qinit_dates = [x for x in available_qinit_dates if os.path.isdir(os.path.join(INITS_DIR, x))]
-    available_qinit_dates = natsorted(available_qinit_dates, reverse=True)
-    for day in range(11):
-        possible_init_date = (pd.to_datetime(ymd) - pd.Timedelta(days=day)).strftime('%Y%m%d')
-        if possible_init_date in available_qinit_dates:
-            possible_qinit_file = os.path.join(INITS_DIR, possible_init_date, f'qinit_{vpu}_{possible_init_date}.nc')
-            if os.path.exists(possible_qinit_file):
-                qinit_file = possible_qinit_file
-                break
-
-    for inflow_file in glob.glob(os.path.join(inflows_dir, f'm3_{vpu}_*.nc')):
-        ensemble_number = os.path.basename(inflow_file).replace('.nc', '').split('_')[-1]
-        create_rapid_namelist(
-            vpu_directory=os.path.join(CONFIGS_DIR, vpu),
-            inflow_file=inflow_file,
-            namelist_directory=namelists_dir,
-            outputs_directory=outputs_dir,
-            qinit_file=qinit_file,
-            qfinal_file=None,
-            file_label=ensemble_number,
-        )
+    manifest = StageManifest.for_day(ymd)
+    if vpu is None:
+        if args.ensemble is not None:
+            argparser.error('--ensemble requires --vpu')
+        with stage('namelists', ymd=ymd, outputs=[os.path.join(namelists_dir, 'namelist_*')]):
+            prepare_vpu_namelists(ymd, max_workers=args.workers, manifest=manifest, subbasins=args.subbasins,
+                                  subbasin_min_reaches=args.subbasinreaches)
+    else:
+        qinit_file = find_qinit_files(ymd, [vpu]).get(vpu)
+        config_files = [os.path.join(CONFIGS_DIR, vpu, x) for x in CONFIG_FILES]
+        with stage('namelists', ymd=ymd, vpu=vpu, ensemble=args.ensemble,
+                   outputs=[os.path.join(namelists_dir, f'namelist_{vpu}_{args.ensemble or "*"}')]):
+            for inflow_file in glob.glob(os.path.join(inflows_dir, f'm3_{vpu}_*.nc')):
+                ensemble_number = os.path.basename(inflow_file).replace('.nc', '').split('_')[-1]
+                if args.ensemble is not None and ensemble_number != args.ensemble:
+                    continue
+                inputs = [inflow_file, *config_files, *([qinit_file] if qinit_file else [])]
+                outputs = [os.path.join(namelists_dir, f'namelist_{vpu}_{ensemble_number}')]
+                if manifest.is_complete('namelists', f'{vpu}_{ensemble_number}', inputs, outputs):
+                    continue
+                _remove_stale_namelists(namelists_dir, vpu, ensemble_number, False)
+                create_rapid_namelist(
+                    vpu_directory=os.path.join(CONFIGS_DIR, vpu),
+                    inflow_file=inflow_file,
+                    namelist_directory=namelists_dir,
+                    outputs_directory=outputs_dir,
+                    qinit_file=qinit_file,
+                    qfinal_file=None,
+                    file_label=ensemble_number,
+                )
+                manifest.record('namelists', f'{vpu}_{ensemble_number}', inputs, outputs)
@@ -0,0 +1,272 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import xarray as xr
+import zarr
+
+# saved next to {ymd}.zarr, not inside it, so the zarr can be uploaded or served without it
+INDEX_SUFFIX = '.rivid_index.npz'
+INDEX_VERSION = 1
+DEFAULT_CACHE_MB = 512
+
+
+def _index_path(zarr_path: str) -> str:
+    return f'{zarr_path.rstrip(os.sep)}{INDEX_SUFFIX}'
+
+
+def _rivid_signature(zarr_path: str) -> np.ndarray:
+    # sizes and modification times of the rivid array files, which change whenever the store is rewritten. The chunks
+    # are in subdirectories in zarr v3 stores
+    rivid_dir = os.path.join(zarr_path, 'rivid')
+    files = sorted(os.path.join(root, x) for root, _, names in os.walk(rivid_dir) for x in names)
+    stats = [os.stat(x) for x in files]
+    return np.array([[x.st_size, x.st_mtime_ns] for x in stats], dtype=np.int64)
+
+
+def build_rivid_index(zarr_path: str) -> str:
+    """
+    Saves the sorted rivids of a forecast zarr and their positions in the Qout rivid dimension
+
+    The chunk of a rivid is its position divided by the rivid chunk size and the offset is the remainder, so one
+    searchsorted call finds the chunks and offsets of any number of rivids without loading the zarr coordinates.
+
+    Args:
+        zarr_path (str): Path to the {ymd}.zarr forecast store
+
+    Returns:
+        str: Path to the index file
+    """
+    group = zarr.open_group(zarr_path, mode='r')
+    rivids = group['rivid'][:].astype(np.int64)
+    order = np.argsort(rivids, kind='stable')
+    index_path = _index_path(zarr_path)
+    tmp_path = f'{index_path}.tmp.npz'
+    np.savez(
+        tmp_path,
+        version=INDEX_VERSION,
+        sorted_rivids=rivids[order],
+        positions=order.astype(np.int64),
+        chunk_size=group['Qout'].chunks[2],
+        signature=_rivid_signature(zarr_path),
+    )
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def load_rivid_index(zarr_path: str) -> dict:
+    """
+    Loads the rivid index of a forecast zarr, building it first if it is missing or the zarr was rewritten
+    """
+    index_path = _index_path(zarr_path)
+    if os.path.exists(index_path):
+        with np.load(index_path) as f:
+            index = {k: f[k] for k in f.files}
+        if index['version'] == INDEX_VERSION and np.array_equal(index['signature'], _rivid_signature(zarr_path)):
+            return index
+        logging.info(f'Rebuilding stale rivid index {index_path}')
+    build_rivid_index(zarr_path)
+    return load_rivid_index(zarr_path)
+
+
+class ChunkCache:
+    """
+    Least recently used cache of decompressed Qout rivid chunks limited by the total bytes of the cached arrays
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: int, load) -> np.ndarray:
+        with self._lock:
+            if key in self._chunks:
+                self.hits += 1
+                self._chunks.move_to_end(key)
+                return self._chunks[key]
+            self.misses += 1
+        # chunks are decompressed outside the lock so that requests for other chunks are not blocked
+        values = load(key)
+        with self._lock:
+            if key not in self._chunks:
+                self._chunks[key] = values
+                self.nbytes += values.nbytes
+            while self.nbytes > self.max_bytes and len(self._chunks) > 1:
+                _, evicted = self._chunks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return values
+
+    def stats(self) -> dict:
+        return {
+            'chunks': len(self._chunks),
+            'mb': round(self.nbytes / 1e6, 1),
+            'max_mb': round(self.max_bytes / 1e6, 1),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ReachForecastStore:
+    """
+    Reads the forecasts of river reaches from a {ymd}.zarr store by rivid
+
+    Args:
+        zarr_path (str): Path to the {ymd}.zarr forecast store
+        cache_mb (float): Maximum megabytes of decompressed chunks kept in memory
+    """
+
+    def __init__(self, zarr_path: str, cache_mb: float = DEFAULT_CACHE_MB):
+        self.zarr_path = zarr_path
+        self.index = load_rivid_index(zarr_path)
+        self.qout = zarr.open_group(zarr_path, mode='r')['Qout']
+        self.chunk_size = int(self.index['chunk_size'])
+        self.cache = ChunkCache(int(cache_mb * 1e6))
+        with xr.open_zarr(zarr_path, consolidated=None) as ds:
+            self.times = ds['time'].values
+            self.ensembles = ds['ensemble'].values
+
+    def _load_chunk(self, chunk: int) -> np.ndarray:
+        return self.qout[:, :, chunk * self.chunk_size:(chunk + 1) * self.chunk_size]
+
+    def positions(self, rivids) -> np.ndarray:
+        """
+        Finds the Qout rivid positions of the rivids, raising a KeyError listing any rivids not in the forecast
+        """
+        rivids = np.asarray(rivids, dtype=np.int64).ravel()
+        sorted_rivids = self.index['sorted_rivids']
+        found = np.minimum(np.searchsorted(sorted_rivids, rivids), sorted_rivids.shape[0] - 1)
+        missing = sorted_rivids[found] != rivids
+        if missing.any():
+            raise KeyError(f'rivids not in the forecast: {rivids[missing].tolist()}')
+        return self.index['positions'][found]
+
+    def query(self, rivids) -> np.ndarray:
+        """
+        Reads every ensemble and timestep of each rivid
+
+        Args:
+            rivids (int or array-like): River ids
+
+        Returns:
+            np.ndarray: Discharge with shape (rivid, ensemble, time)
+        """
+        positions = self.positions(rivids)
+        chunks, offsets = np.divmod(positions, self.chunk_size)
+        unique_chunks, chunk_of_rivid = np.unique(chunks, return_inverse=True)
+        result = np.empty((positions.shape[0], self.qout.shape[0], self.qout.shape[1]), dtype=self.qout.dtype)
+        for i, chunk in enumerate(unique_chunks):
+            selected = np.flatnonzero(chunk_of_rivid == i)
+            block = self.cache.get(int(chunk), self._load_chunk)
+            result[selected] = np.moveaxis(block[:, :, offsets[selected]], 2, 0)
+        return result
+
+    def query_json(self, rivids) -> dict:
+        rivids = np.asarray(rivids, dtype=np.int64).ravel()
+        values = self.query(rivids)
+        return {
+            'rivid': rivids.tolist(),
+            'ensemble': self.ensembles.tolist(),
+            'time': np.datetime_as_string(self.times, unit='s').tolist(),
+            'Qout': np.where(np.isnan(values), None, values.round(3)).tolist(),
+        }
+
+
+def _handler_for(store: ReachForecastStore):
+    class ReachQueryHandler(BaseHTTPRequestHandler):
+        """
+        GET /reaches?rivid=1,2,3 returns the forecast of the rivids as JSON and GET /stats the cache statistics
+        """
+
+        def _send(self, status: int, body: dict) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path == '/stats':
+                return self._send(200, store.cache.stats())
+            if url.path != '/reaches':
+                return self._send(404, {'error': f'unknown path {url.path}'})
+            params = urllib.parse.parse_qs(url.query)
+            try:
+                rivids = [int(x) for x in ','.join(params.get('rivid', [])).split(',') if x]
+            except ValueError:
+                return self._send(400, {'error': 'rivid must be a comma separated list of integers'})
+            if not rivids:
+                return self._send(400, {'error': 'give at least one rivid'})
+            try:
+                return self._send(200, store.query_json(rivids))
+            except KeyError as e:
+                return self._send(404, {'error': e.args[0]})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return ReachQueryHandler
+
+
+def serve(store: ReachForecastStore, host: str = '127.0.0.1', port: int = 8080) -> None:
+    """
+    Serves reach queries over HTTP from one process for local load testing
+    """
+    server = ThreadingHTTPServer((host, port), _handler_for(store))
+    logging.info(f'Serving {store.zarr_path} on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zarr', type=str, required=False, default=None,
+                        help='Path to the forecast zarr', )
+    parser.add_argument('--ymd', type=str, required=False, default=None,
+                        help='Year, month, and day in YYYYMMDD format. Reads FORECASTS_DIR/ymd/outputs/ymd.zarr', )
+    parser.add_argument('--buildindex', action='store_true', default=False,
+                        help='Build the rivid index of the zarr and exit', )
+    parser.add_argument('--rivid', type=int, nargs='+', required=False, default=None,
+                        help='Print the forecast of these rivids as JSON', )
+    parser.add_argument('--serve', action='store_true', default=False,
+                        help='Serve queries over HTTP', )
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1',
+                        help='Host to serve on', )
+    parser.add_argument('--port', type=int, required=False, default=8080,
+                        help='Port to serve on', )
+    parser.add_argument('--cachemb', type=float, required=False, default=DEFAULT_CACHE_MB,
+                        help='Megabytes of decompressed chunks kept in memory', )
+    args = parser.parse_args()
+
+    if not (args.zarr or args.ymd):
+        parser.error('give --zarr or --ymd')
+    zarr_file_path = args.zarr or os.path.join(os.environ['FORECASTS_DIR'], args.ymd, 'outputs', f'{args.ymd}.zarr')
+
+    if args.buildindex:
+        logging.info(f'Wrote {build_rivid_index(zarr_file_path)}')
+        sys.exit(0)
+
+    reach_store = ReachForecastStore(zarr_file_path, cache_mb=args.cachemb)
+    if args.rivid:
+        t0 = time.perf_counter()
+        print(json.dumps(reach_store.query_json(args.rivid)))
+        logging.info(f'Query took {(time.perf_counter() - t0) * 1000:.1f} ms')
+    if args.serve:
+        serve(reach_store, args.host, args.port)
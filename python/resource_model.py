@@ -0,0 +1,318 @@
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import netCDF4 as nc
+import numpy as np
+from natsort import natsorted
+
+from vpu_config_index import build_config_index
+
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
+MEMORY_MODEL_PATH = os.environ.get('MEMORY_MODEL_PATH', os.path.join(FORECASTS_DIR, 'memory_model.json'))
+MEMORY_MODEL_VERSION = 1
+
+# peak memory of a task before calibration as the MB of an idle interpreter with the stage's libraries imported and
+# the bytes held per cell, where the cells of a task are its reaches x timesteps x ensemble members (the cost of the
+# task in scheduler.py)
+DEFAULT_STAGE_MODELS = {
+    'inflows': {'base_mb': 250, 'bytes_per_cell': 16},
+    'namelists': {'base_mb': 120, 'bytes_per_cell': 0},
+    'rapid': {'base_mb': 150, 'bytes_per_cell': 8},
+    'postprocess': {'base_mb': 200, 'bytes_per_cell': 12},
+    'inits': {'base_mb': 120, 'bytes_per_cell': 16},
+    'maptables': {'base_mb': 150, 'bytes_per_cell': 64},
+    'globalmaptables': {'base_mb': 150, 'bytes_per_cell': 96},
+    'zarr': {'base_mb': 250, 'bytes_per_cell': 8},
+    'zarrfinalize': {'base_mb': 250, 'bytes_per_cell': 0},
+}
+# estimates are multiplied by this so that a task slightly larger than the ones the model was calibrated with still
+# fits in what it was admitted with
+DEFAULT_MARGIN = 1.1
+
+
+def default_memory_budget() -> float:
+    """
+    The MB of memory tasks may use at once: MEMORY_BUDGET_MB, or 80% of the physical memory of the machine
+    """
+    if os.environ.get('MEMORY_BUDGET_MB'):
+        return float(os.environ['MEMORY_BUDGET_MB'])
+    return 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e6
+
+
+class MemoryModel:
+    """
+    Estimates the peak memory of a task from the number of cells it handles with one line per stage
+
+    peak MB = (base_mb + bytes_per_cell * cells / 1e6) * margin
+
+    The lines start from DEFAULT_STAGE_MODELS and are fit to the peaks observed in earlier days by calibrate.
+
+    Args:
+        stages (dict): base_mb and bytes_per_cell of each stage. Stages missing from it use the defaults
+        margin (float): Factor applied to every estimate
+    """
+
+    def __init__(self, stages: dict = None, margin: float = DEFAULT_MARGIN):
+        self.stages = {**{k: dict(v) for k, v in DEFAULT_STAGE_MODELS.items()}, **(stages or {})}
+        self.margin = margin
+
+    @classmethod
+    def load(cls, path: str = MEMORY_MODEL_PATH) -> 'MemoryModel':
+        """
+        Loads a calibrated model, or the default model if the file is missing or was saved by another version
+        """
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return cls()
+        if saved.get('version') != MEMORY_MODEL_VERSION:
+            logging.warning(f'Ignoring the memory model {path} saved by another version')
+            return cls()
+        return cls(saved['stages'], saved.get('margin', DEFAULT_MARGIN))
+
+    def save(self, path: str = MEMORY_MODEL_PATH) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.json.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': MEMORY_MODEL_VERSION, 'margin': self.margin, 'stages': self.stages}, f, indent=2)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    def estimate(self, stage: str, cells: float) -> float:
+        """
+        Estimates the peak MB of a task of a stage handling this many reaches x timesteps x ensemble members
+        """
+        line = self.stages.get(stage, {'base_mb': 0, 'bytes_per_cell': 0})
+        return round((line['base_mb'] + line['bytes_per_cell'] * cells / 1e6) * self.margin, 1)
+
+    def calibrate(self, samples: list) -> dict:
+        """
+        Fits the line of each stage to observed peaks
+
+        The slope is the least squares fit of the peaks on the cells, or the current slope if every sample has the
+        same number of cells, and the base is raised or lowered until the line is at or above every sample so that
+        the estimates bound the observed peaks.
+
+        Args:
+            samples (list): (stage, cells, observed peak MB) of completed tasks
+
+        Returns:
+            dict: Number of samples used for each stage
+        """
+        by_stage = {}
+        for stage, cells, observed_mb in samples:
+            if observed_mb is not None and cells is not None:
+                by_stage.setdefault(stage, []).append((float(cells), float(observed_mb)))
+        for stage, points in by_stage.items():
+            cells, observed = np.array(points).T
+            slope = self.stages.get(stage, {}).get('bytes_per_cell', 0) / 1e6
+            if np.unique(cells).size > 1:
+                slope = max(float(np.polyfit(cells, observed, 1)[0]), 0)
+            self.stages[stage] = {
+                'base_mb': round(max(float(np.max(observed - slope * cells)), 0), 1),
+                'bytes_per_cell': round(slope * 1e6, 3),
+                'samples': len(points),
+            }
+        return {stage: len(points) for stage, points in by_stage.items()}
+
+
+def ensemble_timesteps(runoffs_dir: str, ymd: str) -> dict:
+    """
+    Reads the number of timesteps of the runoff file of each ensemble member of a day
+    """
+    timesteps = {}
+    for runoff_file in natsorted(glob.glob(os.path.join(runoffs_dir, ymd, '*.nc'))):
+        ensemble = os.path.basename(runoff_file).split('.')[0]
+        with nc.Dataset(runoff_file) as ds:
+            timesteps[ensemble] = len(ds.dimensions['time'])
+    return timesteps
+
+
+def stage_cells(stage: str, reaches: dict, timesteps: dict, vpu: str = None, ensemble: str = None,
+                workers: int = None) -> float:
+    """
+    The reaches x timesteps x ensemble members a task of a stage handles, the cost of the task in scheduler.py
+
+    Args:
+        stage (str): Stage name
+        reaches (dict): Number of reaches of each VPU
+        timesteps (dict): Number of timesteps of each ensemble member
+        vpu (str): VPU of the task. Defaults to a task of every VPU
+        ensemble (str): Ensemble member of the task. Defaults to a task of every member
+        workers (int): Number of runoff files the inflows task processes at once. Defaults to the number of CPUs
+
+    Returns:
+        float: The cells of the task
+    """
+    n_reaches = reaches.get(vpu, 0) if vpu is not None else sum(reaches.values())
+    if stage == 'inflows':
+        # each of the runoff files processed at once holds the runoff of every reach
+        return sum(reaches.values()) * max(timesteps.values(), default=0) * min(
+            workers or os.cpu_count(), len(timesteps))
+    if stage == 'rapid':
+        return n_reaches * (timesteps.get(ensemble, 0) if ensemble is not None else sum(timesteps.values()))
+    if stage == 'postprocess':
+        return n_reaches * sum(n for ens, n in timesteps.items() if ens != '52')
+    if stage in ('maptables', 'globalmaptables'):
+        return n_reaches * timesteps.get('1', 1)
+    if stage == 'zarr':
+        return n_reaches * sum(timesteps.values())
+    if stage == 'zarrfinalize':
+        return len(reaches)
+    # namelists and inits
+    return n_reaches
+
+
+class TaskCells:
+    """
+    Counts the cells of tasks from the current config index and the runoff files of their day, which are read once
+    per day
+
+    Args:
+        configs_dir (str): Directory of the VPU config directories
+        runoffs_dir (str): Directory of the runoff files of each day
+    """
+
+    def __init__(self, configs_dir: str, runoffs_dir: str):
+        self.configs_dir = configs_dir
+        self.runoffs_dir = runoffs_dir
+        self._timesteps = {}
+
+    def timesteps(self, ymd: str) -> dict:
+        if ymd not in self._timesteps:
+            self._timesteps[ymd] = ensemble_timesteps(self.runoffs_dir, ymd)
+        return self._timesteps[ymd]
+
+    def cells(self, stage: str, ymd: str, vpu: str = None, ensemble: str = None, workers: int = None) -> float:
+        reaches = {x: metadata['reaches_total'] for x, metadata in build_config_index(self.configs_dir).items()}
+        return stage_cells(stage, reaches, self.timesteps(ymd), vpu, ensemble, workers)
+
+
+def observed_peaks(tasks: dict, records: list) -> None:
+    """
+    Sets the observed_mb of each task which ran to the largest peak RSS of the metrics records it wrote
+
+    A record belongs to a task if it has the stage, VPU and ensemble member of the task and started while the task
+    ran. Each task of the scheduler is its own process, so the peak RSS of its records is the peak of the task.
+    """
+    for record in records:
+        if record.get('peak_rss_mb') is None or not record.get('start'):
+            continue
+        start = datetime.datetime.fromisoformat(record['start']).timestamp()
+        for task in tasks.values():
+            if (task.start is None or task.end is None or task.stage != record['stage']
+                    or task.vpu != record.get('vpu') or task.ensemble != record.get('ensemble')):
+                continue
+            if task.start - 1 <= start <= task.end:
+                task.observed_mb = max(task.observed_mb or 0, record['peak_rss_mb'])
+
+
+def memory_report(tasks: dict) -> dict:
+    """
+    Compares the estimated and observed peak MB of the tasks of each stage
+
+    Returns:
+        dict: For each stage the largest estimate and observed peak, the mean ratio of observed to estimated and the
+            tasks whose observed peak was above their estimate
+    """
+    stages = {}
+    for task in tasks.values():
+        if not task.memory_mb or task.observed_mb is None:
+            continue
+        stages.setdefault(task.stage, []).append(task)
+    report = {}
+    for stage, stage_tasks in stages.items():
+        report[stage] = {
+            'tasks': len(stage_tasks),
+            'max_estimated_mb': max(t.memory_mb for t in stage_tasks),
+            'max_observed_mb': max(t.observed_mb for t in stage_tasks),
+            'mean_observed_ratio': round(float(np.mean([t.observed_mb / t.memory_mb for t in stage_tasks])), 3),
+            'underestimated': [t.name for t in stage_tasks if t.observed_mb > t.memory_mb],
+        }
+    return report
+
+
+def metrics_samples(ymd: str, task_cells: TaskCells) -> list:
+    """
+    Reads the (stage, cells, observed peak MB) of the stages of a day from the metrics the scripts recorded, e.g. of a
+    day run by suites/workflow.sh
+
+    The rapid stage of workflow.sh is one record of the command which feeds the RAPID container, so the RAPID runs
+    are read from the run log of runrapid.py instead.
+    """
+    from instrumentation import read_metrics
+
+    samples = [
+        (record['stage'], task_cells.cells(record['stage'], ymd, record.get('vpu'), record.get('ensemble')),
+         record.get('peak_rss_mb'))
+        for record in read_metrics(ymd)
+        if record.get('status') == 'succeeded' and record['stage'] in DEFAULT_STAGE_MODELS
+        and (record['stage'] != 'rapid' or record.get('vpu'))
+    ]
+    run_log = os.path.join(FORECASTS_DIR, ymd, 'logs', 'rapid_runs.jsonl')
+    if os.path.exists(run_log):
+        with open(run_log) as f:
+            for line in f:
+                run = json.loads(line)
+                if run['status'] != 'succeeded':
+                    continue
+                # namelist_{vpu}_{ensemble}
+                vpu, ensemble = os.path.basename(run['namelist']).split('_')[1:3]
+                samples.append(('rapid', task_cells.cells('rapid', ymd, vpu, ensemble), run.get('peak_rss_mb')))
+    return samples
+
+
+def schedule_samples(ymd: str) -> list or None:
+    """
+    Reads the (stage, cells, observed peak MB) of the tasks of a day from the schedule report of scheduler.py
+
+    Returns:
+        list: The samples, or None if the day was not run with scheduler.py
+    """
+    report_path = os.path.join(FORECASTS_DIR, ymd, 'logs', 'schedule.json')
+    try:
+        with open(report_path) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return [(task['stage'], task['cost'] if task.get('memory_cells') is None else task['memory_cells'],
+             task.get('observed_mb')) for task in report['tasks'] if task.get('status') == 'succeeded']
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Calibrate the task memory model of scheduler.py')
+    parser.add_argument('--ymd', type=str, nargs='+', required=True,
+                        help='Days whose observed task peaks the model is fit to, from the schedule report of days run '
+                             'with scheduler.py or the stage metrics of days run with suites/workflow.sh')
+    parser.add_argument('--model', type=str, required=False, default=MEMORY_MODEL_PATH,
+                        help='Path to the memory model to update. Defaults to MEMORY_MODEL_PATH or '
+                             'FORECASTS_DIR/memory_model.json')
+    parser.add_argument('--margin', type=float, required=False, default=None,
+                        help=f'Factor applied to every estimate. Defaults to the current one, or {DEFAULT_MARGIN}')
+    args = parser.parse_args()
+
+    memory_model = MemoryModel.load(args.model)
+    if args.margin is not None:
+        memory_model.margin = args.margin
+    metrics_cells = TaskCells(os.environ['CONFIGS_DIR'], os.environ['RUNOFFS_DIR'])
+    day_samples = []
+    for ymd in args.ymd:
+        samples = schedule_samples(ymd)
+        day_samples.extend(metrics_samples(ymd, metrics_cells) if samples is None else samples)
+    n_samples = memory_model.calibrate(day_samples)
+    if not n_samples:
+        logging.error('No observed task peaks to calibrate with, run the days first')
+        sys.exit(1)
+    memory_model.save(args.model)
+    logging.info(f'Calibrated the memory model with {json.dumps(n_samples)}')
+    print(json.dumps(memory_model.stages, indent=2))
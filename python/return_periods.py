@@ -0,0 +1,197 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+from natsort import natsorted
+
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+
+# the compiled thresholds of returnperiods_{vpu}.nc are saved next to it as returnperiods_{vpu}.thresholds.npy and
+# described by returnperiods_{vpu}.thresholds.json
+COMPILED_SUFFIX = '.thresholds'
+COMPILED_VERSION = 1
+
+
+def return_period_thresholds(rp_path: str, rivids: np.ndarray) -> np.ndarray:
+    """
+    Reads the return period flows of a returnperiods_{vpu}.nc file aligned to the order of the given rivids
+
+    Args:
+        rp_path (str): Path to the return periods netCDF
+        rivids (np.ndarray): River IDs in the order of the Qout columns
+
+    Returns:
+        np.ndarray: Array of shape (len(RETURN_PERIODS), len(rivids)). Missing thresholds are +inf.
+    """
+    with nc.Dataset(rp_path, "r") as rp_ncfile:
+        rp_rivids = np.asarray(rp_ncfile.variables["rivid"][:])
+        rp_flows = np.stack([
+            np.ma.filled(rp_ncfile.variables[f"rp{rp}"][:].astype(np.float64), np.nan) for rp in RETURN_PERIODS
+        ])
+
+    positions = pd.Index(rp_rivids).get_indexer(rivids)
+    thresholds = np.full((len(RETURN_PERIODS), rivids.shape[0]), np.inf)
+    thresholds[:, positions >= 0] = rp_flows[:, positions[positions >= 0]]
+    thresholds[np.isnan(thresholds)] = np.inf
+    return thresholds
+
+
+def rivid_checksum(rivids: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(rivids, dtype='<i8').tobytes()).hexdigest()
+
+
+def _compiled_paths(rp_path: str) -> tuple:
+    base = f'{os.path.splitext(rp_path)[0]}{COMPILED_SUFFIX}'
+    return f'{base}.npy', f'{base}.json'
+
+
+def _source_signature(rp_path: str) -> dict:
+    stat = os.stat(rp_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _round_down_float32(values: np.ndarray) -> np.ndarray:
+    # the largest float32 at or below each threshold, so that a float32 flow exceeds it exactly when it exceeds the
+    # float64 threshold and the classification does not change
+    rounded = values.astype(np.float32)
+    over = rounded.astype(np.float64) > values
+    rounded[over] = np.nextafter(rounded[over], np.float32(-np.inf))
+    return rounded
+
+
+def compile_thresholds(rp_path: str, rivids: np.ndarray) -> str:
+    """
+    Saves the return period flows of a VPU as a float32 array in the order of its Qout rivids
+
+    The array has shape (len(RETURN_PERIODS), len(rivids)) and is loaded memory mapped by load_thresholds. The
+    checksum of the rivids and the size and modification time of the netCDF are saved with it so that an array which
+    no longer matches the configs or the return periods is not used.
+
+    Args:
+        rp_path (str): Path to the returnperiods_{vpu}.nc file
+        rivids (np.ndarray): River IDs in the order of the Qout rivid dimension, i.e. riv_bas_id.csv
+
+    Returns:
+        str: Path to the .npy file
+    """
+    array_path, metadata_path = _compiled_paths(rp_path)
+    thresholds = _round_down_float32(return_period_thresholds(rp_path, rivids))
+    metadata = {
+        'version': COMPILED_VERSION,
+        'return_periods': list(RETURN_PERIODS),
+        'n_rivids': int(rivids.shape[0]),
+        'rivid_sha256': rivid_checksum(rivids),
+        'source': _source_signature(rp_path),
+    }
+    directory = os.path.dirname(os.path.abspath(array_path))
+    fd, tmp_array_path = tempfile.mkstemp(dir=directory, suffix='.npy.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, thresholds)
+    fd, tmp_metadata_path = tempfile.mkstemp(dir=directory, suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    for tmp_path in (tmp_array_path, tmp_metadata_path):
+        os.chmod(tmp_path, 0o644)
+    # the metadata is replaced last, an array without matching metadata is never used
+    os.replace(tmp_array_path, array_path)
+    os.replace(tmp_metadata_path, metadata_path)
+    return array_path
+
+
+def _compiled_metadata(rp_path: str) -> dict or None:
+    _, metadata_path = _compiled_paths(rp_path)
+    try:
+        with open(metadata_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_current(metadata: dict or None, rp_path: str) -> bool:
+    return (
+            metadata is not None
+            and metadata.get('version') == COMPILED_VERSION
+            and metadata.get('return_periods') == list(RETURN_PERIODS)
+            and metadata.get('source') == _source_signature(rp_path)
+    )
+
+
+def load_thresholds(rp_path: str, rivids: np.ndarray) -> np.ndarray:
+    """
+    Loads the return period flows of a VPU in the order of the given rivids, memory mapped from the compiled array if
+    it matches the rivids and the netCDF, otherwise read from the netCDF and aligned to the rivids
+
+    Args:
+        rp_path (str): Path to the returnperiods_{vpu}.nc file
+        rivids (np.ndarray): River IDs in the order of the Qout columns
+
+    Returns:
+        np.ndarray: Array of shape (len(RETURN_PERIODS), len(rivids)). Missing thresholds are +inf.
+    """
+    metadata = _compiled_metadata(rp_path)
+    if _is_current(metadata, rp_path):
+        if metadata['n_rivids'] == rivids.shape[0] and metadata['rivid_sha256'] == rivid_checksum(rivids):
+            return np.load(_compiled_paths(rp_path)[0], mmap_mode='r')
+        logging.warning(f'The compiled thresholds of {rp_path} do not match the Qout rivids, the configs may have '
+                        f'changed since they were compiled. Reading the netCDF instead')
+    elif metadata is not None:
+        logging.warning(f'The compiled thresholds of {rp_path} are stale. Reading the netCDF instead')
+    return return_period_thresholds(rp_path, rivids)
+
+
+def compile_vpu_thresholds(configs_dir: str, return_periods_dir: str, vpus: list = None, force: bool = False) -> list:
+    """
+    Compiles the thresholds of every VPU whose compiled array is missing or no longer matches its riv_bas_id.csv or
+    returnperiods_{vpu}.nc
+
+    Args:
+        configs_dir (str): Path to the directory of VPU config directories
+        return_periods_dir (str): Path to the directory of returnperiods_{vpu}.nc files
+        vpus (list): VPUs to compile. Defaults to every VPU in configs_dir
+        force (bool): Compile the VPUs even if their compiled arrays are current
+
+    Returns:
+        list: The VPUs which were compiled
+    """
+    if vpus is None:
+        vpus = natsorted(os.path.basename(x) for x in glob.glob(os.path.join(configs_dir, '*')) if os.path.isdir(x))
+    compiled = []
+    for vpu in vpus:
+        rp_path = os.path.join(return_periods_dir, f'returnperiods_{vpu}.nc')
+        if not os.path.exists(rp_path):
+            logging.warning(f'No return periods for VPU {vpu} at {rp_path}')
+            continue
+        rivids = pd.read_csv(os.path.join(configs_dir, vpu, 'riv_bas_id.csv'), header=None).iloc[:, 0].to_numpy()
+        metadata = _compiled_metadata(rp_path)
+        if not force and _is_current(metadata, rp_path) and metadata['rivid_sha256'] == rivid_checksum(rivids):
+            continue
+        logging.info(f'Compiling the return period thresholds of VPU {vpu}')
+        compile_thresholds(rp_path, rivids)
+        compiled.append(vpu)
+    return compiled
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, required=False, default=os.environ.get('CONFIGS_DIR'),
+                        help='Path to the directory of VPU config directories', )
+    parser.add_argument('--returnperiods', type=str, required=False, default=os.environ.get('RETURN_PERIODS_DIR'),
+                        help='Path to the directory of returnperiods_{vpu}.nc files', )
+    parser.add_argument('--vpu', type=str, nargs='+', required=False, default=None,
+                        help='VPUs to compile. Defaults to every VPU in the configs directory', )
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Compile the VPUs even if their compiled thresholds are current', )
+    args = parser.parse_args()
+
+    compiled_vpus = compile_vpu_thresholds(args.configs, args.returnperiods, args.vpu, args.force)
+    logging.info(f'Compiled the return period thresholds of {len(compiled_vpus)} VPUs')
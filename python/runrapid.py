@@ -1,29 +1,225 @@
 import argparse
 import datetime
+import glob
+import json
+import os
+import re
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 def timestamp():
     return datetime.datetime.utcnow().strftime('%Y-%m-%d %X')
 
 
+def read_namelist_value(namelist_file: str, key: str) -> str or None:
+    with open(namelist_file) as f:
+        for line in f:
+            match = re.match(rf"^\s*{key}\s*=\s*'?(.*?)'?\s*$", line)
+            if match:
+                return match.group(1)
+    return None
+
+
 def run_rapid_for_namelist_file(namelist_file: str,
-                                path_rapid_exec: str = '/home/rapid/src/rapid', ) -> None:
+                                path_rapid_exec: str = '/home/rapid/src/rapid',
+                                threads: int = None,
+                                usage: dict = None, ) -> int:
+    """
+    Runs RAPID for one namelist file
+
+    Args:
+        namelist_file (str): Path to the namelist file
+        path_rapid_exec (str): Path to the RAPID executable
+        threads (int): Number of threads each RAPID run may use. Defaults to the environment's settings
+        usage (dict): Filled with the CPU seconds and peak RSS of the RAPID process if given
+
+    Returns:
+        int: The exit code of RAPID, or -1 if it could not be started
+    """
+    env = None
+    if threads:
+        env = {**os.environ, 'OMP_NUM_THREADS': str(threads), 'OPENBLAS_NUM_THREADS': str(threads)}
     print(f'Running RAPID for {namelist_file}')
     try:
         print(f'{timestamp()}: Running RAPID for {namelist_file}')
-        subprocess.call(
+        process = subprocess.Popen(
             [path_rapid_exec, '--namelist', namelist_file, '--ksp_type', 'preonly'],
             stdout=sys.stdout,
             stderr=sys.stderr,
+            env=env,
         )
-        print(f'{timestamp()}: Finished RAPID for {namelist_file}')
+        # wait4 gives the resource usage of this run alone, even when other runs finish at the same time
+        _, status, rusage = os.wait4(process.pid, 0)
+        returncode = process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if usage is not None:
+            usage['cpu_seconds'] = round(rusage.ru_utime + rusage.ru_stime, 3)
+            usage['peak_rss_mb'] = round(rusage.ru_maxrss * 1024 / 1e6, 1)
+        print(f'{timestamp()}: Finished RAPID for {namelist_file} with exit code {returncode}')
     except Exception as e:
         print(e)
         print(f'Failed to run RAPID for {namelist_file}')
+        returncode = -1
+
+    return returncode
+
+
+def rapid_unit(namelist_file: str) -> tuple:
+    """
+    Reads the stage manifest unit of a namelist_{vpu}_{ensemble} file, the files RAPID reads, and the Qout file
+
+    Returns:
+        tuple: The unit '{vpu}_{ensemble}', the list of input files, and the Qout file path
+    """
+    unit = os.path.basename(namelist_file).replace('namelist_', '', 1)
+    inputs = [namelist_file, read_namelist_value(namelist_file, 'Vlat_file')]
+    if read_namelist_value(namelist_file, 'BS_opt_Qinit') == '.true.':
+        inputs.append(read_namelist_value(namelist_file, 'Qinit_file'))
+    return unit, inputs, read_namelist_value(namelist_file, 'Qout_file')
+
+
+def day_manifest(forecast_dir: str):
+    """
+    Loads the stage manifest of a forecast day. Only call it on the host: runrapid.py is the one script the RAPID
+    container runs, /mnt/scripts holds nothing else and the container python only has the standard library
+    """
+    from stage_manifest import StageManifest
+    return StageManifest.for_day(forecast_dir=forecast_dir)
+
+
+def pending_namelists(namelist_files: list, manifest) -> list:
+    """
+    Lists the namelists whose Qout file is not complete in the stage manifest of the day
+    """
+    return [x for x in namelist_files if not manifest.is_complete('rapid', *rapid_unit(x)[:2])]
+
+
+def record_rapid_run(manifest, namelist_file: str, start: float) -> bool:
+    """
+    Records the rapid unit of a namelist in the stage manifest of the day after a run of it which started at start
+
+    The unit is only recorded if the Qout file was written by that run and none of the files the run read changed
+    after it started, so that a stale Qout file is never recorded as complete.
+
+    Returns:
+        bool: True if the unit was recorded
+    """
+    unit, inputs, qout_file = rapid_unit(namelist_file)
+    if not qout_file or not os.path.exists(qout_file) or os.path.getmtime(qout_file) < int(start):
+        return False
+    if not all(os.path.exists(x) and os.path.getmtime(x) <= start for x in inputs):
+        return False
+    manifest.record('rapid', unit, inputs, [qout_file])
+    return True
 
-    return
+
+def record_rapid_runs(run_log: str, manifest) -> int:
+    """
+    Records the namelists whose last run in a worker run log succeeded in the stage manifest of the day, unless they
+    are already complete in it
+
+    Returns:
+        int: The number of units recorded
+    """
+    if not os.path.exists(run_log):
+        return 0
+    last_runs = {}
+    with open(run_log) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            last_runs[record['namelist']] = record
+    n_recorded = 0
+    for namelist_file, record in last_runs.items():
+        if record['status'] != 'succeeded' or not os.path.exists(namelist_file):
+            continue
+        if manifest.is_complete('rapid', *rapid_unit(namelist_file)[:2]):
+            continue
+        n_recorded += record_rapid_run(manifest, namelist_file, record['start'])
+    return n_recorded
+
+
+def _run_with_retries(namelist_file: str, path_rapid_exec: str, threads: int, retries: int) -> dict:
+    qout_file = read_namelist_value(namelist_file, 'Qout_file')
+    record = {'namelist': namelist_file, 'qout_file': qout_file, 'attempts': 0, 'start': time.time()}
+    while record['attempts'] <= retries:
+        record['attempts'] += 1
+        t0 = time.time()
+        usage = {}
+        returncode = run_rapid_for_namelist_file(namelist_file, path_rapid_exec, threads, usage)
+        record['wall_seconds'] = round(time.time() - t0, 3)
+        record.update(usage)
+        record['returncode'] = returncode
+        written = qout_file and os.path.exists(qout_file) and os.path.getmtime(qout_file) >= int(t0)
+        record['qout_bytes'] = os.path.getsize(qout_file) if written else 0
+        # RAPID can exit 0 without writing outputs, so a missing or stale Qout file is also a failure
+        record['status'] = 'succeeded' if returncode == 0 and record['qout_bytes'] else 'failed'
+        if record['status'] == 'succeeded':
+            break
+    record['end'] = time.time()
+    return record
+
+
+def run_rapid_worker_pool(namelist_files,
+                          path_rapid_exec: str = '/home/rapid/src/rapid',
+                          concurrency: int = None,
+                          threads: int = None,
+                          retries: int = 1,
+                          run_log: str = None, ) -> dict:
+    """
+    Runs RAPID for a stream of namelist files in one long lived process
+
+    Namelists are started as soon as they are read from namelist_files, so the input can be a generator fed while
+    earlier runs are still going (e.g. lines from stdin). Namelists whose Qout file is complete are left out on the
+    host with pending_namelists, and the runs which succeeded are recorded in the stage manifest from run_log with
+    record_rapid_runs.
+
+    Args:
+        namelist_files (iterable): Paths to namelist files
+        path_rapid_exec (str): Path to the RAPID executable
+        concurrency (int): Number of RAPID runs at once. Defaults to the number of CPUs
+        threads (int): Number of threads each RAPID run may use
+        retries (int): Number of times a failed run is retried
+        run_log (str): Path to a file where one JSON record per finished run is appended
+
+    Returns:
+        dict: Summary of the runs with a record of each run
+    """
+    concurrency = concurrency or os.cpu_count()
+    log_lock = threading.Lock()
+
+    def _run(namelist_file: str) -> dict:
+        record = _run_with_retries(namelist_file, path_rapid_exec, threads, retries)
+        if run_log:
+            with log_lock, open(run_log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(_run, x.strip()) for x in namelist_files if x.strip()]
+        records = [future.result() for future in futures]
+
+    failed = [x['namelist'] for x in records if x['status'] != 'succeeded']
+    return {
+        'runs': len(records),
+        'succeeded': len(records) - len(failed),
+        'failed': failed,
+        'retried': sum(1 for x in records if x['attempts'] > 1),
+        'wall_seconds': round(time.time() - start, 3),
+        'rapid_seconds': round(sum(x['wall_seconds'] for x in records), 3),
+        'cpu_seconds': round(sum(x.get('cpu_seconds', 0) for x in records), 3),
+        'peak_rss_mb': max((x.get('peak_rss_mb', 0) for x in records), default=0),
+        'qout_bytes': sum(x['qout_bytes'] for x in records),
+        'concurrency': concurrency,
+        'threads': threads,
+        'records': records,
+    }
 
 
 if __name__ == '__main__':
@@ -33,8 +229,58 @@ if __name__ == '__main__':
     parser.add_argument('--rapidexec', type=str, required=False,
                         default='/home/rapid/src/rapid',
                         help='Path to rapid executable', )
+    parser.add_argument('--worker', action='store_true', default=False,
+                        help='Run every namelist read from stdin, one path per line, until stdin closes', )
+    parser.add_argument('--namelists', type=str, required=False,
+                        help='Directory or glob pattern of namelist files to run in worker mode', )
+    parser.add_argument('--concurrency', type=int, required=False, default=None,
+                        help='Number of RAPID runs at once in worker mode', )
+    parser.add_argument('--threads', type=int, required=False, default=None,
+                        help='Number of threads for each RAPID run', )
+    parser.add_argument('--retries', type=int, required=False, default=1,
+                        help='Number of times a failed run is retried in worker mode', )
+    parser.add_argument('--runlog', type=str, required=False, default=None,
+                        help='Path to append one JSON record per finished run in worker mode', )
+    parser.add_argument('--summary', type=str, required=False, default=None,
+                        help='Path to save the JSON summary of worker mode. Printed to stdout if not given', )
+    parser.add_argument('--pending', type=str, required=False, default=None,
+                        help='On the host, print the namelists in this directory whose Qout file is not complete in '
+                             'the stage manifest of the day', )
+    parser.add_argument('--record', type=str, required=False, default=None,
+                        help='On the host, record the namelists whose last run in this worker run log succeeded in '
+                             'the stage manifest of the day', )
 
     args = parser.parse_args()
     namelist = args.namelist
     path_to_rapid_exec = args.rapidexec
-    run_rapid_for_namelist_file(namelist, path_to_rapid_exec)
+
+    if args.pending or args.record:
+        # the namelists are in FORECASTS_DIR/ymd/namelists and the run log in FORECASTS_DIR/ymd/logs
+        day_subdirectory = args.pending or os.path.dirname(os.path.abspath(args.record))
+        forecast_directory = os.path.dirname(os.path.abspath(day_subdirectory))
+        rapid_manifest = day_manifest(forecast_directory)
+        if args.pending:
+            for pending_namelist in pending_namelists(sorted(glob.glob(os.path.join(args.pending, '*'))),
+                                                      rapid_manifest):
+                print(pending_namelist)
+        if args.record:
+            print(f'{timestamp()}: Recorded {record_rapid_runs(args.record, rapid_manifest)} RAPID runs')
+        sys.exit(0)
+
+    if not (args.worker or args.namelists):
+        run_record = _run_with_retries(namelist, path_to_rapid_exec, args.threads, 0)
+        sys.exit(run_record['returncode'] or (1 if run_record['status'] == 'failed' else 0))
+
+    if args.namelists:
+        pattern = os.path.join(args.namelists, '*') if os.path.isdir(args.namelists) else args.namelists
+        queue = sorted(glob.glob(pattern))
+    else:
+        queue = sys.stdin
+    summary = run_rapid_worker_pool(queue, path_to_rapid_exec, args.concurrency, args.threads, args.retries,
+                                    args.runlog)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps({k: v for k, v in summary.items() if k != 'records'}, indent=2))
+    sys.exit(1 if summary['failed'] else 0)
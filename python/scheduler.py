@@ -0,0 +1,458 @@
+import argparse
+import dataclasses
+import heapq
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from natsort import natsorted
+
+from instrumentation import read_metrics
+from resource_model import (MEMORY_MODEL_PATH, MemoryModel, default_memory_budget, ensemble_timesteps, memory_report,
+                            observed_peaks, stage_cells)
+from return_periods import compile_vpu_thresholds
+from runrapid import record_rapid_run
+from stage_manifest import StageManifest
+from vpu_config_index import build_config_index
+
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
+CONFIGS_DIR = os.environ['CONFIGS_DIR']
+RUNOFFS_DIR = os.environ['RUNOFFS_DIR']
+RETURN_PERIODS_DIR = os.environ.get('RETURN_PERIODS_DIR')
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RAPID_COMMAND = 'docker exec rapid python3 /mnt/scripts/runrapid.py'
+
+# seconds between reloads of the stage manifest while milestones wait for the task which writes their units
+MANIFEST_POLL_SECONDS = 5
+# the order of the global barriers in suites/workflow.sh
+STAGES = (
+    'inflows', 'namelists', 'rapid', 'postprocess', 'inits', 'maptables', 'globalmaptables', 'zarr', 'zarrfinalize',
+)
+
+
+@dataclasses.dataclass
+class Task:
+    """
+    One command in the forecast task graph
+
+    A task without a command is a milestone of the task it depends on. It succeeds as soon as the stage manifest
+    records its units, which that task writes while it runs, so its dependents start before that task finishes.
+    """
+    name: str
+    stage: str
+    command: list or None
+    cost: float
+    dependencies: list = dataclasses.field(default_factory=list)
+    vpu: str = None
+    ensemble: str = None
+    units: list = None
+    memory_cells: float = None
+    priority: float = 0
+    status: str = 'pending'
+    start: float = None
+    end: float = None
+    returncode: int = None
+    memory_mb: float = None
+    observed_mb: float = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end - self.start) if self.end is not None else 0
+
+
+def _python_command(script: str, *args) -> list:
+    return [sys.executable, os.path.join(SCRIPTS_DIR, script), *args]
+
+
+def build_task_graph(ymd: str, rapid_command: str = DEFAULT_RAPID_COMMAND, inflow_workers: int = None) -> dict:
+    """
+    Builds the per VPU and per ensemble task graph of a forecast day
+
+    Each task costs the number of reaches it handles times the number of timesteps, which is the estimate used to
+    schedule the longest chains of work first.
+
+    The inflows of every member are written by one task, which compiles the weight matrices of every VPU once and
+    streams the runoff files through them. The namelists of a member wait on the milestone inflows_{ensemble}, which
+    is reached when the manifest records the inflow files of the member.
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        rapid_command (str): Command which runs RAPID given a --namelist argument
+        inflow_workers (int): Number of runoff files the inflows task processes at once. Defaults to the default of
+            prepare_inflows.py
+
+    Returns:
+        dict: Tasks keyed by name
+    """
+    forecast_dir = os.path.join(FORECASTS_DIR, ymd)
+    outputs_dir = os.path.join(forecast_dir, 'outputs')
+    namelists_dir = os.path.join(forecast_dir, 'namelists')
+    reaches = {vpu: metadata['reaches_total'] for vpu, metadata in build_config_index(CONFIGS_DIR).items()}
+    timesteps = ensemble_timesteps(RUNOFFS_DIR, ymd)
+    ensembles = natsorted(timesteps)
+    members = [ens for ens in ensembles if ens != '52']
+    total_reaches = sum(reaches.values())
+    vpus = natsorted(reaches)
+
+    tasks = {}
+
+    def _add(task: Task) -> None:
+        tasks[task.name] = task
+
+    def _cells(stage: str, vpu: str = None, ens: str = None) -> float:
+        return stage_cells(stage, reaches, timesteps, vpu, ens, inflow_workers)
+
+    inflow_args = ['--workers', str(inflow_workers)] if inflow_workers else []
+    _add(Task('inflows', 'inflows', _python_command('prepare_inflows.py', '--ymd', ymd, *inflow_args),
+              cost=total_reaches * sum(timesteps.values()),
+              units=[f'{vpu}_{ens}' for ens in ensembles for vpu in vpus], memory_cells=_cells('inflows')))
+    for ens in ensembles:
+        _add(Task(f'inflows_{ens}', 'inflows', None, cost=0, dependencies=['inflows'], ensemble=ens,
+                  units=[f'{vpu}_{ens}' for vpu in vpus]))
+
+    for vpu in reaches:
+        for ens in ensembles:
+            _add(Task(f'namelists_{vpu}_{ens}', 'namelists',
+                      _python_command('prepare_namelists.py', '--ymd', ymd, '--vpu', vpu, '--ensemble', ens),
+                      cost=_cells('namelists', vpu, ens), dependencies=[f'inflows_{ens}'], vpu=vpu, ensemble=ens))
+            # runrapid.py only uses the standard library inside the RAPID container so it is measured from outside
+            measure = _python_command(
+                'instrumentation.py', 'run', '--stage', 'rapid', '--ymd', ymd, '--vpu', vpu, '--ensemble', ens,
+                '--outputs', os.path.join(outputs_dir, f'Qout_{vpu}_*_{ens}.nc'),
+            )
+            _add(Task(f'rapid_{vpu}_{ens}', 'rapid',
+                      [*measure, '--', *shlex.split(rapid_command), '--namelist',
+                       os.path.join(namelists_dir, f'namelist_{vpu}_{ens}')],
+                      cost=_cells('rapid', vpu, ens), dependencies=[f'namelists_{vpu}_{ens}'], vpu=vpu, ensemble=ens))
+
+        _add(Task(f'postprocess_{vpu}', 'postprocess',
+                  _python_command('postprocess_rapid_outputs.py', '--outputs', outputs_dir, '--vpu', vpu),
+                  cost=_cells('postprocess', vpu), dependencies=[f'rapid_{vpu}_{ens}' for ens in members], vpu=vpu))
+        _add(Task(f'inits_{vpu}', 'inits', _python_command('calculate_inits.py', '--ymd', ymd, '--vpu', vpu),
+                  cost=_cells('inits', vpu), dependencies=[f'postprocess_{vpu}'], vpu=vpu))
+        _add(Task(f'maptables_{vpu}', 'maptables',
+                  _python_command('generate_vpu_map_tables.py', '--ymd', ymd, '--vpu', vpu),
+                  cost=_cells('maptables', vpu), dependencies=[f'postprocess_{vpu}'], vpu=vpu))
+
+    _add(Task('globalmaptables', 'globalmaptables', _python_command('generate_global_map_tables.py', '--ymd', ymd),
+              cost=_cells('globalmaptables'), dependencies=[f'maptables_{vpu}' for vpu in reaches]))
+    for vpu in reaches:
+        # each VPU is written to its region of the zarr as soon as its outputs exist
+        _add(Task(f'zarr_{vpu}', 'zarr', _python_command('vpu_netcdfs_to_zarr.py', '--ymd', ymd, '--vpu', vpu),
+                  cost=_cells('zarr', vpu),
+                  dependencies=[f'postprocess_{vpu}'] + ([f'rapid_{vpu}_52'] if '52' in timesteps else []), vpu=vpu))
+    _add(Task('zarrfinalize', 'zarrfinalize', _python_command('vpu_netcdfs_to_zarr.py', '--ymd', ymd, '--finalize'),
+              cost=_cells('zarrfinalize'), dependencies=[f'zarr_{vpu}' for vpu in reaches]))
+    _assign_priorities(tasks)
+    return tasks
+
+
+def estimate_memory(tasks: dict, model: MemoryModel) -> None:
+    """
+    Sets the estimated peak MB of each task from its cost, which is the reaches x timesteps x ensemble members it
+    handles, or from its memory_cells if they differ. Milestones need no memory
+    """
+    for task in tasks.values():
+        cells = task.cost if task.memory_cells is None else task.memory_cells
+        task.memory_mb = model.estimate(task.stage, cells) if task.command else 0
+
+
+def _dependents(tasks: dict) -> dict:
+    dependents = {name: [] for name in tasks}
+    for task in tasks.values():
+        for dependency in task.dependencies:
+            dependents[dependency].append(task.name)
+    return dependents
+
+
+def _assign_priorities(tasks: dict) -> None:
+    # priority is the cost of the most expensive chain of tasks from a task to the end of the graph
+    dependents = _dependents(tasks)
+    for name in reversed(_topological_order(tasks)):
+        task = tasks[name]
+        task.priority = task.cost + max((tasks[x].priority for x in dependents[name]), default=0)
+
+
+def _topological_order(tasks: dict) -> list:
+    n_waiting = {name: len(task.dependencies) for name, task in tasks.items()}
+    dependents = _dependents(tasks)
+    order = [name for name, n in n_waiting.items() if n == 0]
+    for name in order:
+        for dependent in dependents[name]:
+            n_waiting[dependent] -= 1
+            if n_waiting[dependent] == 0:
+                order.append(dependent)
+    if len(order) != len(tasks):
+        raise ValueError('The task graph contains a cycle')
+    return order
+
+
+def mark_complete_tasks(tasks: dict, manifest: StageManifest, ymd: str) -> int:
+    """
+    Marks the tasks whose work the stage manifest shows is complete so that a rerun of the day skips them
+
+    A task is only complete if every task it depends on is complete as well, so a task downstream of work which is
+    redone runs again and checks its own inputs. A milestone only depends on its own units.
+
+    Returns:
+        int: The number of tasks marked complete
+    """
+    n_complete = 0
+    for name in _topological_order(tasks):
+        task = tasks[name]
+        if task.command is not None and any(tasks[x].status != 'complete' for x in task.dependencies):
+            continue
+        if task.units is not None:
+            units = task.units
+        elif task.vpu is None:
+            units = [ymd]
+        else:
+            units = [f'{task.vpu}_{task.ensemble}' if task.ensemble else task.vpu]
+        if not manifest.remaining(task.stage, units):
+            task.status = 'complete'
+            n_complete += 1
+    return n_complete
+
+
+def _run_task(task: Task, log_dir: str) -> int:
+    with open(os.path.join(log_dir, f'{task.name}.log'), 'a') as log:
+        return subprocess.call(task.command, stdout=log, stderr=subprocess.STDOUT)
+
+
+def run_task_graph(tasks: dict, max_workers: int, log_dir: str, memory_budget_mb: float = None,
+                   manifest: StageManifest = None, poll_seconds: float = MANIFEST_POLL_SECONDS,
+                   on_success=None) -> None:
+    """
+    Runs the tasks as soon as their dependencies finish, starting the highest priority ready task first
+
+    Tasks which depend on a failed task are skipped. Tasks marked complete are not run. With a memory budget a task
+    only starts while the estimated peaks of the running tasks and its own fit in the budget. The ready tasks start in
+    priority order, so a large task waits for memory to be freed instead of being overtaken by smaller tasks. A task
+    whose estimate alone is over the budget runs when nothing else is running.
+
+    Milestones succeed when the task they depend on succeeds, or earlier when the stage manifest records their units
+    while that task runs. Without a manifest they wait for the task to finish.
+
+    Args:
+        tasks (dict): Tasks keyed by name from build_task_graph
+        max_workers (int): Maximum number of tasks running at once
+        log_dir (str): Directory where the output of each task is written to {task name}.log
+        memory_budget_mb (float): MB the estimated peaks (memory_mb, see estimate_memory) of the running tasks may
+            add up to. Defaults to no limit
+        manifest (StageManifest): Stage manifest of the day, reloaded every poll_seconds to reach milestones
+        poll_seconds (float): Seconds between reloads of the manifest
+        on_success: Function called with each task which succeeds, before its dependents are released
+
+    Returns:
+        None
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    dependents = _dependents(tasks)
+    n_waiting = {name: sum(tasks[x].status != 'complete' for x in task.dependencies) for name, task in tasks.items()}
+
+    ready = [(-task.priority, name) for name, task in tasks.items()
+             if n_waiting[name] == 0 and task.status == 'pending']
+    heapq.heapify(ready)
+    running = {}
+    memory_in_use = 0
+
+    def _skip_dependents(name: str) -> None:
+        for dependent in dependents[name]:
+            if tasks[dependent].status == 'pending':
+                tasks[dependent].status = 'skipped'
+                _skip_dependents(dependent)
+
+    def _release_dependents(name: str) -> None:
+        for dependent in dependents[name]:
+            n_waiting[dependent] -= 1
+            if n_waiting[dependent] == 0 and tasks[dependent].status == 'pending':
+                heapq.heappush(ready, (-tasks[dependent].priority, dependent))
+
+    def _reach(milestone: Task) -> None:
+        milestone.status = 'succeeded'
+        milestone.start = milestone.end = time.time()
+        _release_dependents(milestone.name)
+
+    def _reach_recorded_milestones() -> None:
+        manifest.reload()
+        for milestone in tasks.values():
+            if (milestone.command is None and milestone.status == 'pending'
+                    and all(tasks[x].status in ('running', 'succeeded') for x in milestone.dependencies)
+                    and not manifest.remaining(milestone.stage, milestone.units)):
+                _reach(milestone)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            while ready and len(running) < max_workers:
+                task = tasks[ready[0][1]]
+                if task.status != 'pending':
+                    heapq.heappop(ready)
+                    continue
+                if task.command is None:
+                    heapq.heappop(ready)
+                    _reach(task)
+                    continue
+                if memory_budget_mb and running and memory_in_use + (task.memory_mb or 0) > memory_budget_mb:
+                    break
+                heapq.heappop(ready)
+                if memory_budget_mb and (task.memory_mb or 0) > memory_budget_mb:
+                    logging.warning(f'{task.name} is estimated to need {task.memory_mb} MB, more than the budget of '
+                                    f'{memory_budget_mb} MB. Running it alone')
+                memory_in_use += task.memory_mb or 0
+                task.status = 'running'
+                task.start = time.time()
+                running[executor.submit(_run_task, task, log_dir)] = task
+            if not running:
+                continue
+            polling = manifest is not None and any(
+                t.command is None and t.status == 'pending'
+                and any(tasks[x].status == 'running' for x in t.dependencies) for t in tasks.values())
+            done, _ = wait(running, timeout=poll_seconds if polling else None, return_when=FIRST_COMPLETED)
+            if polling:
+                _reach_recorded_milestones()
+            for future in done:
+                task = running.pop(future)
+                memory_in_use -= task.memory_mb or 0
+                task.end = time.time()
+                task.returncode = future.result()
+                task.status = 'succeeded' if task.returncode == 0 else 'failed'
+                if task.status == 'failed':
+                    logging.error(f'{task.name} failed with exit code {task.returncode}')
+                    _skip_dependents(task.name)
+                    continue
+                if on_success is not None:
+                    on_success(task)
+                _release_dependents(task.name)
+
+
+def simulate_barrier_makespan(tasks: dict, max_workers: int) -> float:
+    """
+    Estimates the makespan of running the same tasks with suites/workflow.sh, one global barrier per stage
+
+    Each stage is list scheduled on max_workers slots in natural sort order, as xargs -P does, using the measured
+    duration of each task.
+    """
+    makespan = 0
+    for stage in STAGES:
+        stage_tasks = natsorted([t for t in tasks.values() if t.stage == stage], key=lambda t: t.name)
+        slots = [0.0] * max_workers
+        for task in stage_tasks:
+            heapq.heapreplace(slots, slots[0] + task.duration)
+        makespan += max(slots)
+    return makespan
+
+
+def peak_estimated_memory(tasks: dict) -> float:
+    """
+    The largest sum of the estimated peak MB of the tasks which were running at the same time
+    """
+    events = sorted(
+        [(t.start, 1, t.memory_mb or 0) for t in tasks.values() if t.start is not None and t.end is not None]
+        + [(t.end, 0, -(t.memory_mb or 0)) for t in tasks.values() if t.start is not None and t.end is not None]
+    )
+    in_use = peak = 0
+    for _, _, change in events:
+        in_use += change
+        peak = max(peak, in_use)
+    return round(peak, 1)
+
+
+def summarize(tasks: dict, max_workers: int, memory_budget_mb: float = None) -> dict:
+    started = [t for t in tasks.values() if t.start is not None and t.command is not None]
+    makespan = (max(t.end for t in started) - min(t.start for t in started)) if started else 0
+    barrier = simulate_barrier_makespan(tasks, max_workers)
+    stages = {}
+    for stage in STAGES:
+        stage_tasks = [t for t in started if t.stage == stage]
+        if stage_tasks:
+            stages[stage] = {
+                'tasks': len(stage_tasks),
+                'task_seconds': round(sum(t.duration for t in stage_tasks), 3),
+                'first_start': round(min(t.start for t in stage_tasks) - min(t.start for t in started), 3),
+                'last_end': round(max(t.end for t in stage_tasks) - min(t.start for t in started), 3),
+            }
+    statuses = {}
+    for task in tasks.values():
+        statuses[task.status] = statuses.get(task.status, 0) + 1
+    return {
+        'workers': max_workers,
+        'makespan_seconds': round(makespan, 3),
+        'barrier_makespan_seconds': round(barrier, 3),
+        'speedup': round(barrier / makespan, 3) if makespan else None,
+        'statuses': statuses,
+        'stages': stages,
+        'failed': [t.name for t in tasks.values() if t.status == 'failed'],
+        'memory_budget_mb': memory_budget_mb,
+        'peak_estimated_mb': peak_estimated_memory(tasks),
+        'memory': memory_report(tasks),
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ymd', type=str, required=True,
+                        help='Year, month, and day in YYYYMMDD format', )
+    parser.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                        help='Maximum number of tasks running at once', )
+    parser.add_argument('--inflowworkers', type=int, required=False, default=None,
+                        help='Number of runoff files the inflows task processes at once. Defaults to the memory '
+                             'capped default of prepare_inflows.py', )
+    parser.add_argument('--rapidcommand', type=str, required=False, default=DEFAULT_RAPID_COMMAND,
+                        help='Command which runs RAPID for a --namelist, e.g. "python runrapid.py --rapidexec stub"', )
+    parser.add_argument('--report', type=str, required=False, default=None,
+                        help='Path to save the JSON run summary. Defaults to FORECASTS_DIR/ymd/logs/schedule.json', )
+    parser.add_argument('--noresume', action='store_true', default=False,
+                        help='Run every task even if the stage manifest shows its work is complete', )
+    parser.add_argument('--memory', type=float, required=False, default=None,
+                        help='MB the estimated peaks of the running tasks may add up to, 0 for no limit. Defaults '
+                             'to MEMORY_BUDGET_MB or 80%% of the physical memory', )
+    parser.add_argument('--memorymodel', type=str, required=False, default=MEMORY_MODEL_PATH,
+                        help='Path to the memory model calibrated by resource_model.py. Defaults to '
+                             'MEMORY_MODEL_PATH or FORECASTS_DIR/memory_model.json', )
+    args = parser.parse_args()
+    memory_budget = default_memory_budget() if args.memory is None else args.memory
+
+    for directory in ('inflows', 'namelists', 'outputs', 'logs', 'maptables'):
+        os.makedirs(os.path.join(FORECASTS_DIR, args.ymd, directory), exist_ok=True)
+
+    if RETURN_PERIODS_DIR:
+        compile_vpu_thresholds(CONFIGS_DIR, RETURN_PERIODS_DIR)
+    day_manifest = StageManifest.for_day(args.ymd)
+    task_graph = build_task_graph(args.ymd, args.rapidcommand, args.inflowworkers)
+    if not args.noresume:
+        n_resumed = mark_complete_tasks(task_graph, day_manifest, args.ymd)
+        logging.info(f'{n_resumed} tasks are complete in the stage manifest')
+    estimate_memory(task_graph, MemoryModel.load(args.memorymodel))
+    logging.info(f'Running {len(task_graph)} tasks on {args.workers} workers'
+                 + (f' within {memory_budget:.0f} MB' if memory_budget else ''))
+    namelists_dir = os.path.join(FORECASTS_DIR, args.ymd, 'namelists')
+
+    def _record_rapid_task(task: Task) -> None:
+        # runrapid.py cannot import the stage manifest inside the RAPID container so its runs are recorded here
+        if task.stage == 'rapid':
+            namelist_file = os.path.join(namelists_dir, f'namelist_{task.vpu}_{task.ensemble}')
+            record_rapid_run(day_manifest, namelist_file, task.start)
+
+    run_task_graph(task_graph, args.workers, os.path.join(FORECASTS_DIR, args.ymd, 'logs'), memory_budget or None,
+                   day_manifest, on_success=_record_rapid_task)
+
+    observed_peaks(task_graph, read_metrics(args.ymd))
+    summary = summarize(task_graph, args.workers, memory_budget or None)
+    report_path = args.report or os.path.join(FORECASTS_DIR, args.ymd, 'logs', 'schedule.json')
+    with open(report_path, 'w') as f:
+        json.dump({
+            'summary': summary,
+            'tasks': [
+                {k: v for k, v in dataclasses.asdict(t).items() if k != 'command'} for t in task_graph.values()
+            ],
+        }, f, indent=2)
+    logging.info(json.dumps(summary, indent=2))
+    sys.exit(1 if summary['failed'] else 0)
@@ -0,0 +1,253 @@
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from instrumentation import write_record
+
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
+
+MANIFEST_FILE_NAME = 'manifest.jsonl'
+# files up to this size, e.g. namelists and zarr metadata, are identified by their contents instead of their mtime so
+# that rewriting them with the same contents does not invalidate the stages which read them
+HASH_MAX_BYTES = 1 << 20
+
+# hashes keyed by path, size and mtime so files read by many units are hashed once per process
+_HASH_CACHE = {}
+
+
+def manifest_path(ymd: str = None, forecast_dir: str = None) -> str:
+    forecast_dir = forecast_dir or os.path.join(FORECASTS_DIR, ymd)
+    return os.path.join(forecast_dir, 'logs', MANIFEST_FILE_NAME)
+
+
+def _file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_signature(path: str) -> list or None:
+    """
+    Identifies the contents of a file by its size and sha256 if it is small, otherwise by its size and mtime
+
+    Returns:
+        list: [size, sha256 or mtime_ns], or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if stat.st_size <= HASH_MAX_BYTES:
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in _HASH_CACHE:
+            _HASH_CACHE[key] = _file_hash(path)
+        return [stat.st_size, _HASH_CACHE[key]]
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class StageManifest:
+    """
+    Record of the units of work (a VPU, or a VPU and ensemble member) each stage of a forecast day has completed
+
+    Each completed unit is appended to FORECASTS_DIR/ymd/logs/manifest.jsonl with the signatures of the files it read
+    and wrote, so a rerun of the day after a crash skips units whose inputs and outputs are unchanged and redoes the
+    rest. Appends are single writes, so the stages of a day may record units from many processes at once.
+
+    Files a stage deletes after reading them, e.g. the ensemble member Qout files merged by postprocessing, are
+    recorded as consumed. A consumed file which is missing does not invalidate the units which wrote or read it.
+
+    Args:
+        path (str): Path to the manifest file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.consumed = set()
+        self.reload()
+
+    @classmethod
+    def for_day(cls, ymd: str = None, forecast_dir: str = None) -> 'StageManifest':
+        return cls(manifest_path(ymd, forecast_dir))
+
+    def reload(self) -> None:
+        self.entries = {}
+        self.consumed = set()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    # a record cut short by a crash is ignored, the unit it described is redone
+                    logging.warning(f'Ignoring unreadable line in {self.path}')
+
+    def _apply(self, record: dict) -> None:
+        if record.get('invalidated'):
+            if record.get('unit') is None:
+                self.entries = {k: v for k, v in self.entries.items() if k[0] != record['stage']}
+            else:
+                self.entries.pop((record['stage'], record['unit']), None)
+            return
+        self.entries[(record['stage'], record['unit'])] = record
+        self.consumed.update(record.get('consumed', ()))
+
+    def _append(self, record: dict) -> None:
+        write_record(record, self.path)
+        self._apply(record)
+
+    def _is_unchanged(self, path: str, recorded: list or None) -> bool:
+        signature = file_signature(path)
+        if signature is None:
+            return path in self.consumed
+        return signature == recorded
+
+    def is_complete(self, stage: str, unit: str, inputs: list = None, outputs: list = None) -> bool:
+        """
+        Checks whether a unit of a stage was completed and none of its inputs or outputs changed since
+
+        Args:
+            stage (str): Stage name, e.g. 'maptables'
+            unit (str): Unit of work, e.g. a VPU number or '{vpu}_{ensemble}'
+            inputs (list): Paths to the files the unit reads now. Defaults to the inputs it was recorded with. An input
+                which was not recorded, e.g. a new ensemble member file, invalidates the unit
+            outputs (list): Paths to the files the unit writes now. If given, the unit is only complete if it was
+                recorded with exactly these outputs, e.g. not when it is now written as different files
+
+        Returns:
+            bool: True if the unit can be skipped
+        """
+        entry = self.entries.get((stage, str(unit)))
+        if entry is None:
+            return False
+        if outputs is not None and set(entry['outputs']) != {os.path.abspath(x) for x in outputs}:
+            return False
+        recorded_inputs = entry['inputs']
+        paths = set(recorded_inputs) if inputs is None else set(recorded_inputs) | {os.path.abspath(x) for x in inputs}
+        if not all(self._is_unchanged(x, recorded_inputs.get(x)) for x in paths):
+            return False
+        return all(self._is_unchanged(path, signature) for path, signature in entry['outputs'].items())
+
+    def invalidate_lost(self, stage: str, unit: str, inputs: list) -> list:
+        """
+        Finds the files a unit consumed the last time it ran which it cannot read again, and invalidates the units
+        which wrote them so that the next run of the day writes them again. Call it when the unit is not complete
+
+        Args:
+            stage (str): Stage name
+            unit (str): Unit of work
+            inputs (list): Paths to the files the unit reads now
+
+        Returns:
+            list: The lost files. The unit cannot be redone correctly until they are written again
+        """
+        entry = self.entries.get((stage, str(unit)))
+        inputs = {os.path.abspath(x) for x in inputs}
+        lost = [x for x in (entry['consumed'] if entry else []) if x not in inputs and not os.path.exists(x)]
+        producers = [key for key, entry in self.entries.items() if any(x in entry['outputs'] for x in lost)]
+        for producer_stage, producer_unit in producers:
+            self.invalidate(producer_stage, producer_unit)
+        return lost
+
+    def remaining(self, stage: str, units) -> list:
+        """
+        Lists the units of a stage which are not complete
+
+        Args:
+            stage (str): Stage name
+            units (dict or iterable): Units to check, or a dict of the input paths of each unit
+
+        Returns:
+            list: The units which still need to run, in the order given
+        """
+        if isinstance(units, dict):
+            return [unit for unit, inputs in units.items() if not self.is_complete(stage, unit, inputs)]
+        return [unit for unit in units if not self.is_complete(stage, unit)]
+
+    def record(self, stage: str, unit: str, inputs: list, outputs: list, consumed: list = None) -> None:
+        """
+        Records a completed unit of a stage. Call it after the outputs are fully written and before deleting the
+        consumed files, so that a crash in between does not lose the unit
+
+        Args:
+            stage (str): Stage name
+            unit (str): Unit of work
+            inputs (list): Paths to the files the unit read
+            outputs (list): Paths to the files the unit wrote
+            consumed (list): Paths to files the unit deleted after reading them
+        """
+        consumed = [os.path.abspath(x) for x in (consumed or [])]
+        self._append({
+            'stage': stage,
+            'unit': str(unit),
+            'inputs': {x: file_signature(x) for x in map(os.path.abspath, inputs)},
+            'outputs': {x: file_signature(x) for x in map(os.path.abspath, outputs)},
+            'consumed': consumed,
+            'recorded': datetime.datetime.now(datetime.UTC).isoformat(),
+        })
+
+    def invalidate(self, stage: str, unit: str = None) -> None:
+        """
+        Forgets a completed unit of a stage, or every unit of the stage if no unit is given, so that it is redone
+        """
+        self._append({'stage': stage, 'unit': None if unit is None else str(unit), 'invalidated': True})
+
+    def status(self) -> dict:
+        """
+        Counts the complete and stale units of each stage, checking the files each unit was recorded with
+        """
+        stages = {}
+        for stage, unit in sorted(self.entries):
+            state = 'complete' if self.is_complete(stage, unit) else 'stale'
+            stages.setdefault(stage, {'complete': [], 'stale': []})[state].append(unit)
+        return stages
+
+    def compact(self) -> None:
+        """
+        Rewrites the manifest with only the current record of each unit. Run it when no stage is running
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=f'{MANIFEST_FILE_NAME}.')
+        with os.fdopen(fd, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ymd', type=str, required=True, help='Year, month, and day in YYYYMMDD format')
+    parser.add_argument('--stage', type=str, required=False, default=None,
+                        help='Only show or invalidate this stage')
+    parser.add_argument('--unit', type=str, required=False, default=None,
+                        help='Unit of the stage to invalidate, e.g. a VPU number. Defaults to every unit')
+    parser.add_argument('--invalidate', action='store_true', default=False,
+                        help='Forget the completed units of --stage so the next run redoes them')
+    parser.add_argument('--compact', action='store_true', default=False,
+                        help='Rewrite the manifest keeping only the current record of each unit')
+    parser.add_argument('--units', action='store_true', default=False,
+                        help='List the complete and stale units instead of counting them')
+    args = parser.parse_args()
+
+    manifest = StageManifest.for_day(args.ymd)
+    if args.invalidate:
+        if not args.stage:
+            parser.error('give the --stage to invalidate')
+        manifest.invalidate(args.stage, args.unit)
+        logging.info(f'Invalidated {args.stage} {args.unit or "(all units)"}')
+    if args.compact:
+        manifest.compact()
+    states = {k: v for k, v in manifest.status().items() if args.stage in (None, k)}
+    if not args.units:
+        states = {k: {state: len(units) for state, units in v.items()} for k, v in states.items()}
+    print(json.dumps(states, indent=2))
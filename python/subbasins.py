@@ -0,0 +1,401 @@
+import argparse
+import glob
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import netCDF4 as nc
+import numpy as np
+from natsort import natsorted
+
+from instrumentation import stage
+from stage_manifest import StageManifest
+
+FORECASTS_DIR = os.environ['FORECASTS_DIR']
+CONFIGS_DIR = os.environ['CONFIGS_DIR']
+
+# the group inflows and Qout files of a day are kept in this subdirectory of inflows and outputs, so that the stages
+# which list the files of whole VPUs never see them
+SUBBASINS_DIR = 'subbasins'
+PARTITION_FILE_NAME = 'partition.json'
+PARTITION_VERSION = 1
+# config files subset for each group, rows of k.csv and x.csv are in the order of rapid_connect.csv
+PARTITIONED_FILES = ('rapid_connect.csv', 'k.csv', 'x.csv', 'riv_bas_id.csv')
+# a group of VPU 101 is named 101-g0, which has no underscore so it parses as a VPU in the file names of a day
+GROUP_PATTERN = re.compile(r'-g\d+$')
+
+
+def group_code(vpu: str, group: int) -> str:
+    return f'{vpu}-g{group}'
+
+
+def group_vpu(code: str) -> str:
+    """
+    The VPU of a group code, or the code itself if it is not a group
+    """
+    return GROUP_PATTERN.sub('', code)
+
+
+def partition_dir(vpu_directory: str, n_groups: int) -> str:
+    return os.path.join(vpu_directory, f'subbasins_{n_groups}')
+
+
+def _source_signature(vpu_directory: str) -> dict:
+    signature = {}
+    for file_name in PARTITIONED_FILES:
+        stat = os.stat(os.path.join(vpu_directory, file_name))
+        signature[file_name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return signature
+
+
+def _read_lines(path: str) -> list:
+    with open(path) as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+def _write_lines(path: str, lines: list) -> None:
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def find_subnetworks(rivids: np.ndarray, next_down: np.ndarray) -> list:
+    """
+    Splits a river network into the sets of reaches which are connected by flow
+
+    Args:
+        rivids (np.ndarray): River IDs of the reaches, the first column of rapid_connect.csv
+        next_down (np.ndarray): River ID downstream of each reach, 0 or a river ID outside the network at outlets
+
+    Returns:
+        list: Sets of river IDs, largest first
+    """
+    import networkx as nx
+
+    graph = nx.Graph()
+    graph.add_nodes_from(rivids.tolist())
+    in_network = set(rivids.tolist())
+    graph.add_edges_from(
+        (rivid, down) for rivid, down in zip(rivids.tolist(), next_down.tolist()) if down in in_network)
+    return sorted(nx.connected_components(graph), key=len, reverse=True)
+
+
+def pack_subnetworks(subnetworks: list, n_groups: int) -> list:
+    """
+    Bin packs subnetworks into at most n_groups groups of similar numbers of reaches, largest subnetwork first into
+    the group with the fewest reaches
+
+    Returns:
+        list: Sets of river IDs of the groups which are not empty, largest first
+    """
+    groups = [set() for _ in range(n_groups)]
+    heap = [(0, i) for i in range(n_groups)]
+    for subnetwork in sorted(subnetworks, key=len, reverse=True):
+        n_reaches, i = heapq.heappop(heap)
+        groups[i].update(subnetwork)
+        heapq.heappush(heap, (n_reaches + len(subnetwork), i))
+    return sorted([x for x in groups if x], key=len, reverse=True)
+
+
+def write_partition(vpu_directory: str, n_groups: int) -> dict:
+    """
+    Splits the config files of a VPU into groups of independent subnetworks, each written as a config directory
+    named by group_code in partition_dir(vpu_directory, n_groups)
+
+    The rows of each group keep the order they have in the VPU files, so every reach is still listed after the
+    reaches upstream of it. partition.json is written last and describes the groups.
+
+    Returns:
+        dict: The partition, see load_partition
+    """
+    vpu = os.path.basename(os.path.abspath(vpu_directory))
+    directory = partition_dir(vpu_directory, n_groups)
+    lines = {x: _read_lines(os.path.join(vpu_directory, x)) for x in PARTITIONED_FILES}
+    connect_rows = [row.split(',') for row in lines['rapid_connect.csv']]
+    rivids = np.array([int(row[0]) for row in connect_rows], dtype=np.int64)
+    next_down = np.array([int(row[1]) for row in connect_rows], dtype=np.int64)
+    if not len(lines['k.csv']) == len(lines['x.csv']) == rivids.shape[0]:
+        raise ValueError(f'k.csv and x.csv of {vpu_directory} do not have a row for each row of rapid_connect.csv')
+
+    subnetworks = find_subnetworks(rivids, next_down)
+    group_of = {rivid: i for i, group in enumerate(pack_subnetworks(subnetworks, n_groups)) for rivid in group}
+    n_written = max(group_of.values()) + 1
+    connect_groups = np.array([group_of[x] for x in rivids.tolist()])
+    bas_rivids = [int(x.split(',')[0]) for x in lines['riv_bas_id.csv']]
+    if not set(bas_rivids) <= group_of.keys():
+        raise ValueError(f'riv_bas_id.csv of {vpu_directory} has reaches which are not in rapid_connect.csv')
+    bas_groups = np.array([group_of[x] for x in bas_rivids])
+
+    groups = []
+    for i in range(n_written):
+        code = group_code(vpu, i)
+        os.makedirs(os.path.join(directory, code), exist_ok=True)
+        for file_name in PARTITIONED_FILES:
+            row_groups = bas_groups if file_name == 'riv_bas_id.csv' else connect_groups
+            _write_lines(os.path.join(directory, code, file_name),
+                         [line for line, group in zip(lines[file_name], row_groups) if group == i])
+        groups.append({
+            'code': code,
+            'reaches_in_rapid_connect': int((connect_groups == i).sum()),
+            'max_upstream_reaches': len(connect_rows[0]) - 3,
+            'reaches_total': int((bas_groups == i).sum()),
+        })
+    partition = {
+        'version': PARTITION_VERSION,
+        'vpu': vpu,
+        'n_groups': n_groups,
+        'subnetworks': len(subnetworks),
+        'largest_subnetwork': len(subnetworks[0]) if subnetworks else 0,
+        'source': _source_signature(vpu_directory),
+        'groups': groups,
+    }
+    with open(os.path.join(directory, PARTITION_FILE_NAME), 'w') as f:
+        json.dump(partition, f, indent=2)
+    return partition
+
+
+def load_partition(vpu_directory: str, n_groups: int) -> dict or None:
+    """
+    Reads the partition of a VPU into n_groups groups if it was written from the current config files
+
+    Returns:
+        dict: The groups with their code and the reach counts of their config files, or None if there is no current
+            partition
+    """
+    try:
+        with open(os.path.join(partition_dir(vpu_directory, n_groups), PARTITION_FILE_NAME)) as f:
+            partition = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if partition.get('version') != PARTITION_VERSION or partition.get('source') != _source_signature(vpu_directory):
+        return None
+    return partition
+
+
+def vpu_partition(vpu_directory: str, n_groups: int) -> dict:
+    """
+    Loads the partition of a VPU into n_groups groups, writing it first if it is missing or stale
+    """
+    partition = load_partition(vpu_directory, n_groups)
+    if partition is None:
+        logging.info(f'Partitioning {vpu_directory} into {n_groups} groups of subnetworks')
+        partition = write_partition(vpu_directory, n_groups)
+    return partition
+
+
+def group_directory(vpu_directory: str, n_groups: int, code: str) -> str:
+    return os.path.join(partition_dir(vpu_directory, n_groups), code)
+
+
+def config_rivids(config_directory: str, file_name: str = 'riv_bas_id.csv') -> np.ndarray:
+    """
+    Reads the river IDs in the first column of a config file in the order of its rows
+    """
+    return np.loadtxt(os.path.join(config_directory, file_name), delimiter=',', dtype=np.int64, usecols=0, ndmin=1)
+
+
+def _positions(all_rivids: np.ndarray, rivids: np.ndarray) -> np.ndarray:
+    order = np.argsort(all_rivids, kind='stable')
+    positions = order[np.clip(np.searchsorted(all_rivids, rivids, sorter=order), 0, len(order) - 1)]
+    if not np.array_equal(all_rivids[positions], rivids):
+        raise ValueError('Some river IDs are missing from the file')
+    return positions
+
+
+def _copy_structure(source: nc.Dataset, destination: nc.Dataset, n_rivids: int) -> None:
+    destination.setncatts(source.__dict__)
+    for name, dimension in source.dimensions.items():
+        size = n_rivids if name == 'rivid' else len(dimension)
+        destination.createDimension(name, None if dimension.isunlimited() else size)
+    for name, variable in source.variables.items():
+        out = destination.createVariable(name, variable.datatype, variable.dimensions,
+                                         fill_value=getattr(variable, '_FillValue', None))
+        out.setncatts({k: v for k, v in variable.__dict__.items() if k != '_FillValue'})
+
+
+def subset_rivid_file(source_path: str, output_path: str, rivids: np.ndarray) -> str:
+    """
+    Copies a netCDF with a rivid dimension, e.g. an inflow or a qinit file, keeping only the given reaches in the
+    given order
+
+    Returns:
+        str: output_path
+    """
+    tmp_path = f'{output_path}.tmp'
+    with nc.Dataset(source_path) as source, nc.Dataset(tmp_path, 'w', format=source.data_model) as destination:
+        source.set_auto_maskandscale(False)
+        destination.set_auto_maskandscale(False)
+        positions = _positions(np.asarray(source['rivid'][:], dtype=np.int64), rivids)
+        _copy_structure(source, destination, rivids.shape[0])
+        for name, variable in source.variables.items():
+            data = variable[:]
+            if 'rivid' in variable.dimensions:
+                data = np.take(data, positions, axis=variable.dimensions.index('rivid'))
+            destination[name][:] = data
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def is_current_subset(output_path: str, source_path: str, rivids: np.ndarray) -> bool:
+    """
+    Checks whether output_path is a subset_rivid_file of source_path with the given reaches written after the source
+    """
+    if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(source_path):
+        return False
+    with nc.Dataset(output_path) as ds:
+        return np.array_equal(np.asarray(ds['rivid'][:], dtype=np.int64), rivids)
+
+
+def merge_group_files(group_paths: list, output_path: str, rivids: np.ndarray) -> str:
+    """
+    Writes the Qout files of the groups of a VPU as one Qout file with the reaches in the order of the VPU
+
+    Variables on the rivid dimension are assembled from every group, the others are copied from the first group.
+
+    Args:
+        group_paths (list): Qout files of every group of the VPU for one ensemble member
+        output_path (str): Path to the VPU Qout file
+        rivids (np.ndarray): River IDs of the VPU in the order of its riv_bas_id.csv
+
+    Returns:
+        str: output_path
+    """
+    tmp_path = f'{output_path}.tmp'
+    groups = [nc.Dataset(x) for x in group_paths]
+    try:
+        for group in groups:
+            group.set_auto_maskandscale(False)
+        group_positions = [_positions(rivids, np.asarray(x['rivid'][:], dtype=np.int64)) for x in groups]
+        if sum(x.shape[0] for x in group_positions) != rivids.shape[0]:
+            raise ValueError(f'The groups of {output_path} do not hold every reach of the VPU once')
+        first = groups[0]
+        with nc.Dataset(tmp_path, 'w', format=first.data_model) as destination:
+            destination.set_auto_maskandscale(False)
+            _copy_structure(first, destination, rivids.shape[0])
+            for name, variable in first.variables.items():
+                if 'rivid' not in variable.dimensions:
+                    destination[name][:] = variable[:]
+                    continue
+                axis = variable.dimensions.index('rivid')
+                shape = list(variable.shape)
+                shape[axis] = rivids.shape[0]
+                data = np.empty(shape, dtype=variable.dtype)
+                for group, positions in zip(groups, group_positions):
+                    index = [slice(None)] * len(shape)
+                    index[axis] = positions
+                    data[tuple(index)] = group[name][:]
+                destination[name][:] = data
+    finally:
+        for group in groups:
+            group.close()
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _read_namelist_value(namelist_file: str, key: str) -> str or None:
+    with open(namelist_file) as f:
+        for line in f:
+            name, _, value = line.partition('=')
+            if name.strip() == key:
+                return value.strip().strip("'")
+    return None
+
+
+def group_merges(ymd: str) -> dict:
+    """
+    Lists the Qout files of a day which are routed in groups from the namelists of the groups
+
+    Returns:
+        dict: The group Qout files of each VPU Qout file, with the VPU as ('vpu', path)
+    """
+    namelists_dir = os.path.join(FORECASTS_DIR, ymd, 'namelists')
+    outputs_dir = os.path.join(FORECASTS_DIR, ymd, 'outputs')
+    merges = {}
+    for namelist_file in natsorted(glob.glob(os.path.join(namelists_dir, 'namelist_*-g*'))):
+        code = os.path.basename(namelist_file).replace('namelist_', '', 1).split('_')[0]
+        vpu = group_vpu(code)
+        group_qout = _read_namelist_value(namelist_file, 'Qout_file')
+        vpu_qout = os.path.join(outputs_dir, os.path.basename(group_qout).replace(f'_{code}_', f'_{vpu}_', 1))
+        merges.setdefault((vpu, vpu_qout), []).append(group_qout)
+    return merges
+
+
+def _merge(vpu: str, vpu_qout: str, group_qouts: list) -> str:
+    return merge_group_files(group_qouts, vpu_qout, config_rivids(os.path.join(CONFIGS_DIR, vpu)))
+
+
+def merge_subbasin_outputs(ymd: str, max_workers: int = None, manifest: StageManifest = None) -> list:
+    """
+    Merges the Qout files of the groups of every VPU routed in groups into the Qout file RAPID would have written for
+    the whole VPU, then deletes the group files
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        max_workers (int): Number of Qout files merged at once. Defaults to the number of CPUs
+        manifest (StageManifest): Stage manifest of the day. Skips merges which are complete and records the rest
+
+    Returns:
+        list: The VPU Qout files which were written
+    """
+    merges = group_merges(ymd)
+    if manifest is not None:
+        merges = {
+            (vpu, vpu_qout): group_qouts for (vpu, vpu_qout), group_qouts in merges.items()
+            if not manifest.is_complete('subbasins', _unit(vpu_qout), group_qouts)
+        }
+    missing = [x for group_qouts in merges.values() for x in group_qouts if not os.path.exists(x)]
+    if missing:
+        raise FileNotFoundError(f'RAPID did not write the Qout files of these groups: {missing}')
+
+    written = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_merge, vpu, vpu_qout, group_qouts): (vpu_qout, group_qouts)
+                   for (vpu, vpu_qout), group_qouts in merges.items()}
+        for future, (vpu_qout, group_qouts) in futures.items():
+            future.result()
+            if manifest is not None:
+                manifest.record('subbasins', _unit(vpu_qout), group_qouts, [vpu_qout], consumed=group_qouts)
+            for group_qout in group_qouts:
+                os.remove(group_qout)
+            written.append(vpu_qout)
+    return written
+
+
+def _unit(vpu_qout: str) -> str:
+    # Qout_{vpu}_{start}_{end}_{ensemble}_{ensemble}.nc is the unit {vpu}_{ensemble} of the other stages
+    name_parts = os.path.basename(vpu_qout).replace('.nc', '').split('_')
+    return f'{name_parts[1]}_{name_parts[-1]}'
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Route the independent subnetworks of a VPU as separate RAPID runs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    partition_parser = subparsers.add_parser('partition', help='Write the group config files of VPUs')
+    partition_parser.add_argument('--configs', type=str, required=False, default=CONFIGS_DIR,
+                                  help='Path to the directory of VPU config directories')
+    partition_parser.add_argument('--vpu', type=str, nargs='+', required=False, default=None,
+                                  help='VPUs to partition. Defaults to every VPU in the configs directory')
+    partition_parser.add_argument('--groups', type=int, required=True, help='Number of groups per VPU')
+    merge_parser = subparsers.add_parser('merge', help='Merge the group Qout files of a day into VPU Qout files')
+    merge_parser.add_argument('--ymd', type=str, required=True, help='Year, month, and day in YYYYMMDD format')
+    merge_parser.add_argument('--workers', type=int, required=False, default=None,
+                              help='Number of Qout files merged at once')
+    args = parser.parse_args()
+
+    if args.command == 'partition':
+        vpus = args.vpu or natsorted(
+            x for x in os.listdir(args.configs) if os.path.isdir(os.path.join(args.configs, x)))
+        for vpu in vpus:
+            vpu_groups = vpu_partition(os.path.join(args.configs, vpu), args.groups)
+            sizes = [x['reaches_total'] for x in vpu_groups['groups']]
+            logging.info(f'VPU {vpu}: {vpu_groups["subnetworks"]} subnetworks in {len(sizes)} groups of {sizes} '
+                         f'reaches, the largest subnetwork has {vpu_groups["largest_subnetwork"]}')
+    else:
+        with stage('subbasins', ymd=args.ymd, outputs=[os.path.join(FORECASTS_DIR, args.ymd, 'outputs', 'Qout_*')]):
+            merged = merge_subbasin_outputs(args.ymd, args.workers, StageManifest.for_day(args.ymd))
+        logging.info(f'Merged the group Qout files of {len(merged)} VPU Qout files')
@@ -0,0 +1,179 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from natsort import natsorted
+
+# hidden so that `ls -1 $CONFIGS_DIR` still only lists VPU directories
+INDEX_FILE_NAME = '.vpu_config_index.json'
+INDEX_VERSION = 1
+
+# config files whose changes invalidate a VPU's entry in the index
+INDEXED_FILES = ('rapid_connect.csv', 'riv_bas_id.csv', )
+
+# loaded indexes keyed by index file path so repeated lookups in one process do not reread the json
+_INDEX_CACHE = {}
+
+
+def _file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _read_vpu_metadata(vpu_directory: str) -> dict:
+    # imported here so that processes which only read the index do not import pandas
+    import pandas as pd
+
+    rapid_connect_df = pd.read_csv(os.path.join(vpu_directory, 'rapid_connect.csv'), header=None)
+    riv_bas_id_df = pd.read_csv(os.path.join(vpu_directory, 'riv_bas_id.csv'), header=None)
+    rapid_connect_columns = ['rivid', 'next_down', 'count_upstream']  # plus 1 per possible upstream reach
+    return {
+        'reaches_in_rapid_connect': rapid_connect_df.shape[0],
+        'max_upstream_reaches': rapid_connect_df.columns.shape[0] - len(rapid_connect_columns),
+        'reaches_total': riv_bas_id_df.shape[0],
+    }
+
+
+def _index_path(configs_dir: str, index_path: str = None) -> str:
+    return index_path if index_path else os.path.join(configs_dir, INDEX_FILE_NAME)
+
+
+def _load_index(index_path: str) -> dict:
+    if index_path in _INDEX_CACHE:
+        return _INDEX_CACHE[index_path]
+    index = {'version': INDEX_VERSION, 'vpus': {}}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                loaded = json.load(f)
+            if loaded.get('version') == INDEX_VERSION:
+                index = loaded
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable config index {index_path}: {e}')
+    _INDEX_CACHE[index_path] = index
+    return index
+
+
+def _save_index(index: dict, index_path: str, merge: bool = True) -> None:
+    # merge with entries other processes may have written since this index was loaded
+    if merge and os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                on_disk = json.load(f)
+            if on_disk.get('version') == INDEX_VERSION:
+                index['vpus'] = {**on_disk['vpus'], **index['vpus']}
+        except (OSError, ValueError):
+            pass
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), prefix=f'{INDEX_FILE_NAME}.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logging.warning(f'Could not save config index {index_path}: {e}')
+
+
+def _entry_is_current(entry: dict, vpu_directory: str) -> bool:
+    for file_name in INDEXED_FILES:
+        path = os.path.join(vpu_directory, file_name)
+        if not os.path.exists(path) or entry['files'].get(file_name, {}).get('signature') != _file_signature(path):
+            return False
+    return True
+
+
+def _refresh_entry(entry: dict or None, vpu_directory: str) -> dict:
+    files = {}
+    for file_name in INDEXED_FILES:
+        path = os.path.join(vpu_directory, file_name)
+        files[file_name] = {'signature': _file_signature(path), 'sha256': _file_hash(path)}
+
+    # files which were touched but not changed keep their metadata
+    if entry is not None and all(files[x]['sha256'] == entry['files'].get(x, {}).get('sha256') for x in files):
+        return {**entry, 'files': files}
+    logging.info(f'Indexing config files in {vpu_directory}')
+    return {'files': files, **_read_vpu_metadata(vpu_directory)}
+
+
+def vpu_config_metadata(vpu_directory: str, index_path: str = None) -> dict:
+    """
+    Gets the reach counts of a VPU from the config index, reindexing the VPU if its config files changed
+
+    Args:
+        vpu_directory (str): Path to the VPU config directory
+        index_path (str): Path to the index file. Defaults to a hidden file in the parent configs directory
+
+    Returns:
+        dict: reaches_in_rapid_connect, max_upstream_reaches, and reaches_total of the VPU
+    """
+    vpu_directory = os.path.abspath(vpu_directory)
+    vpu = os.path.basename(vpu_directory)
+    index_path = _index_path(os.path.dirname(vpu_directory), index_path)
+    index = _load_index(index_path)
+
+    entry = index['vpus'].get(vpu)
+    if entry is None or not _entry_is_current(entry, vpu_directory):
+        entry = _refresh_entry(entry, vpu_directory)
+        index['vpus'][vpu] = entry
+        _save_index(index, index_path)
+
+    return {k: v for k, v in entry.items() if k != 'files'}
+
+
+def build_config_index(configs_dir: str, index_path: str = None) -> dict:
+    """
+    Builds or refreshes the config index for every VPU directory in configs_dir
+
+    Args:
+        configs_dir (str): Path to the directory of VPU config directories
+        index_path (str): Path to the index file. Defaults to a hidden file in configs_dir
+
+    Returns:
+        dict: Metadata for each VPU keyed by VPU number
+    """
+    index_path = _index_path(configs_dir, index_path)
+    index = _load_index(index_path)
+    vpu_dirs = natsorted([x for x in glob.glob(os.path.join(configs_dir, '*')) if os.path.isdir(x)])
+
+    changed = False
+    for vpu_directory in vpu_dirs:
+        vpu = os.path.basename(vpu_directory)
+        entry = index['vpus'].get(vpu)
+        if entry is None or not _entry_is_current(entry, vpu_directory):
+            index['vpus'][vpu] = _refresh_entry(entry, vpu_directory)
+            changed = True
+
+    vpus = {os.path.basename(x) for x in vpu_dirs}
+    if set(index['vpus']) - vpus:
+        index['vpus'] = {k: v for k, v in index['vpus'].items() if k in vpus}
+        changed = True
+    if changed:
+        _save_index(index, index_path, merge=False)
+
+    return {vpu: {k: v for k, v in entry.items() if k != 'files'} for vpu, entry in index['vpus'].items()}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, required=False, default=os.environ.get('CONFIGS_DIR'),
+                        help='Path to the directory of VPU config directories', )
+    parser.add_argument('--index', type=str, required=False, default=None,
+                        help='Path to the index file', )
+    args = parser.parse_args()
+
+    metadata = build_config_index(args.configs, args.index)
+    logging.info(f'Indexed {len(metadata)} VPUs')
@@ -1,85 +1,324 @@
 import argparse
+import contextlib
+import datetime
+import fcntl
 import glob
 import os
 import shutil
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
-import dask
+import dask.array as da
 import numpy as np
+import pandas as pd
 import xarray as xr
+import zarr
 from natsort import natsorted
 from numcodecs import Blosc
+from zarr.codecs import BloscCodec
+
+from instrumentation import stage
+from reach_query import build_rivid_index
+from stage_manifest import StageManifest
 
 CONFIGS_DIR = os.environ['CONFIGS_DIR']
 FORECASTS_DIR = os.environ['FORECASTS_DIR']
 RUNOFFS_DIR = os.environ['RUNOFFS_DIR']
+# 'chunked' writes a zarr v2 store with one object per chunk. 'sharded' writes a zarr v3 store which packs SHARD_CHUNKS
+# rivid chunks into each object, so there are far fewer objects to archive, and is read with the same chunks
+ZARR_LAYOUT = os.environ.get('ZARR_LAYOUT', 'chunked')
+ZARR_LAYOUTS = ('chunked', 'sharded')
+
+# target size of one uncompressed Qout chunk, the same as the dask 'array.chunk-size' used before
+CHUNK_BYTES = 5e6
+# number of rivid chunks read from the netCDFs and written to the zarr at once by each VPU
+BLOCK_CHUNKS = 16
+# number of rivid chunks in each shard object of the sharded layout
+SHARD_CHUNKS = 16
+STAGING_DIR_SUFFIX = '.staging'
+
+
+def _zarr_path(ymd: str) -> str:
+    return os.path.join(FORECASTS_DIR, ymd, 'outputs', f'{ymd}.zarr')
+
+
+def _store_layout(zarr_file_path: str) -> str or None:
+    if os.path.exists(os.path.join(zarr_file_path, 'zarr.json')):
+        return 'sharded'
+    if os.path.exists(os.path.join(zarr_file_path, '.zgroup')):
+        return 'chunked'
+    return None
+
+
+def _store_metadata_files(zarr_file_path: str) -> tuple:
+    # the file with the date_created of the store and the file written by consolidating its metadata. Consolidating
+    # rewrites the root zarr.json of the sharded layout, so date_created is saved in the Qout attributes there too
+    if _store_layout(zarr_file_path) == 'sharded':
+        return os.path.join(zarr_file_path, 'Qout', 'zarr.json'), os.path.join(zarr_file_path, 'zarr.json')
+    return os.path.join(zarr_file_path, '.zattrs'), os.path.join(zarr_file_path, '.zmetadata')
+
+
+def _ensemble_numbers(ymd: str) -> list:
+    ensemble_nums = glob.glob(os.path.join(RUNOFFS_DIR, ymd, '*runoff*.nc'))
+    ensemble_nums = [int(os.path.basename(x).split('.')[0]) for x in ensemble_nums]
+    return sorted([x for x in ensemble_nums if x != 52]) + [52]
+
+
+def _vpu_output_files(outputs_directory: str, vpu: str) -> tuple:
+    qout_52_files = glob.glob(os.path.join(outputs_directory, f'Qout_{vpu}_*_52.nc'))
+    return os.path.join(outputs_directory, f'Qout_{vpu}.nc'), (qout_52_files[0] if qout_52_files else None)
+
+
+def _rivid_chunk_size(n_ensembles: int, n_times: int, n_rivids: int) -> int:
+    return int(min(max(CHUNK_BYTES // (4 * n_ensembles * n_times), 1), n_rivids))
+
+
+def create_forecast_zarr(ymd: str, template_vpu: str = None, layout: str = ZARR_LAYOUT) -> str:
+    """
+    Creates the empty zarr store of a forecast day which each VPU fills with write_vpu_region
+
+    The rivid, ensemble and time coordinates are written up front. Reaches are the riv_bas_id of every VPU in the
+    configs directory in natural sort order, which is the order the Qout files are written in by RAPID. The times are
+    the union of the times of ensembles 1-51 and ensemble 52 of one VPU since all VPUs share the same runoff times.
+    The rivid range of each VPU is saved in the 'vpu_regions' attribute of the store.
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        template_vpu (str): VPU whose outputs are used for the time coordinate and Qout attributes. Defaults to the
+            first VPU with outputs
+        layout (str): 'chunked' for a zarr v2 store or 'sharded' for a zarr v3 store with SHARD_CHUNKS rivid chunks in
+            each shard
+
+    Returns:
+        str: Path to the zarr store
+    """
+    outputs_directory = os.path.join(FORECASTS_DIR, ymd, 'outputs')
+    vpu_dirs = natsorted([x for x in glob.glob(os.path.join(CONFIGS_DIR, '*')) if os.path.isdir(x)])
+    vpu_nums = [os.path.basename(x) for x in vpu_dirs]
+    if template_vpu is None:
+        template_vpu = next(x for x in vpu_nums if os.path.exists(_vpu_output_files(outputs_directory, x)[0]))
+
+    rivids = []
+    vpu_regions = {}
+    for vpu, vpu_dir in zip(vpu_nums, vpu_dirs):
+        vpu_rivids = pd.read_csv(os.path.join(vpu_dir, 'riv_bas_id.csv'), header=None).iloc[:, 0].to_numpy()
+        start = sum(x.shape[0] for x in rivids)
+        vpu_regions[vpu] = [start, start + vpu_rivids.shape[0]]
+        rivids.append(vpu_rivids)
+    rivids = np.concatenate(rivids)
+
+    qout_1_51_file, qout_52_file = _vpu_output_files(outputs_directory, template_vpu)
+    with xr.open_dataset(qout_1_51_file) as ds:
+        times = ds['time'].values
+        rivid_dtype = ds['rivid'].dtype
+        qout_attrs = dict(ds['Qout'].attrs)
+    if qout_52_file is not None:
+        with xr.open_dataset(qout_52_file) as ds:
+            times = np.union1d(times, ds['time'].values)
+    for attr in ('coordinates', 'grid_mapping'):
+        qout_attrs.pop(attr, None)
+
+    ensembles = _ensemble_numbers(ymd)
+    chunks = (len(ensembles), times.shape[0], _rivid_chunk_size(len(ensembles), times.shape[0], rivids.shape[0]))
+    # a rewritten store has new attributes, which invalidates the VPU regions written to the old one
+    date_created = datetime.datetime.now(datetime.UTC).isoformat()
+    if layout == 'sharded':
+        shards = (*chunks[:2], chunks[2] * SHARD_CHUNKS)
+        compressor = BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle')
+        encoding = {'Qout': {'compressors': (compressor,), 'chunks': chunks, 'shards': shards, '_FillValue': np.nan}}
+        zarr_format, write_chunks = 3, shards
+        qout_attrs['date_created'] = date_created
+    else:
+        compressor = Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
+        encoding = {'Qout': {'compressors': (compressor,), 'chunks': chunks, '_FillValue': np.nan}}
+        zarr_format, write_chunks = 2, chunks
+    ds = xr.Dataset(
+        {'Qout': (('ensemble', 'time', 'rivid'), da.empty((len(ensembles), times.shape[0], rivids.shape[0]),
+                                                          chunks=write_chunks, dtype='float32'), qout_attrs)},
+        coords={'ensemble': ensembles, 'time': times, 'rivid': rivids.astype(rivid_dtype)},
+        attrs={'vpu_regions': vpu_regions, 'date_created': date_created},
+    )
+    zarr_file_path = _zarr_path(ymd)
+    # only the metadata and coordinates are written, unwritten Qout chunks read as NaN
+    ds.to_zarr(zarr_file_path, mode='w', compute=False, zarr_format=zarr_format, consolidated=False,
+               encoding=encoding)
+    return zarr_file_path
+
+
+def _ensure_forecast_zarr(ymd: str, vpu: str, layout: str = ZARR_LAYOUT) -> str:
+    # the first VPU to finish creates the store, the others wait on the lock and reuse it
+    zarr_file_path = _zarr_path(ymd)
+    with open(f'{zarr_file_path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not any(os.path.exists(os.path.join(zarr_file_path, 'Qout', x)) for x in ('.zarray', 'zarr.json')):
+            create_forecast_zarr(ymd, template_vpu=vpu, layout=layout)
+    return zarr_file_path
+
+
+def _region_blocks(start: int, end: int, chunk_size: int, n_rivids: int, block_chunks: int = BLOCK_CHUNKS) -> list:
+    # splits a VPU's rivid range into blocks of whole chunks and the partial chunks it shares with its neighbors. For
+    # the sharded layout chunk_size is the shard size, since writing part of a shard rewrites the whole shard object
+    first_full = min(-(-start // chunk_size) * chunk_size, end)
+    last_full = end if end == n_rivids else max((end // chunk_size) * chunk_size, first_full)
+    blocks = []
+    if start < first_full:
+        blocks.append((start, first_full, False))
+    step = chunk_size * block_chunks
+    blocks += [(x, min(x + step, last_full), True) for x in range(first_full, last_full, step)]
+    if last_full < end:
+        blocks.append((last_full, end, False))
+    return blocks
+
+
+def write_vpu_region(ymd: str, vpu: str, layout: str = ZARR_LAYOUT) -> dict:
+    """
+    Writes the ensembles 1-51 and ensemble 52 discharge of one VPU to its rivid range of the forecast zarr
+
+    Blocks of whole chunks, or whole shards in the sharded layout, are written directly, so VPUs can be written by
+    separate processes at the same time. The few rivids in chunks or shards shared with the neighboring VPUs are staged
+    next to the store and written by finalize_forecast_zarr. The store is created if it does not exist yet.
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        vpu (str): VPU number
+        layout (str): Layout of the store if this VPU creates it. An existing store keeps its layout
+
+    Returns:
+        dict: The VPU, its rivid range, and the number of rivids written and staged
+    """
+    outputs_directory = os.path.join(FORECASTS_DIR, ymd, 'outputs')
+    zarr_file_path = _ensure_forecast_zarr(ymd, vpu, layout)
+    staging_dir = f'{zarr_file_path}{STAGING_DIR_SUFFIX}'
+    os.makedirs(staging_dir, exist_ok=True)
+
+    with xr.open_zarr(zarr_file_path, consolidated=False) as store:
+        times = pd.Index(store['time'].values)
+        ensembles = pd.Index(store['ensemble'].values)
+        start, end = store.attrs['vpu_regions'][vpu]
+        expected_rivids = store['rivid'].values[start:end]
+    qout = zarr.open_group(zarr_file_path, mode='r+')['Qout']
+    chunk_size = qout.chunks[2]
+    shard_size = qout.shards[2] if qout.shards else chunk_size
+
+    qout_1_51_file, qout_52_file = _vpu_output_files(outputs_directory, vpu)
+    with contextlib.ExitStack() as stack:
+        ds = stack.enter_context(xr.open_dataset(qout_1_51_file))
+        if not np.array_equal(ds['rivid'].values, expected_rivids):
+            raise ValueError(f'The rivids of {qout_1_51_file} do not match riv_bas_id.csv of VPU {vpu}')
+        members = ds['Qout'].transpose('ensemble', 'time', 'rivid')
+        sources = [(members, np.arange(members.shape[0]), times.get_indexer(ds['time'].values))]
+        if qout_52_file is not None:
+            ds52 = stack.enter_context(xr.open_dataset(qout_52_file))
+            sources.append((ds52['Qout'].expand_dims('ensemble'), ensembles.get_indexer([52]),
+                            times.get_indexer(ds52['time'].values)))
+
+        written = staged = 0
+        blocks = _region_blocks(start, end, shard_size, qout.shape[2], max(BLOCK_CHUNKS * chunk_size // shard_size, 1))
+        for block_start, block_end, whole_chunks in blocks:
+            values = np.full((len(ensembles), len(times), block_end - block_start), np.nan, dtype='float32')
+            for source, ensemble_idx, time_idx in sources:
+                values[np.ix_(ensemble_idx, time_idx)] = source[:, :, block_start - start:block_end - start].values
+            if whole_chunks:
+                qout[:, :, block_start:block_end] = values
+                written += block_end - block_start
+            else:
+                np.save(os.path.join(staging_dir, f'{vpu}_{block_start}_{block_end}.npy'), values)
+                staged += block_end - block_start
 
+    return {'vpu': vpu, 'region': [start, end], 'written': written, 'staged': staged}
 
-def netcdf_forecasts_to_zarr(ymd: str) -> None:
+
+def _region_files(ymd: str, vpu: str) -> tuple:
+    # the stage manifest inputs and outputs of a VPU region: the netCDFs, and the store attributes and staged blocks
+    outputs_directory = os.path.join(FORECASTS_DIR, ymd, 'outputs')
+    zarr_file_path = _zarr_path(ymd)
+    inputs = [x for x in _vpu_output_files(outputs_directory, vpu) if x is not None]
+    outputs = [_store_metadata_files(zarr_file_path)[0],
+               *glob.glob(os.path.join(f'{zarr_file_path}{STAGING_DIR_SUFFIX}', f'{vpu}_*.npy'))]
+    return inputs, outputs
+
+
+def write_vpu_region_once(ymd: str, vpu: str, manifest: StageManifest, layout: str = ZARR_LAYOUT) -> dict or None:
+    """
+    Writes a VPU region unless the stage manifest shows it was written to the current store from the same netCDFs
+
+    Returns:
+        dict: The result of write_vpu_region, or None if the region was already written
+    """
+    inputs, _ = _region_files(ymd, vpu)
+    if manifest.is_complete('zarr', vpu, inputs):
+        return None
+    result = write_vpu_region(ymd, vpu, layout)
+    manifest.record('zarr', vpu, *_region_files(ymd, vpu))
+    return result
+
+
+def finalize_forecast_zarr(ymd: str, manifest: StageManifest = None) -> None:
+    """
+    Writes the staged rivids in chunks shared by neighboring VPUs, consolidates the zarr metadata and builds the rivid
+    index used by reach_query.py
+
+    Args:
+        ymd (str): Year, month, and day in YYYYMMDD format
+        manifest (StageManifest): Stage manifest of the day where the staged files are recorded as consumed
+    """
+    zarr_file_path = _zarr_path(ymd)
+    staging_dir = f'{zarr_file_path}{STAGING_DIR_SUFFIX}'
+    qout = zarr.open_group(zarr_file_path, mode='r+')['Qout']
+    staged_files = natsorted(glob.glob(os.path.join(staging_dir, '*.npy')))
+    for staged_file in staged_files:
+        block_start, block_end = [int(x) for x in os.path.basename(staged_file)[:-4].split('_')[-2:]]
+        qout[:, :, block_start:block_end] = np.load(staged_file)
+    with warnings.catch_warnings():
+        # consolidated metadata is not part of the zarr v3 spec yet, zarr-python and xarray read it all the same
+        warnings.simplefilter('ignore', UserWarning)
+        zarr.consolidate_metadata(zarr_file_path)
+    build_rivid_index(zarr_file_path)
+    if manifest is not None:
+        manifest.record('zarrfinalize', ymd, staged_files, [_store_metadata_files(zarr_file_path)[1]],
+                        consumed=staged_files)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    if os.path.exists(f'{zarr_file_path}.lock'):
+        os.remove(f'{zarr_file_path}.lock')
+
+
+def netcdf_forecasts_to_zarr(ymd: str, max_workers: int = None, manifest: StageManifest = None,
+                             layout: str = ZARR_LAYOUT) -> None:
     """
     Converts the netcdf forecast files to zarr.
 
     Args:
         ymd (str): Year, month, and day in YYYYMMDD format.
+        max_workers (int): Number of VPUs written at once. Defaults to the number of CPUs
+        manifest (StageManifest): Stage manifest of the day. If given, VPU regions already written to the existing
+            store from the same netCDFs are kept and only the other VPUs are written
+        layout (str): 'chunked' or 'sharded'. An existing store with the other layout is written again
     """
     outputs_directory = os.path.join(FORECASTS_DIR, ymd, "outputs")
     vpu_nums = [x for x in glob.glob(os.path.join(CONFIGS_DIR, "*")) if os.path.isdir(x)]
     vpu_nums = natsorted([os.path.basename(x).replace('.nc', '') for x in vpu_nums])
-    ensemble_nums = glob.glob(os.path.join(RUNOFFS_DIR, ymd, '*runoff*.nc'))
-    ensemble_nums = [int(os.path.basename(x).split('.')[0]) for x in ensemble_nums]
-    ensemble_nums = sorted([x for x in ensemble_nums if x != 52])
-
-    qout_52_files = natsorted(glob.glob(os.path.join(outputs_directory, f"Qout_*_52.nc")))
-    qout_1_51_files = natsorted([os.path.join(outputs_directory, f"Qout_{vpu}.nc") for vpu in vpu_nums])
-    qout_1_51_files = [x for x in qout_1_51_files if os.path.exists(x)]
-    zarr_file_path = os.path.join(outputs_directory, f"{ymd}.zarr")
-
-    if os.path.exists(zarr_file_path):
-        shutil.rmtree(zarr_file_path)
-
-    with dask.config.set(**{
-        'array.slicing.split_large_chunks': False,
-        # set the max chunk size to 5MB
-        'array.chunk-size': '5MB',
-        # use the threads scheduler
-        'scheduler': 'threads',
-        # set the maximum memory target usage to 90% of total memory
-        'distributed.worker.memory.target': 0.80,
-        # do not allow spilling to disk
-        'distributed.worker.memory.spill': False,
-        # specify the amount of resources to allocate to dask workers
-        'distributed.worker.resources': {
-            'memory': 6e9,  # 1e9=1GB, this is the amount per worker
-            'cpu': os.cpu_count(),  # num CPU per worker
-        }
-    }):
-        print("Configuring compression")
-        compressor = Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
-        encoding = {'Qout': {"compressor": compressor}}
-        print("Opening ensembles 1-51 datasets")
-        with xr.open_mfdataset(qout_1_51_files, combine="nested", concat_dim="rivid") as ds151:
-            print("Assigning the ensemble coordinate variable")
-            ds151 = ds151.assign_coords(ensemble=ensemble_nums)
-            print("Opening ensemble 52 dataset")
-            with xr.open_mfdataset(qout_52_files, combine="nested", concat_dim="rivid") as ds52:
-                print("Assigning the ensemble coordinate variable")
-                ds52 = ds52.assign_coords(ensemble=52)
-                print("Writing to zarr")
-                (
-                    xr
-                    .concat([ds151, ds52], dim="ensemble")
-                    .drop_vars(["crs", "lat", "lon", "time_bnds", "Qout_err"])
-                    .chunk({
-                        "time": -1,
-                        "rivid": "auto",
-                        "ensemble": -1
-                    })
-                    .to_zarr(
-                        zarr_file_path,
-                        consolidated=True,
-                        encoding=encoding,
-                    )
-                )
-                print("Done")
+    vpu_nums = [x for x in vpu_nums if os.path.exists(_vpu_output_files(outputs_directory, x)[0])]
+    zarr_file_path = _zarr_path(ymd)
+
+    remaining = vpu_nums
+    if manifest is not None:
+        remaining = manifest.remaining('zarr', {vpu: _region_files(ymd, vpu)[0] for vpu in vpu_nums})
+    if remaining == vpu_nums or _store_layout(zarr_file_path) != layout:
+        remaining = vpu_nums
+        for path in (zarr_file_path, f'{zarr_file_path}{STAGING_DIR_SUFFIX}'):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        print("Creating the zarr store")
+        create_forecast_zarr(ymd, template_vpu=vpu_nums[0], layout=layout)
+    print(f"Writing {len(remaining)} of {len(vpu_nums)} VPUs")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(write_vpu_region, [ymd] * len(remaining), remaining, [layout] * len(remaining)):
+            print(f"Wrote VPU {result['vpu']} rivids {result['region'][0]}-{result['region'][1]}")
+            if manifest is not None:
+                manifest.record('zarr', result['vpu'], *_region_files(ymd, result['vpu']))
+    print("Finalizing")
+    finalize_forecast_zarr(ymd, manifest)
+    print("Done")
 
 
 if __name__ == "__main__":
@@ -89,5 +328,45 @@ if __name__ == "__main__":
         help="Year, month, and day in YYYYMMDD format",
         required=True,
     )
+    parser.add_argument(
+        "--vpu",
+        help="Write only this VPU to the zarr, creating the store if needed. Run --finalize after all VPUs",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--finalize",
+        help="Write the staged rivids of chunks shared by VPUs and consolidate the metadata",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--layout",
+        help="'chunked' writes a zarr v2 store, 'sharded' a zarr v3 store with many chunks in each object. Defaults "
+             "to ZARR_LAYOUT or chunked",
+        choices=ZARR_LAYOUTS,
+        required=False,
+        default=ZARR_LAYOUT,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of VPUs written at once when converting the whole forecast",
+        type=int,
+        required=False,
+        default=None,
+    )
     args = parser.parse_args()
-    netcdf_forecasts_to_zarr(ymd=args.ymd)
+    zarr_file = _zarr_path(args.ymd)
+    zarr_outputs = [os.path.join(zarr_file, '**'), os.path.join(f'{zarr_file}{STAGING_DIR_SUFFIX}', '*')]
+    zarr_manifest = StageManifest.for_day(args.ymd)
+    if args.vpu:
+        with stage('zarr', ymd=args.ymd, vpu=args.vpu, outputs=zarr_outputs) as zarr_stage:
+            zarr_stage.add(**(write_vpu_region_once(ymd=args.ymd, vpu=args.vpu, manifest=zarr_manifest,
+                                                    layout=args.layout) or {}))
+    if args.finalize:
+        with stage('zarrfinalize', ymd=args.ymd, outputs=zarr_outputs):
+            finalize_forecast_zarr(ymd=args.ymd, manifest=zarr_manifest)
+    if not (args.vpu or args.finalize):
+        with stage('zarr', ymd=args.ymd, outputs=zarr_outputs):
+            netcdf_forecasts_to_zarr(ymd=args.ymd, max_workers=args.workers, manifest=zarr_manifest,
+                                     layout=args.layout)
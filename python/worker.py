@@ -0,0 +1,411 @@
+import argparse
+import collections
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import runpy
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from resource_model import MEMORY_MODEL_PATH, MemoryModel, TaskCells, default_memory_budget
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_SOCKET = os.environ.get('WORKER_SOCKET')
+
+# the scripts a worker runs as tasks, by the name of the script without .py
+TASKS = (
+    'prepare_inflows', 'vpu_config_index', 'return_periods', 'prepare_namelists', 'postprocess_rapid_outputs',
+    'subbasins', 'calculate_inits', 'generate_vpu_map_tables', 'generate_global_map_tables', 'vpu_netcdfs_to_zarr',
+)
+# the stage of the memory model of each task. vpu_netcdfs_to_zarr --finalize is the zarrfinalize stage, and tasks of
+# other scripts are not estimated
+TASK_STAGES = {
+    'prepare_inflows': 'inflows', 'prepare_namelists': 'namelists', 'postprocess_rapid_outputs': 'postprocess',
+    'calculate_inits': 'inits', 'generate_vpu_map_tables': 'maptables', 'generate_global_map_tables': 'globalmaptables',
+    'vpu_netcdfs_to_zarr': 'zarr',
+}
+# imported once by the worker before its pool is forked so that no task pays for importing them. polars is left to
+# the tasks, its thread pool is not safe to fork
+PRELOAD_MODULES = ('numpy', 'pandas', 'netCDF4', 'xarray', 'dask.array', 'zarr', 'scipy.sparse')
+SHUTDOWN_TASK = 'shutdown'
+
+
+def task_argv(args: list or dict or None) -> list:
+    """
+    Converts the args of a task request to command line arguments
+
+    A list is used as is. A dict maps each key to --key followed by its value, or by each of its values if it is a
+    list. True adds only the flag, and False or None leaves the option out.
+    """
+    if args is None:
+        return []
+    if isinstance(args, list):
+        return [str(x) for x in args]
+    argv = []
+    for key, value in args.items():
+        if value is None or value is False:
+            continue
+        argv.append(f'--{key}')
+        if value is True:
+            continue
+        argv.extend(str(x) for x in (value if isinstance(value, list) else [value]))
+    return argv
+
+
+def _task_arguments(argv: list) -> argparse.Namespace:
+    # the arguments of the scripts which tell the day, VPU and ensemble member of a task
+    parser = argparse.ArgumentParser(add_help=False)
+    for name in ('--ymd', '--vpu', '--ensemble', '--outputs', '--workers'):
+        parser.add_argument(name, type=str, default=None)
+    parser.add_argument('--finalize', action='store_true', default=False)
+    return parser.parse_known_args(argv)[0]
+
+
+def task_cells(task: str, argv: list, cells: TaskCells) -> tuple:
+    """
+    Finds the stage of a task and counts the reaches x timesteps x ensemble members it handles from its arguments
+
+    Returns:
+        tuple: The stage and the cells, or None and 0 if the task is not estimated
+    """
+    stage = TASK_STAGES.get(task)
+    if stage is None:
+        return None, 0
+    args = _task_arguments(argv)
+    if stage == 'zarr' and args.finalize:
+        stage = 'zarrfinalize'
+    # postprocess_rapid_outputs is given the outputs directory of the day, FORECASTS_DIR/ymd/outputs
+    ymd = args.ymd or (os.path.basename(os.path.dirname(os.path.normpath(args.outputs))) if args.outputs else None)
+    if ymd is None:
+        return stage, 0
+    workers = int(args.workers) if stage == 'inflows' and args.workers else None
+    return stage, cells.cells(stage, ymd, args.vpu, args.ensemble, workers)
+
+
+def _initialize_process(log_path: str = None) -> None:
+    # the output of the tasks goes to the log, or to stderr so that stdout only carries the task results
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if log_path:
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.dup2(fd, 2)
+        os.close(fd)
+    os.dup2(2, 1)
+
+
+def run_task(task: str, argv: list) -> dict:
+    """
+    Runs a script as if it were called from the command line, in the current process
+
+    The script is executed as __main__ with argv as its arguments, so it behaves as a new interpreter running the
+    script except that modules imported by earlier tasks are already imported. Logging is reset before each task.
+
+    Returns:
+        dict: The returncode and wall seconds of the task, and the error if it raised one
+    """
+    script = os.path.join(SCRIPTS_DIR, f'{task}.py')
+    sys.argv = [script, *argv]
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.root.setLevel(logging.WARNING)
+
+    result = {'returncode': 0, 'pid': os.getpid()}
+    t0 = time.perf_counter()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        result['returncode'] = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception as e:
+        traceback.print_exc()
+        result.update(returncode=1, error=f'{type(e).__name__}: {e}')
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    result['seconds'] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+class TaskWorker:
+    """
+    Runs the workflow scripts as tasks on a pool of long lived processes so that each process imports the libraries
+    of the scripts once instead of once per task
+
+    The pool is forked after PRELOAD_MODULES are imported. Each task runs a script with run_task, so the stage
+    metrics and the stage manifest are recorded as when the script is run on its own. The environment variables are
+    read once per worker, start one worker per forecast environment. The peak RSS of the stage metrics recorded by a
+    task is reset when its stage starts, so it does not include earlier tasks of the same pool process.
+
+    With a memory budget the peak MB of each task is estimated with the memory model of scheduler.py, and a task only
+    starts while the estimates of the running tasks and its own fit in the budget. Tasks start in the order they were
+    submitted, so a large task waits for memory to be freed instead of being overtaken by smaller tasks. A task whose
+    estimate alone is over the budget runs when nothing else is running.
+
+    Args:
+        max_workers (int): Number of tasks run at once. Defaults to the number of CPUs
+        log_path (str): File to append the output of the tasks to. Defaults to stderr
+        memory_budget_mb (float): MB the estimated peaks of the running tasks may add up to. Defaults to no limit
+        memory_model (MemoryModel): Estimates the peaks of the tasks. Defaults to the uncalibrated model
+    """
+
+    def __init__(self, max_workers: int = None, log_path: str = None, memory_budget_mb: float = None,
+                 memory_model: MemoryModel = None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.log_path = log_path
+        self.memory_budget_mb = memory_budget_mb
+        self.memory_model = memory_model or MemoryModel()
+        self.cells = TaskCells(os.environ['CONFIGS_DIR'], os.environ['RUNOFFS_DIR']) if memory_budget_mb else None
+        self._lock = threading.RLock()
+        # tasks waiting for a process and memory, and the number and estimated MB of the tasks running
+        self._waiting = collections.deque()
+        self._n_running = 0
+        self._memory_in_use = 0
+        for module in PRELOAD_MODULES:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                logging.warning(f'Could not preload {module}')
+        self.executor = self._start_pool()
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=_initialize_process, initargs=(self.log_path, ))
+        # a forked pool starts all its processes with the first task, which is done before any server thread starts
+        executor.submit(os.getpid).result()
+        return executor
+
+    def submit(self, request: dict, callback) -> None:
+        """
+        Queues a task, starts it when a process and its estimated memory are free, and calls callback with its result
+        when it finishes
+
+        Args:
+            request (dict): The task name as 'task', its arguments as 'args' (see task_argv) and an optional 'id'
+                returned with the result
+            callback: Function called with the result dict, which has the stage, cells and estimated memory_mb of the
+                task if the worker has a memory budget
+        """
+        result = {'id': request.get('id'), 'task': request.get('task')}
+        if request.get('task') not in TASKS:
+            callback({**result, 'status': 'failed', 'returncode': 1, 'error': f'Unknown task {request.get("task")}'})
+            return
+        try:
+            argv = task_argv(request.get('args'))
+        except (AttributeError, TypeError) as e:
+            callback({**result, 'status': 'failed', 'returncode': 1, 'error': f'Invalid args: {e}'})
+            return
+        memory_mb = 0
+        if self.cells is not None:
+            try:
+                stage, cells = task_cells(request['task'], argv, self.cells)
+            except Exception as e:
+                logging.warning(f'Could not estimate the memory of task {request.get("id")}: {type(e).__name__}: {e}')
+                stage, cells = TASK_STAGES.get(request['task']), 0
+            memory_mb = self.memory_model.estimate(stage, cells) if stage else 0
+            result.update(stage=stage, cells=cells, memory_mb=memory_mb)
+        with self._lock:
+            self._waiting.append((request['task'], argv, memory_mb, result, callback))
+            self._start_waiting()
+
+    def _start_waiting(self) -> None:
+        with self._lock:
+            while self._waiting and self._n_running < self.max_workers:
+                task, argv, memory_mb, result, callback = self._waiting[0]
+                if (self.memory_budget_mb and self._n_running
+                        and self._memory_in_use + memory_mb > self.memory_budget_mb):
+                    break
+                self._waiting.popleft()
+                if self.memory_budget_mb and memory_mb > self.memory_budget_mb:
+                    logging.warning(f'{task} {result["id"]} is estimated to need {memory_mb} MB, more than the budget '
+                                    f'of {self.memory_budget_mb} MB. Running it alone')
+                self._n_running += 1
+                self._memory_in_use += memory_mb
+                future = self.executor.submit(run_task, task, argv)
+                future.add_done_callback(lambda f, m=memory_mb, r=result, c=callback: self._finish(f, m, r, c))
+
+    def _finish(self, future, memory_mb: float, result: dict, callback) -> None:
+        try:
+            task_result = future.result()
+        except BrokenProcessPool as e:
+            # a task which kills its process breaks the pool, the tasks still running in it fail too
+            task_result = {'returncode': 1, 'error': f'The worker pool broke: {e}'}
+            self._restart_pool()
+        except Exception as e:
+            task_result = {'returncode': 1, 'error': f'{type(e).__name__}: {e}'}
+        with self._lock:
+            self._n_running -= 1
+            self._memory_in_use -= memory_mb
+        status = 'succeeded' if task_result['returncode'] == 0 else 'failed'
+        callback({**result, 'status': status, **task_result})
+        self._start_waiting()
+
+    def _restart_pool(self) -> None:
+        with self._lock:
+            if getattr(self.executor, '_broken', False):
+                logging.error('Restarting the broken worker pool')
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._start_pool()
+
+    def serve_stream(self, rfile, wfile, on_shutdown=None) -> int:
+        """
+        Runs the tasks of each JSON line read from rfile and writes the result of each task to wfile as a JSON line
+        when it finishes, in the order they finish. Returns after the results of all tasks are written
+
+        Returns:
+            int: Number of failed tasks
+        """
+        lock = threading.Lock()
+        pending = threading.Semaphore(0)
+        failures = 0
+        n_submitted = 0
+
+        def _respond(result: dict) -> None:
+            nonlocal failures
+            with lock:
+                failures += result['status'] != 'succeeded'
+                try:
+                    wfile.write((json.dumps(result) + '\n').encode())
+                    wfile.flush()
+                except (BrokenPipeError, ValueError, OSError):
+                    logging.warning(f'Could not return the result of task {result.get("id")}')
+            pending.release()
+
+        for line in rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('a task request is a JSON object')
+            except ValueError as e:
+                n_submitted += 1
+                _respond({'id': None, 'task': None, 'status': 'failed', 'returncode': 1, 'error': f'Bad request: {e}'})
+                continue
+            n_submitted += 1
+            if request.get('task') == SHUTDOWN_TASK and on_shutdown is not None:
+                _respond({'id': request.get('id'), 'task': SHUTDOWN_TASK, 'status': 'succeeded', 'returncode': 0})
+                on_shutdown()
+                break
+            self.submit(request, _respond)
+
+        for _ in range(n_submitted):
+            pending.acquire()
+        return failures
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def serve_socket(worker: TaskWorker, socket_path: str) -> None:
+    """
+    Serves tasks on a unix socket until a shutdown task is received or the process is terminated
+
+    Each connection sends task requests as JSON lines and receives a JSON line with the result of each task.
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            worker.serve_stream(self.rfile, self.wfile,
+                                on_shutdown=lambda: threading.Thread(target=server.shutdown).start())
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    logging.info(f'Serving tasks on {socket_path} with {worker.max_workers} processes')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(socket_path: str, request: dict, connect_timeout: float = 60) -> dict:
+    """
+    Sends one task to a worker serving on a unix socket and waits for its result
+
+    Args:
+        socket_path (str): Path to the socket of the worker
+        request (dict): The task request, see TaskWorker.submit
+        connect_timeout (float): Seconds to wait for the worker to start listening
+
+    Returns:
+        dict: The result of the task
+    """
+    deadline = time.time() + connect_timeout
+    while True:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            client.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+    with client, client.makefile('rwb') as stream:
+        stream.write((json.dumps(request) + '\n').encode())
+        stream.flush()
+        client.shutdown(socket.SHUT_WR)
+        line = stream.readline()
+    if not line:
+        return {**request, 'status': 'failed', 'returncode': 1, 'error': 'The worker closed the connection'}
+    return json.loads(line)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Long lived worker which runs the workflow scripts as tasks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser(
+        'serve', help='Run tasks read as JSON lines from stdin, or from connections to --socket')
+    serve_parser.add_argument('--socket', type=str, required=False, default=WORKER_SOCKET,
+                              help='Unix socket to serve tasks on. Defaults to WORKER_SOCKET, or stdin if not set')
+    serve_parser.add_argument('--workers', type=int, required=False, default=None,
+                              help='Number of tasks run at once. Defaults to the number of CPUs')
+    serve_parser.add_argument('--log', type=str, required=False, default=None,
+                              help='File to append the output of the tasks to. Defaults to stderr')
+    serve_parser.add_argument('--memory', type=float, required=False, default=None,
+                              help='MB the estimated peaks of the running tasks may add up to, 0 for no limit. '
+                                   'Defaults to MEMORY_BUDGET_MB or 80%% of the physical memory')
+    serve_parser.add_argument('--memorymodel', type=str, required=False, default=MEMORY_MODEL_PATH,
+                              help='Path to the memory model calibrated by resource_model.py. Defaults to '
+                                   'MEMORY_MODEL_PATH or FORECASTS_DIR/memory_model.json')
+    submit_parser = subparsers.add_parser('submit', help='Run one task on a worker serving on --socket')
+    submit_parser.add_argument('--socket', type=str, required=False, default=WORKER_SOCKET,
+                               help='Unix socket of the worker. Defaults to WORKER_SOCKET')
+    submit_parser.add_argument('--id', type=str, required=False, default=None, help='Identifier of the task')
+    submit_parser.add_argument('--timeout', type=float, required=False, default=60,
+                               help='Seconds to wait for the worker to start listening')
+    submit_parser.add_argument('task', type=str, choices=(*TASKS, SHUTDOWN_TASK), help='Script to run')
+    submit_parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the script')
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        if not args.socket:
+            parser.error('give the --socket of the worker or set WORKER_SOCKET')
+        task_result = submit(args.socket, {'id': args.id, 'task': args.task, 'args': args.args}, args.timeout)
+        print(json.dumps(task_result))
+        sys.exit(task_result.get('returncode') or 0)
+
+    memory_budget = default_memory_budget() if args.memory is None else args.memory
+    task_worker = TaskWorker(args.workers, args.log, memory_budget or None, MemoryModel.load(args.memorymodel))
+    try:
+        if args.socket:
+            serve_socket(task_worker, args.socket)
+            n_failed = 0
+        else:
+            n_failed = task_worker.serve_stream(sys.stdin.buffer, sys.stdout.buffer)
+    finally:
+        task_worker.close()
+    sys.exit(1 if n_failed else 0)
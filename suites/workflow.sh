@@ -22,6 +22,15 @@ done
 echo "YMD is set to: $YMD"
 export YMD
 
+# the repository this script is in
+WORKFLOW_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)
+# runs runrapid.py in the RAPID container, given the runrapid.py arguments
+RAPID_COMMAND=${RAPID_COMMAND:-docker exec -i rapid python3 /mnt/scripts/runrapid.py}
+# archives the day to S3 while the later stages run, given the archive_to_s3.py arguments. Set it empty to not archive
+ARCHIVE_COMMAND=${ARCHIVE_COMMAND-python $WORKFLOW_DIR/python/archive_to_s3.py}
+# number of tasks and RAPID runs at once
+WORKFLOW_WORKERS=${WORKFLOW_WORKERS:-$(nproc)}
+
 VPUS=$(ls -1 $CONFIGS_DIR | awk -F/ '{print $NF}' | sort -V)
 
 # Download the latest IFS grids from s3 bucket
@@ -36,41 +45,95 @@ mkdir -p $FORECASTS_DIR/$YMD/outputs
 mkdir -p $FORECASTS_DIR/$YMD/logs
 mkdir -p $FORECASTS_DIR/$YMD/maptables
 
+# Run the python stages as tasks of one long lived worker so that their libraries are imported once. It only starts
+# the tasks whose estimated peak memory fits in MEMORY_BUDGET_MB with the tasks already running
+echo "Starting the task worker"
+export WORKER_SOCKET=$FORECASTS_DIR/$YMD/logs/worker.sock
+$WORKFLOW_DIR/bash/forecast-workflow worker --workers "$WORKFLOW_WORKERS" --log $FORECASTS_DIR/$YMD/logs/worker.log 2>> $FORECASTS_DIR/$YMD/logs/worker.log &
+WORKER_PID=$!
+trap 'kill $WORKER_PID 2>/dev/null' EXIT
+SUBMIT="$WORKFLOW_DIR/bash/forecast-workflow submit"
+
 # Calculate inflows
 echo "Calculating inflows"
-xargs -I {} -P "$(nproc)" sh -c "python $HOME/forecast-workflow/python/prepare_inflows.py --ymd $YMD --vpu {} >> $FORECASTS_DIR/$YMD/logs/{}" <<< $VPUS || exit 1
+$SUBMIT prepare_inflows --ymd $YMD >> $FORECASTS_DIR/$YMD/logs/inflows.log || exit 1
 
 # Prepare namelists
 echo "Preparing namelists"
-xargs -I {} -P "$(nproc)" sh -c "python $HOME/forecast-workflow/python/prepare_namelists.py --ymd $YMD --vpu {} >> $FORECASTS_DIR/$YMD/logs/{}" <<< $VPUS || exit 1
+$SUBMIT vpu_config_index --configs $CONFIGS_DIR >> $FORECASTS_DIR/$YMD/logs/namelists.log || exit 1
+# only VPUs whose riv_bas_id.csv or return periods changed are compiled again
+$SUBMIT return_periods --configs $CONFIGS_DIR >> $FORECASTS_DIR/$YMD/logs/namelists.log || exit 1
+# VPUs with independent subnetworks are routed as RAPID_SUBBASINS runs of groups of subnetworks if it is set
+$SUBMIT prepare_namelists --ymd $YMD >> $FORECASTS_DIR/$YMD/logs/namelists.log || exit 1
 
 # RAPID routing
 echo "Running RAPID routing"
-NAMELISTS=$(ls -1 $FORECASTS_DIR/$YMD/namelists/* | sort -V)
-xargs -I {} -P "$(nproc)" sh -c 'docker exec rapid python3 /mnt/scripts/runrapid.py --namelist "{}" >> "$FORECASTS_DIR/$YMD/logs/$(basename "{}").log"' <<< "$NAMELISTS" || exit 1
+# the namelists whose Qout file is complete in the stage manifest are skipped, and the runs which succeeded are
+# recorded in it on the host because the container only has runrapid.py and the python standard library
+python $WORKFLOW_DIR/python/runrapid.py --pending $FORECASTS_DIR/$YMD/namelists | sort -V | $WORKFLOW_DIR/bash/instrument.sh rapid \
+  --outputs "$FORECASTS_DIR/$YMD/outputs/Qout_*.nc" -- $RAPID_COMMAND --worker \
+  --concurrency "$WORKFLOW_WORKERS" \
+  --runlog "$FORECASTS_DIR/$YMD/logs/rapid_runs.jsonl" \
+  --summary "$FORECASTS_DIR/$YMD/logs/rapid_summary.json" >> "$FORECASTS_DIR/$YMD/logs/rapid.log"
+RAPID_STATUS=$?
+python $WORKFLOW_DIR/python/runrapid.py --record "$FORECASTS_DIR/$YMD/logs/rapid_runs.jsonl" >> "$FORECASTS_DIR/$YMD/logs/rapid.log" || exit 1
+[[ $RAPID_STATUS -eq 0 ]] || exit 1
+if [[ -n "$RAPID_SUBBASINS" ]]; then
+  $SUBMIT subbasins merge --ymd $YMD >> "$FORECASTS_DIR/$YMD/logs/rapid.log" || exit 1
+fi
+
+# Archive map tables, inits and zarr chunks to S3 while the later stages produce them
+ARCHIVE_PID=
+if [[ -n "$ARCHIVE_COMMAND" ]]; then
+  echo "Starting the S3 archiver"
+  $ARCHIVE_COMMAND --ymd $YMD --watch --timeout 21600 >> "$FORECASTS_DIR/$YMD/logs/archive.log" 2>&1 &
+  ARCHIVE_PID=$!
+fi
+# stops the archiver without uploading an incomplete forecast if a later stage fails
+trap 'kill $ARCHIVE_PID $WORKER_PID 2>/dev/null' EXIT
 
-# Concatenate and summarize the ensemble outputs
+# Concatenate and summarize the ensemble outputs, then write each VPU to its region of the zarr while the other VPUs
+# are still being summarized
 echo "Concatenating and summarizing the ensemble outputs"
-xargs -I {} -P "$(nproc)" sh -c "../bash/postprocess_rapid_outputs.sh --outputs $FORECASTS_DIR/$YMD/outputs --vpu {} >> $FORECASTS_DIR/$YMD/logs/{}" <<< $VPUS || exit 1
+postprocess_vpu() {
+  $SUBMIT --id postprocess_$1 postprocess_rapid_outputs --outputs $FORECASTS_DIR/$YMD/outputs --vpu $1 >> $FORECASTS_DIR/$YMD/logs/postprocess.log || return 1
+  $SUBMIT --id zarr_$1 vpu_netcdfs_to_zarr --ymd $YMD --vpu $1 >> $FORECASTS_DIR/$YMD/logs/zarr.log
+}
+export -f postprocess_vpu
+export SUBMIT
+xargs -I {} -P "$WORKFLOW_WORKERS" bash -c 'postprocess_vpu {}' <<< $VPUS || exit 1
 
 # Calculate the init files
 echo "Calculating the init files"
-xargs -I {} -P "$(nproc)" sh -c "python $HOME/forecast-workflow/python/calculate_inits.py --ymd $YMD --vpu {} >> $FORECASTS_DIR/$YMD/logs/{}" <<< $VPUS || exit 1
+$SUBMIT calculate_inits --ymd $YMD --archive >> $FORECASTS_DIR/$YMD/logs/inits.log || exit 1
 
 # Generate Esri map style tables
 echo "Generating Esri map style tables"
-xargs -I {} -P "$(nproc)" sh -c "python $HOME/forecast-workflow/python/generate_vpu_map_tables.py --ymd $YMD --vpu {} >> $FORECASTS_DIR/$YMD/logs/{}" <<< $VPUS || exit 1
-python $HOME/forecast-workflow/python/generate_global_map_tables.py --ymd $YMD || exit 1
+xargs -I {} -P "$WORKFLOW_WORKERS" $SUBMIT --id maptables_{} generate_vpu_map_tables --ymd $YMD --vpu {} <<< $VPUS >> $FORECASTS_DIR/$YMD/logs/maptables.log || exit 1
+$SUBMIT generate_global_map_tables --ymd $YMD >> $FORECASTS_DIR/$YMD/logs/maptables.log || exit 1
 
-# NetCDF to Zarr (and delete netCDFs)
-echo "Converting NetCDF to Zarr"
-python $HOME/forecast-workflow/python/vpu_netcdfs_to_zarr.py --ymd $YMD || exit 1
+# Write the rivids of zarr chunks shared by neighboring VPUs and consolidate the metadata
+echo "Finalizing the Zarr"
+$SUBMIT vpu_netcdfs_to_zarr --ymd $YMD --finalize >> $FORECASTS_DIR/$YMD/logs/zarr.log || exit 1
+
+echo "Stopping the task worker"
+$SUBMIT shutdown > /dev/null
+wait $WORKER_PID
 
 # Archive inits, outputs, map tables
-echo "Archiving inits, outputs, map tables"
-../bash/archive_to_s3.sh
+if [[ -n "$ARCHIVE_PID" ]]; then
+  echo "Archiving inits, outputs, map tables"
+  wait $ARCHIVE_PID || exit 1
+fi
+trap - EXIT
+
+echo "Exporting stage metrics"
+python $WORKFLOW_DIR/python/instrumentation.py prometheus --ymd $YMD \
+  --output "${PROMETHEUS_TEXTFILE_DIR:-$FORECASTS_DIR/$YMD/logs}/forecast_workflow.prom"
+python $WORKFLOW_DIR/python/instrumentation.py summary --ymd $YMD \
+  --compare "$(date -d "$YMD - 1 day" +%Y%m%d)" > "$FORECASTS_DIR/$YMD/logs/metrics_summary.json"
 
 echo "Clearing forecast directory"
-../bash/clean_forecast_directory.sh
+$WORKFLOW_DIR/bash/instrument.sh clean -- $WORKFLOW_DIR/bash/clean_forecast_directory.sh
 
 echo "Forecast workflow completed successfully"